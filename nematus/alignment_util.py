@@ -17,34 +17,97 @@ import json
 import sys
 import codecs
 
+import numpy
+
 def get_alignments(attention, x_mask, y_mask):
-    #print("\nPrinting Attention...")
-    #print(attention)
-    #print("\nPrinting x_mask, need to figure out how to use it")
-    #print(x_mask)
-    #print("\nPrinting y_mask, need to figure out how to use it")
-    #print(y_mask)
-
-    n_rows, n_cols = y_mask.shape  ###n_cols correspond to the number of sentences.
-    #print("Number of rows and number of columns: \n\n", n_rows, n_cols)
-
-    for target_sent_index in range(n_cols):
-        #print("\n\n","*" * 40)
-        print("Going through sentence", target_sent_index)
-        #source_sent_index = source_indexes[target_sent_index]
-        target_length = y_mask[:,target_sent_index].tolist().count(1)
-        source_length = x_mask[:,target_sent_index].tolist().count(1)
-        # #print("STEP1: The attention matrix that is relevant for this sentence",)
-        temp_attention = attention[range(target_length),:,:]
-        #print("STEP2: The attention matrix that is particular to just this sentence\n",)
-        this_attention = temp_attention[:,target_sent_index,range(source_length)]
+    """Yield the attention matrix of each sentence in a minibatch as a JSON line ({"matrix": ...}).
+
+    attention: (target steps, sentences, source steps), as returned by the model
+    """
+    target_lengths = y_mask.sum(0).astype('int64')  ###one column per sentence
+    source_lengths = x_mask.sum(0).astype('int64')
+
+    for target_sent_index in range(y_mask.shape[1]):
+        this_attention = attention[:target_lengths[target_sent_index], target_sent_index,
+                                   :source_lengths[target_sent_index]]
 
         jdata = {}
         jdata['matrix'] = this_attention.tolist()
-        jdata = json.dumps(jdata)
-        #print("\t\tJSON Data")
-        #print("\t\t",jdata)
-        yield jdata
+        yield json.dumps(jdata)
+
+
+def format_matrix(matrix):
+    """Format an alignment matrix (one row per target word) as space-separated text, one row per line,
+    followed by an empty line."""
+    rows = numpy.asarray(matrix).astype(str)
+    return ''.join(' '.join(row) + ' \n' for row in rows) + '\n'
+
+
+def format_matrix_json(matrix, source, target, sid, tid):
+    """Format an alignment matrix as a JSON list of (target word, source word, weight, sid, tid) links
+    (the same text json.dump(..., ensure_ascii=False, indent=2) produces)."""
+    weights = numpy.asarray(matrix).astype(str)
+    if weights.size == 0:
+        return '[]'
+    source = [json.dumps(w, ensure_ascii=False) for w in source] + ['"</s>"']
+    target = [json.dumps(w, ensure_ascii=False) for w in target] + ['"</s>"']
+    ids = '{0}, \n    {1}\n  ]'.format(sid, tid)
+    links = []
+    for ti, row in enumerate(weights):
+        prefix = '[\n    ' + target[ti] + ', \n    '
+        for si, w in enumerate(row):
+            links.append(prefix + source[si] + ', \n    "' + w + '", \n    ' + ids)
+    return '[\n  ' + ', \n  '.join(links) + '\n]'
+
+
+class AlignmentArchive(object):
+    """Alignment matrices stored in a single .npz file, in the order they were added:
+
+    data: all matrices, flattened and concatenated (float32)
+    offsets: start of each matrix in data (and the end of the last one)
+    shapes: (target length, source length) of each matrix
+    ids: (sentence id, rank of the hypothesis in the n-best list) of each matrix
+    """
+
+    def __init__(self):
+        self.matrices = []
+        self.ids = []
+
+    def add(self, matrix, sid, rank=0):
+        self.matrices.append(numpy.asarray(matrix, dtype='float32'))
+        self.ids.append((sid, rank))
+
+    def extend(self, other):
+        self.matrices.extend(other.matrices)
+        self.ids.extend(other.ids)
+
+    def __len__(self):
+        return len(self.matrices)
+
+    def __getitem__(self, i):
+        return self.matrices[i]
+
+    def save(self, file):
+        shapes = numpy.array([m.shape for m in self.matrices], dtype='int64').reshape((-1, 2))
+        offsets = numpy.zeros(len(self.matrices) + 1, dtype='int64')
+        offsets[1:] = numpy.cumsum(shapes.prod(1))
+        if self.matrices:
+            data = numpy.concatenate([m.ravel() for m in self.matrices])
+        else:
+            data = numpy.zeros(0, dtype='float32')
+        numpy.savez(file, data=data, offsets=offsets, shapes=shapes,
+                    ids=numpy.array(self.ids, dtype='int64').reshape((-1, 2)))
+
+    @classmethod
+    def load(cls, file):
+        archive = cls()
+        npz = numpy.load(file)
+        data, offsets = npz['data'], npz['offsets']
+        for i, shape in enumerate(npz['shapes']):
+            archive.matrices.append(data[offsets[i]:offsets[i + 1]].reshape(shape))
+        archive.ids = [tuple(sid) for sid in npz['ids'].tolist()]
+        return archive
+
 
 def combine_source_target_text(source_IN, nbest_IN, saveto, alignment_IN):
     """
@@ -0,0 +1,506 @@
+"""
+Beam search and sampling with the f_init/f_next functions of a model, one
+sentence at a time (gen_sample) or a batch of sentences (gen_par_sample).
+
+Only NumPy is used here: f_init and f_next may be compiled Theano functions
+(nmt_utils.build_sampler, RemoteMT) or the NumPy backend (numpy_backend.py),
+which can then translate without importing Theano.
+"""
+
+import copy
+
+import numpy
+
+
+# gen_sample calls f_init(x) and f_next(word, ctx, state) one sentence at a
+# time, so nothing is padded; supply an all-ones x_mask to compiled samplers
+# (RemoteMT.x_f_init and RemoteMT.x_f_next do the same for remote models).
+def unmasked_sampler(f_init, f_next):
+
+    def _f_init(x, x_mask=None):
+        if x_mask is None:
+            x_mask = numpy.ones(x.shape[1:]).astype('float32')
+        return f_init(x, x_mask)
+
+    def _f_next(word, ctx, state, x_mask=None):
+        if x_mask is None:
+            x_mask = numpy.ones(ctx.shape[:-1]).astype('float32')
+        return f_next(word, ctx, state, x_mask)
+
+    return _f_init, _f_next
+
+
+# select the surviving beam candidates from a [n_hyps, vocab] matrix of costs.
+# Without any pruning option this is exactly the n_best cheapest candidates;
+# returns indices into the flattened matrix.
+def _select_candidates(cand_scores, n_best, max_cands_per_hyp=None, prune_abs=None, prune_rel=None):
+    if n_best < 1 or cand_scores.size == 0:
+        return numpy.zeros((0,), dtype='int64')
+
+    # only keep the max_cands_per_hyp best continuations of each parent hypothesis
+    masked = False
+    if max_cands_per_hyp and max_cands_per_hyp < cand_scores.shape[1]:
+        worst = cand_scores.argpartition(max_cands_per_hyp-1, axis=1)[:, max_cands_per_hyp:]
+        cand_scores = cand_scores.copy()
+        cand_scores[numpy.arange(cand_scores.shape[0])[:, None], worst] = numpy.inf
+        masked = True
+
+    cand_flat = cand_scores.flatten()
+    n_best = min(n_best, cand_flat.shape[0])
+    ranks_flat = cand_flat.argpartition(n_best-1)[:n_best]
+
+    if masked:
+        ranks_flat = ranks_flat[numpy.isfinite(cand_flat[ranks_flat])]
+
+    # threshold pruning relative to the best candidate of this step:
+    # prune_abs is a margin in cost (negative log-probability),
+    # prune_rel a ratio to the probability of the best candidate
+    if (prune_abs is not None or prune_rel is not None) and ranks_flat.shape[0] > 0:
+        costs = cand_flat[ranks_flat]
+        threshold = numpy.inf
+        if prune_abs is not None:
+            threshold = min(threshold, numpy.nanmin(costs) + prune_abs)
+        if prune_rel is not None:
+            threshold = min(threshold, numpy.nanmin(costs) - numpy.log(prune_rel))
+        ranks_flat = ranks_flat[costs <= threshold]
+
+    return ranks_flat
+
+
+# adaptive beam width (adaptive_beam=gap): the beam of a sentence starts with
+# beam_min hypotheses. At each step, it is doubled (up to k) while the two best
+# candidates are less than gap apart, i.e. the search is unsure which one to
+# extend, and halved (down to beam_min) once the best one leads by gap or more.
+def _adapt_beam_width(width, cand_scores, gap, beam_min, k):
+    if cand_scores.size < 2:
+        return width
+    best = numpy.partition(cand_scores.ravel(), 1)[:2]
+    if best[1] - best[0] < gap:
+        return min(k, 2 * width)
+    return max(beam_min, width // 2)
+
+
+# costs only grow as hypotheses are extended, so once the cheapest live
+# hypothesis (divided by the longest possible length, if normalizing) is no
+# better than the best finished one, continuing the search is pointless.
+def _live_can_improve(hyp_scores, finished_samples, finished_scores, maxlen, normalize=False):
+    if len(finished_scores) == 0 or len(hyp_scores) == 0:
+        return True
+    if normalize:
+        best_finished = min(score / len(s) for s, score in zip(finished_samples, finished_scores))
+        best_live = numpy.min(hyp_scores) / float(maxlen)
+    else:
+        best_finished = min(finished_scores)
+        best_live = numpy.min(hyp_scores)
+    return best_live < best_finished
+
+
+# generate sample, either with stochastic sampling or beam search. Note that,
+# this function iteratively calls f_init and f_next functions.
+def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
+               stochastic=True, argmax=False, return_alignment=False,
+               return_hyp_graph=False, normalize=False, early_stop=False,
+               max_cands_per_hyp=None, prune_abs=None, prune_rel=None, log_probs=False,
+               adaptive_beam=None, beam_min=1, stats=None):
+    """
+    :param f_init: *list* of f_init functions. Each: state0, ctx0 = f_init(x)
+    :param f_next: *list* of f_next functions. Each: next_prob, next_word, next_state = f_next(word, ctx, state)
+        (to exclude UNK, build them with build_sampler(..., log_probs=True, suppress_unk=True))
+    :param x: a [BATCHED?] sequence of word ids followed by 0 (0 = eos id)
+    :param trng: theano RandomStreams
+    :param k: beam width
+    :param maxlen: max length of a sentences
+    :param stochastic: bool, do stochastic sampling
+    :param argmax: bool, something to do with argmax of highest word prob...
+    :param return_alignment:
+    :param return_hyp_graph:
+    :param normalize: bool, scores will be normalized by length (only used by early_stop)
+    :param early_stop: bool, stop as soon as no live hypothesis can beat the best finished one
+    :param max_cands_per_hyp: keep at most this many continuations of each hypothesis per step
+    :param prune_abs: drop candidates whose cost exceeds the best candidate's by more than this
+    :param prune_rel: drop candidates whose probability is below prune_rel times the best candidate's
+    :param log_probs: bool, f_next returns log-probabilities (build_sampler(..., log_probs=True) or a fused
+        ensemble from build_ensemble_sampler); either way, the word probabilities returned for several models
+        are the mean of their probabilities
+    :param adaptive_beam: adaptive beam width: start with beam_min hypotheses, double the width (up to k) while
+        the two best candidates are less than adaptive_beam apart and halve it otherwise (see _adapt_beam_width)
+    :param beam_min: initial and minimum beam width with adaptive_beam
+    :param stats: dict; if given, 'steps' and 'hyps' (the number of live hypotheses summed over steps,
+        i.e. the effective beam width times the number of steps) are added to it
+    :return:
+    """
+
+    # k is the beam size we have
+    if k > 1:
+        assert not stochastic, \
+            'Beam search does not support stochastic sampling'
+
+    sample = []
+    sample_score = []
+    sample_word_probs = []
+    alignment = []
+    hyp_graph = None
+    if stochastic:
+        sample_score = 0
+    if return_hyp_graph:
+        from hypgraph import HypGraph
+        hyp_graph = HypGraph()
+        hyp_nodes = [0]  # graph node in which each live hypothesis ends
+
+    live_k = 1
+    dead_k = 0
+    beam_width = k if adaptive_beam is None else min(k, beam_min)
+
+    hyp_samples = [[]] * live_k
+    word_probs = [[]] * live_k
+    hyp_scores = numpy.zeros(live_k).astype('float32')
+    hyp_states = []
+    if return_alignment:
+        hyp_alignment = [[] for _ in xrange(live_k)]
+
+    # for ensemble decoding, we keep track of states and probability distribution
+    # for each model in the ensemble
+    num_models = len(f_init)
+    next_state = [None]*num_models
+    ctx0 = [None]*num_models
+    next_p = [None]*num_models
+    dec_alphas = [None]*num_models
+    # get initial state of decoder rnn and encoder context
+    for i in xrange(num_models):
+        ret = f_init[i](x)
+        next_state[i] = ret[0]
+        ctx0[i] = ret[1]
+    next_w = -1 * numpy.ones((1,)).astype('int64')  # bos indicator
+
+    # x is a sequence of word ids followed by 0, eos id
+    for ii in xrange(maxlen):
+        if stats is not None:
+            stats['steps'] = stats.get('steps', 0) + 1
+            stats['hyps'] = stats.get('hyps', 0) + live_k
+        for i in xrange(num_models):
+            ctx = numpy.tile(ctx0[i], [live_k, 1])
+            inps = [next_w, ctx, next_state[i]]
+            ret = f_next[i](*inps)
+            # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
+            next_p[i], next_w_tmp, next_state[i] = ret[0], ret[1], ret[2]
+            if return_alignment:
+                dec_alphas[i] = ret[3]
+        if stochastic:
+            if argmax:
+                nw = sum(next_p)[0].argmax()
+            else:
+                nw = next_w_tmp[0]
+            sample.append(nw)
+            if log_probs:
+                sample_score += next_p[0][0, nw]
+            else:
+                sample_score += numpy.log(next_p[0][0, nw])
+            if nw == 0:
+                break
+        else:
+            if log_probs:
+                cand_scores = hyp_scores[:, None] - sum(next_p)
+                # word probabilities are only needed for the selected candidates (see below)
+                probs_flat = None
+            else:
+                cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
+                probs = sum(next_p)/num_models
+                probs_flat = probs.flatten()
+            cand_flat = cand_scores.flatten()
+            if adaptive_beam is not None:
+                beam_width = _adapt_beam_width(beam_width, cand_scores, adaptive_beam, beam_min, k)
+            ranks_flat = _select_candidates(cand_scores, min(beam_width, k-dead_k),
+                                            max_cands_per_hyp=max_cands_per_hyp,
+                                            prune_abs=prune_abs, prune_rel=prune_rel)
+
+            # averaging the attention weights accross models
+            if return_alignment:
+                mean_alignment = sum(dec_alphas)/num_models
+
+            voc_size = next_p[0].shape[1]
+            # index of each k-best hypothesis
+            trans_indices = ranks_flat / voc_size
+            word_indices = ranks_flat % voc_size
+            costs = cand_flat[ranks_flat]
+
+            new_hyp_samples = []
+            new_hyp_scores = numpy.zeros(len(ranks_flat)).astype('float32')
+            new_word_probs = []
+            new_hyp_states = []
+            new_hyp_parents = []
+            if return_alignment:
+                # holds the history of attention weights for each time step for each of the surviving hypothesis
+                # dimensions (live_k * target_words * source_hidden_units]
+                # at each time step we append the attention weights corresponding to the current target word
+                new_hyp_alignment = [[] for _ in xrange(len(ranks_flat))]
+
+            # ti -> index of k-best hypothesis
+            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+                new_hyp_samples.append(hyp_samples[ti]+[wi])
+                if log_probs:
+                    word_prob = numpy.mean([numpy.exp(next_p[i][ti, wi]) for i in xrange(num_models)])
+                else:
+                    word_prob = probs_flat[ranks_flat[idx]]
+                new_word_probs.append(word_probs[ti] + [word_prob.tolist()])
+                new_hyp_scores[idx] = copy.copy(costs[idx])
+                new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
+                if return_hyp_graph:
+                    new_hyp_parents.append(hyp_nodes[ti])
+                if return_alignment:
+                    # get history of attention weights for the current hypothesis
+                    new_hyp_alignment[idx] = copy.copy(hyp_alignment[ti])
+                    # extend the history with current attention weights
+                    new_hyp_alignment[idx].append(mean_alignment[ti])
+
+
+            # check the finished samples
+            new_live_k = 0
+            hyp_samples = []
+            hyp_scores = []
+            hyp_states = []
+            word_probs = []
+            if return_alignment:
+                hyp_alignment = []
+            if return_hyp_graph:
+                hyp_nodes = []
+
+            # sample and sample_score hold the k-best translations and their scores
+            for idx in xrange(len(new_hyp_samples)):
+                if return_hyp_graph:
+                    node = hyp_graph.add_node(new_hyp_parents[idx], new_hyp_samples[idx][-1],
+                                              word_prob=new_word_probs[idx][-1], cost=new_hyp_scores[idx])
+                if new_hyp_samples[idx][-1] == 0:
+                    sample.append(new_hyp_samples[idx])
+                    sample_score.append(new_hyp_scores[idx])
+                    sample_word_probs.append(new_word_probs[idx])
+                    if return_alignment:
+                        alignment.append(new_hyp_alignment[idx])
+                    dead_k += 1
+                else:
+                    new_live_k += 1
+                    hyp_samples.append(new_hyp_samples[idx])
+                    hyp_scores.append(new_hyp_scores[idx])
+                    hyp_states.append(new_hyp_states[idx])
+                    word_probs.append(new_word_probs[idx])
+                    if return_alignment:
+                        hyp_alignment.append(new_hyp_alignment[idx])
+                    if return_hyp_graph:
+                        hyp_nodes.append(node)
+            hyp_scores = numpy.array(hyp_scores)
+
+            live_k = new_live_k
+
+            if new_live_k < 1:
+                break
+            if dead_k >= k:
+                break
+            if early_stop and not _live_can_improve(hyp_scores, sample, sample_score, maxlen, normalize):
+                break
+
+            next_w = numpy.array([w[-1] for w in hyp_samples])
+            next_state = [numpy.array(state) for state in zip(*hyp_states)]
+
+    if not stochastic:
+        # dump every remaining one
+        if live_k > 0:
+            for idx in xrange(live_k):
+                sample.append(hyp_samples[idx])
+                sample_score.append(hyp_scores[idx])
+                sample_word_probs.append(word_probs[idx])
+                if return_alignment:
+                    alignment.append(hyp_alignment[idx])
+
+    if not return_alignment:
+        alignment = [None for i in range(len(sample))]
+
+    return sample, sample_score, sample_word_probs, alignment, hyp_graph
+
+
+# generate sample, either with stochastic sampling or beam search. Note that,
+# this function iteratively calls f_init and f_next functions.
+def gen_par_sample(f_init, f_next, x, x_mask, k=1, maxlen=30,
+                   normalize=False, early_stop=False,
+                   max_cands_per_hyp=None, prune_abs=None, prune_rel=None, log_probs=False,
+                   adaptive_beam=None, beam_min=1):
+    """
+    :param f_init: *list* of f_init functions. Each: state0, ctx0 = f_init(x, X_MASK)
+    :param f_next: *list* of f_next functions. Each: next_prob, next_word, next_state = f_next(word, ctx, state)
+        (to exclude UNK, build them with build_sampler(..., log_probs=True, suppress_unk=True))
+    :param x: a BATCHED sequence of word ids, each terminated by 0 (0 = eos id)
+    :param k: beam width
+    :param maxlen: max length of a sentences
+    :param normalize: bool, scores will be normalized by length (only used by early_stop)
+    :param early_stop: bool, stop a sentence as soon as none of its live hypotheses can beat its best finished one
+    :param max_cands_per_hyp: keep at most this many continuations of each hypothesis per step
+    :param prune_abs: drop candidates whose cost exceeds the best candidate's (of the same sentence) by more than this
+    :param prune_rel: drop candidates whose probability is below prune_rel times the best candidate's
+    :param log_probs: bool, f_next returns log-probabilities
+    :param adaptive_beam: adaptive beam width per sentence (see gen_sample)
+    :param beam_min: initial and minimum beam width with adaptive_beam
+    :return:
+    """
+    # k is the beam size we have
+    batch_size = x.shape[2]
+    sample = [[] for i in range(batch_size)]
+    sample_score = [[] for i in range(batch_size)]
+    sample_word_probs = [[] for i in range(batch_size)]
+    live_k = [1] * batch_size
+    dead_k = [0] * batch_size # num completed sentences
+    beam_widths = [k if adaptive_beam is None else min(k, beam_min)] * batch_size
+
+    hyp_samples = [[]] * batch_size * 1 # wrote 1 explictly to denote 1 live_k per sent
+    word_probs = [[]] * batch_size * 1
+    hyp_scores = numpy.zeros(batch_size * 1).astype('float32')
+    # for ensemble decoding, we keep track of states and probability distribution
+    # for each model in the ensemble
+    num_models = len(f_init)
+    next_state = [None]*num_models
+    ctx0 = [None]*num_models # initial context
+    next_ps = [None]*num_models
+    # get initial state of decoder rnn and encoder context
+    for i in xrange(num_models):
+        ret = f_init[i](x, x_mask)
+        next_state[i] = ret[0]
+        ctx0[i] = ret[1]
+    next_w = -1 * numpy.ones((batch_size,)).astype('int64')  # bos (beginning of sent) indicator
+
+    # -- OK --
+    # x is a sequence of word ids followed by 0, eos id
+    for ii in xrange(maxlen):
+        for i in xrange(num_models):
+            # Encoder context does not change, just need to know how many are required
+            # numpy.tile(ctx0[i], [live_k, 1]) -- prev: simply repeat context live_k times (and propagate up a dimension)
+            # New: tile each context per sent, then concat them together.
+            ctx = numpy.concatenate([numpy.tile(ctx0[i][:,sent_idx:sent_idx+1], [live_k_per_sent, 1]) for sent_idx, live_k_per_sent in enumerate(live_k)], axis = 1)
+            mask = numpy.concatenate([numpy.tile(x_mask[:,sent_idx:sent_idx+1], [1, live_k_per_sent]) for sent_idx, live_k_per_sent in enumerate(live_k)], axis = 1)
+            
+            inps = [next_w, ctx, next_state[i], mask] # prepare parameters for f_next
+            ret = f_next[i](*inps)  
+            # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
+            next_ps[i], next_ws_tmp, next_state[i] = ret[0], ret[1], ret[2]
+        # We do the same thing with the same flat structures. just our interpretations now differ!
+        voc_size = next_ps[0].shape[1] # should be constant
+        if log_probs:
+            cand_scores = hyp_scores[:, None] - sum(next_ps)
+            # word probabilities are only needed for the selected candidates (see below)
+            probs_flat = None
+        else:
+            cand_scores = hyp_scores[:, None] - sum(numpy.log(next_ps))
+            probs = sum(next_ps)/num_models
+            probs_flat = probs.flatten()
+        cand_flat = cand_scores.flatten()
+        # OK argpartition in pieces.
+        # Wait if we are argpartitioning across sent boundaries, two words can come out of a single hyp! wait that's ok though! great.
+        #ranks_flat = cand_flat.argpartition(k-dead_k-1)[:(k-dead_k)] # Basically, top k-dead_k (INDICES OF)
+        sent_boundaries = numpy.cumsum([0] + live_k) # rows of cand_scores belonging to each sentence
+        # start, end = start index and end index for a sentence (not inclusive on end)
+        # select from each piece. add 'start' (times vocab size, because the softmaxes are flattened) to it
+        # because np thinks its a new small array, so remember the start idx
+        ranks_per_sent = []
+        for sent_idx, (start, end) in enumerate(zip(sent_boundaries[:-1], sent_boundaries[1:])):
+            if adaptive_beam is not None:
+                beam_widths[sent_idx] = _adapt_beam_width(beam_widths[sent_idx], cand_scores[start:end],
+                                                          adaptive_beam, beam_min, k)
+            ranks_per_sent.append(start * voc_size +
+                                  _select_candidates(cand_scores[start:end],
+                                                     min(beam_widths[sent_idx], k - dead_k[sent_idx]),
+                                                     max_cands_per_hyp=max_cands_per_hyp,
+                                                     prune_abs=prune_abs, prune_rel=prune_rel))
+        ranks_flat = numpy.concatenate(ranks_per_sent, axis = 0)
+        
+        # averaging the attention weights across models
+        # index of each k-best hypothesis
+        trans_indices = ranks_flat / voc_size # Hmm. Which element of beam did it come from
+        word_indices = ranks_flat % voc_size # and what word was it. That implies the cand scores are the entire softmax...
+        costs = cand_flat[ranks_flat] # Get the probs
+        new_hyp_samples = [] 
+        new_hyp_scores = numpy.zeros(len(ranks_flat)).astype('float32')
+        new_word_probs = []
+        new_hyp_states = []
+        # ti -> index of k-best hypothesis
+        for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+            # hyps/etc will proceed in order, since ranks flat goes in order of sentences.
+            new_hyp_samples.append(hyp_samples[ti]+[wi]) # looks like appending the next word to the existing hypothesis, and adding that to a list of new hypotheses
+            if log_probs:
+                word_prob = numpy.mean([numpy.exp(next_ps[i][ti, wi]) for i in xrange(num_models)])
+            else:
+                word_prob = probs_flat[ranks_flat[idx]]
+            new_word_probs.append(word_probs[ti] + [word_prob.tolist()]) # Not sure, I think same thing but for probabilities. the '+' -- the second element is a list so probably still a list of word probs over the hyp
+            new_hyp_scores[idx] = copy.copy(costs[idx]) # the total cost with the new prob added
+            new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)]) # copy the state over too
+        # check the finished samples
+        new_live_k = [0] * batch_size
+        hyp_samples = []
+        hyp_scores = []
+        hyp_states = []
+        word_probs = []
+        # sample and sample_score hold the k-best translations and their scores
+        # In the flattened 'sample' array, markers between sentences will be based on the cumulative sum of live_ks
+        #ipdb.set_trace()
+
+        # number of candidates selected for each sentence (k-dead_k, unless pruned)
+        live_k_tmp = [len(ranks) for ranks in ranks_per_sent]
+        sample_sent_boundaries = numpy.cumsum(live_k_tmp)
+        sent_idx = 0
+        for idx in xrange(len(new_hyp_samples)):
+            # Need to know which sent it came from
+            while idx >= sample_sent_boundaries[sent_idx]:
+                sent_idx += 1
+            if new_hyp_samples[idx][-1] == 0: # If eos (End of sent)
+                #ipdb.set_trace()
+
+                sample[sent_idx].append(new_hyp_samples[idx]) # I think 'sample' are only for finished samples
+                sample_score[sent_idx].append(new_hyp_scores[idx])
+                sample_word_probs[sent_idx].append(new_word_probs[idx])
+                dead_k[sent_idx] += 1 # finished the sent.
+            else:
+                new_live_k[sent_idx] += 1 # count live k's
+                # Live ones are flat.
+                hyp_samples.append(new_hyp_samples[idx])
+                hyp_scores.append(new_hyp_scores[idx])
+                hyp_states.append(new_hyp_states[idx])
+                word_probs.append(new_word_probs[idx])
+        hyp_scores = numpy.array(hyp_scores)
+        if early_stop:
+            # retire sentences whose live hypotheses cannot beat their best finished one
+            hyp_boundaries = numpy.cumsum([0] + new_live_k)
+            keep = []
+            for sent_idx, (start, end) in enumerate(zip(hyp_boundaries[:-1], hyp_boundaries[1:])):
+                if start < end and not _live_can_improve(hyp_scores[start:end], sample[sent_idx],
+                                                         sample_score[sent_idx], maxlen, normalize):
+                    for idx in xrange(start, end):
+                        sample[sent_idx].append(hyp_samples[idx])
+                        sample_score[sent_idx].append(hyp_scores[idx])
+                        sample_word_probs[sent_idx].append(word_probs[idx])
+                    dead_k[sent_idx] = k
+                    new_live_k[sent_idx] = 0
+                else:
+                    keep.extend(xrange(start, end))
+            hyp_samples = [hyp_samples[idx] for idx in keep]
+            hyp_states = [hyp_states[idx] for idx in keep]
+            word_probs = [word_probs[idx] for idx in keep]
+            hyp_scores = hyp_scores[keep]
+        live_k = new_live_k
+        # Conservative break conditions...
+        if sum(new_live_k) < 1:
+            break
+        if min(dead_k) >= k:
+            break
+        next_w = numpy.array([w[-1] for w in hyp_samples])
+        next_state = [numpy.array(state) for state in zip(*hyp_states)]
+    # dump every remaining one
+    sample_sent_boundaries = numpy.cumsum(live_k)
+    sent_idx = 0
+    for idx in xrange(len(hyp_samples)):
+        while idx >= sample_sent_boundaries[sent_idx]:
+            sent_idx += 1
+        #if live_k > 0: 
+        sample[sent_idx].append(hyp_samples[idx])
+        sample_score[sent_idx].append(hyp_scores[idx])
+        sample_word_probs[sent_idx].append(word_probs[idx])
+    return sample, sample_score, sample_word_probs
+
+# My notes: doing it in par:
+# All of this stuff, topk etc, is done in numpy. Only f_next() etc are done in theano/GPU.
+# So just need some extra handling steps after-the-fact.
+# It doesn't look like there is any conflict with sending different sentences in, for f_next()
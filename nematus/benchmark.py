@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+Throughput and latency benchmarks for decoding and training.
+
+Builds small random models with init_params (no trained systems needed) and
+writes the measurements as JSON, so regressions show up when comparing
+results across commits on the same machine.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+import numpy
+
+
+def random_model_options(dim_word=128, dim=256, n_words_src=2000, n_words=2000):
+    from nmt_client import default_model_options
+    model_options = deepcopy(default_model_options)
+    model_options.update(dim_word=dim_word,
+                         dim=dim,
+                         dim_per_factor=[dim_word],
+                         n_words_src=n_words_src,
+                         n_words=n_words,
+                         optimizer='adam',
+                         clip_c=1.)
+    return model_options
+
+
+def random_sentences(n, vocab_size, min_len, max_len, rng):
+    # word ids 0 (eos) and 1 (UNK) are reserved
+    lengths = rng.randint(min_len, max_len + 1, size=n)
+    return [list(rng.randint(2, vocab_size, size=l)) for l in lengths]
+
+
+def _source(sent):
+    # source sentence in the format of translate.py: one list of factors per word, followed by eos
+    return [[w] for w in sent] + [[0]]
+
+
+def _seconds(f, repeat):
+    times = []
+    for _ in xrange(repeat):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+    return times
+
+
+def _summary(times):
+    times = numpy.array(times)
+    return dict(mean=float(times.mean()), median=float(numpy.median(times)),
+                min=float(times.min()), max=float(times.max()), n=len(times))
+
+
+def bench_sampler(f_init, f_next, sentences, live_ks, repeat):
+    """latency of single f_init and f_next calls (f_next with live_k hypotheses)"""
+    results = dict(f_init=[], f_next=[])
+    for sent in sentences[:repeat]:
+        x = numpy.array(_source(sent)).T.reshape([1, len(sent) + 1, 1])
+        results['f_init'] += _seconds(lambda: f_init(x), 1)
+    results['f_init'] = _summary(results['f_init'])
+
+    x = numpy.array(_source(sentences[0])).T.reshape([1, len(sentences[0]) + 1, 1])
+    state0, ctx0 = f_init(x)[:2]
+    for live_k in live_ks:
+        next_w = numpy.random.randint(2, 10, size=live_k).astype('int64')
+        ctx = numpy.tile(ctx0, [live_k, 1])
+        state = numpy.tile(state0, [live_k, 1])
+        times = _seconds(lambda: f_next(next_w, ctx, state), repeat)
+        results['f_next'].append(dict(live_k=live_k, **_summary(times)))
+    return results
+
+
+def _bench_gen_sample(f_init, f_next, sentences, k, maxlen, adaptive_beam=None):
+    from beam_search import gen_sample
+
+    stats = dict()
+    costs = []
+    t0 = time.time()
+    for sent in sentences:
+        seq = _source(sent)
+        sample, score, _, _, _ = gen_sample([f_init], [f_next],
+                                            numpy.array(seq).T.reshape([1, len(seq), 1]),
+                                            k=k, maxlen=maxlen, stochastic=False, argmax=False,
+                                            log_probs=True, adaptive_beam=adaptive_beam, stats=stats)
+        costs.append(float(numpy.min(score)))
+    elapsed = time.time() - t0
+    # effective beam: live hypotheses per decoder step; cost of the best translation as a quality proxy
+    return dict(function='gen_sample', k=k, batch_size=1, adaptive_beam=adaptive_beam, seconds=elapsed,
+                sentences_per_second=len(sentences) / elapsed,
+                effective_beam=float(stats['hyps']) / stats['steps'], mean_cost=float(numpy.mean(costs)))
+
+
+def bench_decoding(f_init, f_next, sentences, beam_sizes, batch_sizes, maxlen, adaptive_beams=()):
+    """sentences/s of gen_sample (one sentence at a time, with a fixed and an adaptive beam) and
+    gen_par_sample (batched)"""
+    from beam_search import gen_par_sample
+    from nmt_utils import prepare_data
+
+    results = []
+    for k in beam_sizes:
+        for adaptive_beam in [None] + list(adaptive_beams):
+            result = _bench_gen_sample(f_init, f_next, sentences, k, maxlen, adaptive_beam)
+            results.append(result)
+            sys.stderr.write('gen_sample k={0} adaptive_beam={1}: {2:.2f} sentences/s, effective beam {3:.2f}, '
+                             'mean cost {4:.4f}\n'.format(k, adaptive_beam, result['sentences_per_second'],
+                                                          result['effective_beam'], result['mean_cost']))
+
+        for batch_size in batch_sizes:
+            t0 = time.time()
+            for start in xrange(0, len(sentences), batch_size):
+                # prepare_data appends the eos that _source adds for gen_sample
+                sents = sentences[start:start + batch_size]
+                x, x_mask, _, _ = prepare_data([[[w] for w in sent] for sent in sents], sents)
+                gen_par_sample([f_init], [f_next], x, x_mask, k=k, maxlen=maxlen, log_probs=True)
+            elapsed = time.time() - t0
+            results.append(dict(function='gen_par_sample', k=k, batch_size=batch_size, seconds=elapsed,
+                                sentences_per_second=len(sentences) / elapsed))
+            sys.stderr.write('gen_par_sample k={0} batch_size={1}: {2:.2f} sentences/s\n'.format(
+                k, batch_size, len(sentences) / elapsed))
+    return results
+
+
+def bench_data(source_sentences, target_sentences, n_words_src, n_words, batch_size, maxibatch_size):
+    """tokens/s of prepare_data and TextIterator (reading, dictionary lookup and sorting)"""
+    from data_iterator import TextIterator
+    from nmt_utils import prepare_data
+
+    results = dict()
+    n_tokens = sum(len(s) + len(t) for s, t in zip(source_sentences, target_sentences))
+
+    seqs_x = [[[w] for w in s] for s in source_sentences]
+    t0 = time.time()
+    for start in xrange(0, len(seqs_x), batch_size):
+        prepare_data(seqs_x[start:start + batch_size], target_sentences[start:start + batch_size])
+    elapsed = time.time() - t0
+    results['prepare_data'] = dict(seconds=elapsed, tokens_per_second=n_tokens / elapsed)
+
+    tmpdir = tempfile.mkdtemp(prefix='nematus-benchmark')
+    try:
+        for name, sents, vocab_size in [('source', source_sentences, n_words_src),
+                                        ('target', target_sentences, n_words)]:
+            with open(os.path.join(tmpdir, name), 'w') as f:
+                for sent in sents:
+                    f.write(' '.join('w%d' % w for w in sent) + '\n')
+            vocab = dict(('w%d' % i, i) for i in xrange(2, vocab_size))
+            vocab['eos'] = 0
+            vocab['UNK'] = 1
+            with open(os.path.join(tmpdir, name + '.json'), 'w') as f:
+                json.dump(vocab, f)
+
+        iterator = TextIterator(os.path.join(tmpdir, 'source'), os.path.join(tmpdir, 'target'),
+                                [os.path.join(tmpdir, 'source.json')], os.path.join(tmpdir, 'target.json'),
+                                n_words_source=n_words_src, n_words_target=n_words,
+                                batch_size=batch_size, maxlen=float('inf'),
+                                maxibatch_size=maxibatch_size)
+        t0 = time.time()
+        n_iter_tokens = 0
+        for x, y in iterator:
+            n_iter_tokens += sum(len(s) for s in x) + sum(len(t) for t in y)
+        elapsed = time.time() - t0
+        results['TextIterator'] = dict(seconds=elapsed, tokens_per_second=n_iter_tokens / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def bench_training(model_options, source_sentences, target_sentences, batch_size, steps, lrate=0.0001):
+    """time per update of x_f_grad_shared + x_f_update, or of x_train_step with model_options['fused_step']"""
+    from nmt_remote import RemoteMT
+    from nmt_utils import prepare_data
+
+    remote = RemoteMT()
+    t0 = time.time()
+    remote.init(model_options)
+    compile_time = time.time() - t0
+    remote.set_noise_val(1.)
+
+    seqs_x = [[[w] for w in s] for s in source_sentences]
+    batches = []
+    for start in xrange(0, len(seqs_x), batch_size):
+        batches.append(prepare_data(seqs_x[start:start + batch_size], target_sentences[start:start + batch_size]))
+
+    fused = model_options.get('fused_step', False)
+    grad_times = []
+    update_times = []
+    n_tokens = 0
+    for step in xrange(steps):
+        x, x_mask, y, y_mask = batches[step % len(batches)]
+        n_tokens += x_mask.sum() + y_mask.sum()
+        t0 = time.time()
+        if fused:
+            remote.x_train_step(x, x_mask, y, y_mask, lrate)
+        else:
+            remote.x_f_grad_shared(x, x_mask, y, y_mask)
+        t1 = time.time()
+        if not fused:
+            remote.x_f_update(lrate)
+        t2 = time.time()
+        grad_times.append(t1 - t0)
+        update_times.append(t2 - t1)
+
+    step_times = numpy.array(grad_times) + numpy.array(update_times)
+    results = dict(compile_seconds=compile_time,
+                   optimizer=model_options['optimizer'],
+                   fused_step=fused,
+                   sparse_update=list(model_options.get('sparse_update') or []),
+                   sampled_softmax=model_options.get('sampled_softmax', 0),
+                   batch_size=batch_size,
+                   step=_summary(step_times),
+                   tokens_per_second=float(n_tokens / step_times.sum()))
+    if not fused:
+        results.update(f_grad_shared=_summary(grad_times), f_update=_summary(update_times))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(saveto, dim_word=128, dim=256, n_words_src=2000, n_words=2000,
+         n_sentences=50, min_len=5, max_len=30, beam_sizes=(1, 5, 12), batch_sizes=(10, 50),
+         maxlen=50, repeat=20, train_batch_size=40, train_steps=20, optimizer='adam',
+         maxibatch_size=20, seed=1234, skip=(), adaptive_beams=(), fused_step=False,
+         sparse_update=(), sampled_softmax=0, backend='theano', quantize=False, quantized_product='float32'):
+
+    import theano
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    from beam_search import unmasked_sampler
+    from nmt_utils import init_params, build_sampler
+    from theano_util import init_theano_params
+
+    rng = numpy.random.RandomState(seed)
+    numpy.random.seed(seed)
+
+    model_options = random_model_options(dim_word=dim_word, dim=dim, n_words_src=n_words_src, n_words=n_words)
+    model_options['optimizer'] = optimizer
+    model_options['fused_step'] = fused_step
+    model_options['sparse_update'] = list(sparse_update)
+    model_options['sampled_softmax'] = sampled_softmax
+
+    source_sentences = random_sentences(n_sentences, n_words_src, min_len, max_len, rng)
+    target_sentences = random_sentences(n_sentences, n_words, min_len, max_len, rng)
+
+    results = dict(meta=dict(commit=_git_commit(),
+                             time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             host=platform.node(),
+                             python=platform.python_version(),
+                             theano=theano.__version__,
+                             theano_device=theano.config.device,
+                             theano_floatX=theano.config.floatX,
+                             model=dict(dim_word=dim_word, dim=dim, n_words_src=n_words_src, n_words=n_words),
+                             n_sentences=n_sentences, min_len=min_len, max_len=max_len, seed=seed))
+
+    if 'sampler' not in skip or 'decoding' not in skip:
+        params = init_params(model_options)
+        if quantize:
+            from quantize import quantize_params, dequantize_params
+            params = quantize_params(params)
+            if backend != 'numpy':
+                params = dequantize_params(params)
+        t0 = time.time()
+        if backend == 'numpy':
+            from numpy_backend import build_numpy_sampler
+            f_init, f_next = build_numpy_sampler(params, model_options, log_probs=True, seed=seed,
+                                                 quantized_product=quantized_product)
+        else:
+            tparams = init_theano_params(params)
+            trng = RandomStreams(seed)
+            use_noise = theano.shared(numpy.float32(0.))
+            f_init, f_next = build_sampler(tparams, model_options, use_noise, trng, log_probs=True)
+        results['meta']['sampler_compile_seconds'] = time.time() - t0
+        results['meta']['backend'] = backend
+        results['meta']['quantize'] = quantize
+        if quantize and backend == 'numpy':
+            results['meta']['quantized_product'] = quantized_product
+        f_init, f_next = unmasked_sampler(f_init, f_next)
+
+        if 'sampler' not in skip:
+            sys.stderr.write('Benchmarking f_init/f_next...\n')
+            results['sampler'] = bench_sampler(f_init, f_next, source_sentences, sorted(set(beam_sizes)), repeat)
+        if 'decoding' not in skip:
+            sys.stderr.write('Benchmarking decoding...\n')
+            results['decoding'] = bench_decoding(f_init, f_next, source_sentences, beam_sizes, batch_sizes, maxlen,
+                                                 adaptive_beams)
+
+    if 'data' not in skip:
+        sys.stderr.write('Benchmarking data preparation...\n')
+        results['data'] = bench_data(source_sentences, target_sentences, n_words_src, n_words,
+                                     train_batch_size, maxibatch_size)
+
+    if 'training' not in skip:
+        sys.stderr.write('Benchmarking training steps...\n')
+        results['training'] = bench_training(model_options, source_sentences, target_sentences,
+                                             train_batch_size, train_steps)
+
+    json.dump(results, saveto, indent=2, sort_keys=True)
+    saveto.write('\n')
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', '-o', type=argparse.FileType('w'),
+                        default=sys.stdout, metavar='PATH',
+                        help="Output file for JSON results (default: standard output)")
+    parser.add_argument('--dim_word', type=int, default=128, metavar='INT',
+                        help="embedding layer size (default: %(default)s)")
+    parser.add_argument('--dim', type=int, default=256, metavar='INT',
+                        help="hidden layer size (default: %(default)s)")
+    parser.add_argument('--n_words_src', type=int, default=2000, metavar='INT',
+                        help="source vocabulary size (default: %(default)s)")
+    parser.add_argument('--n_words', type=int, default=2000, metavar='INT',
+                        help="target vocabulary size (default: %(default)s)")
+    parser.add_argument('--n_sentences', type=int, default=50, metavar='INT',
+                        help="number of random sentences (default: %(default)s)")
+    parser.add_argument('--min_len', type=int, default=5, metavar='INT',
+                        help="minimum sentence length (default: %(default)s)")
+    parser.add_argument('--max_len', type=int, default=30, metavar='INT',
+                        help="maximum sentence length (default: %(default)s)")
+    parser.add_argument('--beam_sizes', type=int, nargs='+', default=[1, 5, 12], metavar='INT',
+                        help="beam sizes for decoding (default: %(default)s)")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[10, 50], metavar='INT',
+                        help="batch sizes for gen_par_sample (default: %(default)s)")
+    parser.add_argument('--adaptive_beams', type=float, nargs='+', default=[], metavar='FLOAT',
+                        help="also decode with these adaptive beam gaps (see translate.py --adaptive-beam)")
+    parser.add_argument('--maxlen', type=int, default=50, metavar='INT',
+                        help="maximum translation length (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=20, metavar='INT',
+                        help="number of f_init/f_next calls to time (default: %(default)s)")
+    parser.add_argument('--train_batch_size', type=int, default=40, metavar='INT',
+                        help="minibatch size for data and training benchmarks (default: %(default)s)")
+    parser.add_argument('--train_steps', type=int, default=20, metavar='INT',
+                        help="number of timed updates (default: %(default)s)")
+    parser.add_argument('--optimizer', type=str, default='adam',
+                        choices=['adam', 'adadelta', 'rmsprop', 'sgd'],
+                        help="optimizer (default: %(default)s)")
+    parser.add_argument('--fused_step', action="store_true",
+                        help="benchmark training with the fused step (gradients and update in one call)")
+    parser.add_argument('--sparse_update', type=str, nargs='+', default=[], metavar='GROUP',
+                        choices=['source_embeddings', 'target_embeddings', 'output'],
+                        help="benchmark training with sparse updates of these parameter groups")
+    parser.add_argument('--sampled_softmax', type=int, default=0, metavar='INT',
+                        help="benchmark training with a sampled softmax over INT candidates (default: full softmax)")
+    parser.add_argument('--backend', type=str, default='theano', choices=['theano', 'numpy'],
+                        help="backend of the sampler and decoding benchmarks (default: %(default)s)")
+    parser.add_argument('--quantize', action="store_true",
+                        help="decode with int8 weights (see quantize.py; only kept in int8 by the numpy backend)")
+    parser.add_argument('--quantized_product', type=str, default='float32', choices=['float32', 'blocks', 'int8'],
+                        help="with --quantize and the numpy backend, how to multiply with the int8 matrices "
+                             "(see quantize.py) (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1234, metavar='INT',
+                        help="random seed (default: %(default)s)")
+    parser.add_argument('--skip', type=str, nargs='+', default=[],
+                        choices=['sampler', 'decoding', 'data', 'training'],
+                        help="benchmarks to skip")
+
+    args = parser.parse_args()
+
+    main(args.output, dim_word=args.dim_word, dim=args.dim, n_words_src=args.n_words_src, n_words=args.n_words,
+         n_sentences=args.n_sentences, min_len=args.min_len, max_len=args.max_len,
+         beam_sizes=args.beam_sizes, batch_sizes=args.batch_sizes, maxlen=args.maxlen, repeat=args.repeat,
+         train_batch_size=args.train_batch_size, train_steps=args.train_steps, optimizer=args.optimizer,
+         seed=args.seed, skip=args.skip, adaptive_beams=args.adaptive_beams, fused_step=args.fused_step,
+         sparse_update=args.sparse_update, sampled_softmax=args.sampled_softmax, backend=args.backend,
+         quantize=args.quantize, quantized_product=args.quantized_product)
@@ -1,46 +1,96 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
-
 class HypGraph(object):
-        
+        """
+        Search graph of a beam search. Nodes are integers: node 0 is the start
+        of the sentence, and every other node is a word that extends the
+        hypothesis ending in its parent node. Labels (word ids), parents, costs
+        and word probabilities are kept in lists indexed by node.
+        """
+
         def __init__(self):
-                self.nodes = defaultdict(str) # {id = label}
-                self.edges = [] # (parent_node_id, child_node_id)
-                self.costs = defaultdict(float) # {node_id = cost}
-                self.word_probs = defaultdict(float) # {node_id = word_prob}
-                                
-        def get_id(self, word, history):        
-                if history == []:
-                        return str(word)
-                history = '-'.join([str(h) for h in reversed(history)])
-                return '%s-%s' % (word, history)
-        
-        def get_ids(self, words):        
-                ids = []
-                for i, w in enumerate(words):
-                        history = words[:i]
-                        ids.append(self.get_id(w, history))
-                return ids
+                self.labels = [0] # word id of each node
+                self.parents = [-1] # parent of each node (-1 for the root)
+                self.costs = [0.] # cost of the hypothesis ending in each node
+                self.word_probs = [0.] # probability of the last word
+                self._children = {} # (parent, word) -> node
 
-        def add(self, word, history, word_prob=None, cost=None):
-                history_labels = [0] + history
-                history_ids = self.get_ids(history_labels)        
-                word_label = word
-                word_id = self.get_id(word_label, history_labels)        
-                # store
-                self.nodes[word_id] = word_label
-                self.edges.append((history_ids[-1], word_id))
+        def __len__(self):
+                return len(self.labels)
+
+        @property
+        def edges(self):
+                return [(parent, node) for node, parent in enumerate(self.parents) if node > 0]
+
+        def add_node(self, parent, word, word_prob=None, cost=None):
+                """
+                Add word after node parent (or update it if it is there
+                already) and return its node.
+                """
+                node = self._children.get((parent, word))
+                if node is None:
+                        node = len(self.labels)
+                        self._children[(parent, word)] = node
+                        self.labels.append(word)
+                        self.parents.append(parent)
+                        self.costs.append(0.)
+                        self.word_probs.append(0.)
                 if word_prob != None:
-                        self.word_probs[word_id] = word_prob
+                        self.word_probs[node] = float(word_prob)
                 if cost != None:
-                        self.costs[word_id] = cost
+                        self.costs[node] = float(cost)
+                return node
+
+        def find(self, history):
+                """
+                Return the node in which the hypothesis history (a list of
+                word ids) ends, adding missing nodes.
+                """
+                node = 0
+                for word in history:
+                        node = self.add_node(node, word)
+                return node
+
+        def add(self, word, history, word_prob=None, cost=None):
+                """
+                Add word after the hypothesis history. Takes time linear in the
+                length of the history; use add_node where the parent is known.
+                """
+                return self.add_node(self.find(history), word, word_prob=word_prob, cost=cost)
+
+        def export(self):
+                """
+                Return the graph as a dictionary of lists (e.g. to store it as
+                JSON); from_export restores it.
+                """
+                return {'labels': [int(label) for label in self.labels],
+                        'parents': list(self.parents),
+                        'costs': list(self.costs),
+                        'word_probs': list(self.word_probs)}
+
+        @classmethod
+        def from_export(cls, data):
+                graph = cls()
+                graph.labels = list(data['labels'])
+                graph.parents = list(data['parents'])
+                graph.costs = list(data['costs'])
+                graph.word_probs = list(data['word_probs'])
+                graph._children = dict(((parent, label), node) for node, (parent, label)
+                                       in enumerate(zip(graph.parents, graph.labels)) if node > 0)
+                return graph
+
+        def __getstate__(self):
+                # the index of children can be rebuilt; leave it out of pickles
+                return self.export()
+
+        def __setstate__(self, state):
+                self.__dict__.update(HypGraph.from_export(state).__dict__)
 
 class HypGraphRenderer(object):
 
         def __init__(self, hyp_graph):
-                self.nodes = hyp_graph.nodes
+                self.nodes = dict(enumerate(hyp_graph.labels)) # {node = label}
                 self.edges = hyp_graph.edges
                 self.costs = hyp_graph.costs
                 self.word_probs = hyp_graph.word_probs
@@ -62,9 +112,9 @@ class HypGraphRenderer(object):
                 graph = AGraph(directed=True)
                 for node_id, node_label in self.nodes.iteritems():
                         attributes = self._node_attr(node_id, costs=costs, word_probs=word_probs)
-                        graph.add_node(node_id, **attributes)
+                        graph.add_node(str(node_id), **attributes)
                 for (parent_node_id, child_node_id) in self.edges:
-                        graph.add_edge(parent_node_id, child_node_id)
+                        graph.add_edge(str(parent_node_id), str(child_node_id))
                 self.graph = graph
                 if highlight_best:
                         self._highlight_best()
@@ -93,12 +143,12 @@ class HypGraphRenderer(object):
                 best_hyp_cost = None
                 best_hyp_leaf_node_id = None
                 for node_id, label in self.nodes.iteritems():        
-                        if label in self.EOS_SYMBOLS:
+                        if label in self.EOS_SYMBOLS and node_id != 0: # the root has label 0, too
                                 if best_hyp_cost == None or self.costs[node_id] < best_hyp_cost:
                                         best_hyp_leaf_node_id = node_id
                                         best_hyp_cost = self.costs[node_id]
                 if best_hyp_leaf_node_id:
-                        best_hyp_leaf_node = self.graph.get_node(best_hyp_leaf_node_id)                
+                        best_hyp_leaf_node = self.graph.get_node(str(best_hyp_leaf_node_id))                
                         current_node = best_hyp_leaf_node
                         while current_node != []:        
                                 current_node.attr['style'] = 'filled'
@@ -20,7 +20,9 @@ import theano.tensor as tensor
 
 from data_iterator import TextIterator
 from domain_interpolation_data_iterator import DomainInterpolatorTextIterator
-from nmt_utils import init_params, build_model, build_sampler, prepare_data, gen_sample, pred_probs
+from nmt_utils import init_params, build_model, build_sampler, prepare_data, gen_sample, pred_probs, \
+    sparse_update_params, SPARSE_UPDATE_GROUPS
+from optimizers import gradients, adam, adadelta, rmsprop, sgd
 from theano_util import load_params, init_theano_params, itemlist, unzip_from_theano, zip_to_theano
 from util import load_dict
 
@@ -65,6 +67,7 @@ def train(dim_word=100,  # word vector dimensionality
           dropout_target=0, # dropout target words (0: no dropout)
           reload_=False,
           overwrite=False,
+          save_float16=False, # store saved models and the best parameters kept in memory in float16
           external_validation_script=None,
           shuffle_each_epoch=True,
           finetune=False,
@@ -75,6 +78,12 @@ def train(dim_word=100,  # word vector dimensionality
           domain_interpolation_inc=0.1,
           domain_interpolation_indomain_datasets=('indomain.en', 'indomain.fr'),
           maxibatch_size=20, #How many minibatches to load at one time
+          fused_step=False, # compute gradients and update in one call (see optimizers.py)
+          accum_steps=1, # accumulate the gradients of this many minibatches per update
+          accum_weighting='sentences', # weight accumulated gradients by the number of 'sentences' or target 'tokens'
+          sparse_update=None, # parameter groups that only update the rows of the words in the batch (see nmt_utils)
+          sampled_softmax=0, # train on a softmax over this many sampled words instead of the full vocabulary (0: full)
+          output_chunk_steps=0, # compute the output layer in chunks of this many target positions (0: all at once)
           model_version=0.1, #store version used for training for compatibility
     ):
 
@@ -172,6 +181,10 @@ def train(dim_word=100,  # word vector dimensionality
     f_log_probs = theano.function(inps, cost, profile=profile)
     print('Done')
 
+    # f_log_probs (validation, scoring) keeps the full softmax
+    if sampled_softmax:
+        cost = opt_ret['sampled_cost']
+
     cost = cost.mean()
 
     # apply L2 regularization on weights
@@ -213,8 +226,14 @@ def train(dim_word=100,  # word vector dimensionality
     else:
         updated_params = tparams
 
+    # the gradients of sparsely updated parameters only cover the rows of the words in the batch
+    sparse = sparse_update_params(model_options)
+    if sparse and (model_options['decay_c'] > 0. or model_options['map_decay_c'] > 0.):
+        sys.exit('Error: weight decay (--decay_c, --map_decay_c) changes every row, it cannot be used with '
+                 '--sparse_update')
+
     print('Computing gradient...',)
-    grads = tensor.grad(cost, wrt=itemlist(updated_params))
+    grads, sparse = gradients(cost, updated_params, sparse)
     print('Done')
 
     # apply gradient clipping here
@@ -233,13 +252,24 @@ def train(dim_word=100,  # word vector dimensionality
     lr = tensor.scalar(name='lr')
 
     print('Building optimizers...',)
-    f_grad_shared, f_update = eval(optimizer)(lr, updated_params, grads, inps, cost, profile=profile)
+    if fused_step and accum_steps > 1:
+        print('Gradient accumulation needs separate gradient and update steps, not using fused_step')
+        fused_step = False
+    if fused_step:
+        f_train_step = eval(optimizer)(lr, updated_params, grads, inps, cost, profile=profile, fused=True,
+                                       sparse=sparse)
+    else:
+        f_grad_shared, f_update = eval(optimizer)(lr, updated_params, grads, inps, cost, profile=profile,
+                                                  accumulate=accum_steps > 1, sparse=sparse)
     print('Done')
 
     print('Total compilation time: {0:.1f}s'.format(time.time() - comp_start))
 
     print('Optimization')
 
+    # parameters are computed in floatX, but (optionally) stored in float16
+    save_dtype = 'float16' if save_float16 else None
+
     best_p = None
     bad_counter = 0
     uidx = 0
@@ -264,6 +294,11 @@ def train(dim_word=100,  # word vector dimensionality
 
     valid_err = None
 
+    # with accum_steps > 1, every update uses the gradients of accum_steps consecutive
+    # minibatches (of similar length, as they come from the same sorted maxibatch)
+    accum_cost = 0.
+    n_accum = 0
+
     last_disp_samples = 0
     ud_start = time.time()
     p_validation = None
@@ -288,11 +323,26 @@ def train(dim_word=100,  # word vector dimensionality
                 uidx -= 1
                 continue
 
-            # compute cost, grads and copy grads to shared variables
-            cost = f_grad_shared(x, x_mask, y, y_mask)
-
-            # do the update on parameters
-            f_update(lrate)
+            if accum_steps > 1:
+                # add the gradients of this minibatch to those collected since the last update
+                weight = y_mask.sum() if accum_weighting == 'tokens' else x_mask.shape[1]
+                accum_cost += f_grad_shared(x, x_mask, y, y_mask, numpy.float32(weight))
+                n_accum += 1
+                if n_accum < accum_steps:
+                    uidx -= 1
+                    continue
+
+                f_update(lrate)
+                cost, accum_cost, n_accum = accum_cost / accum_steps, 0., 0
+            elif fused_step:
+                # compute cost and grads and update the parameters
+                cost = f_train_step(x, x_mask, y, y_mask, lrate)
+            else:
+                # compute cost, grads and copy grads to shared variables
+                cost = f_grad_shared(x, x_mask, y, y_mask)
+
+                # do the update on parameters
+                f_update(lrate)
 
             # check for bad numbers, usually we remove non-finite elements
             # and continue training - but not done here
@@ -315,7 +365,7 @@ def train(dim_word=100,  # word vector dimensionality
                 if best_p is not None:
                     params = best_p
                 else:
-                    params = unzip_from_theano(tparams)
+                    params = unzip_from_theano(tparams, save_dtype)
                 numpy.savez(saveto, history_errs=history_errs, uidx=uidx, **params)
                 print('Done')
 
@@ -325,7 +375,7 @@ def train(dim_word=100,  # word vector dimensionality
                     saveto_uidx = '{}.iter{}.npz'.format(
                         os.path.splitext(saveto)[0], uidx)
                     numpy.savez(saveto_uidx, history_errs=history_errs,
-                                uidx=uidx, **unzip_from_theano(tparams))
+                                uidx=uidx, **unzip_from_theano(tparams, save_dtype))
                     print('Done')
 
             # generate some samples with the model and display them
@@ -344,7 +394,6 @@ def train(dim_word=100,  # word vector dimensionality
                                                                                         maxlen=30,
                                                                                         stochastic=stochastic,
                                                                                         argmax=False,
-                                                                                        suppress_unk=False,
                                                                                         return_hyp_graph=False)
                     print('Source ', jj, ': ',)
                     for pos in range(x.shape[1]):
@@ -394,7 +443,7 @@ def train(dim_word=100,  # word vector dimensionality
                 history_errs.append(valid_err)
 
                 if uidx == 0 or valid_err <= numpy.array(history_errs).min():
-                    best_p = unzip_from_theano(tparams)
+                    best_p = unzip_from_theano(tparams, save_dtype)
                     bad_counter = 0
                 if len(history_errs) > patience and valid_err >= \
                         numpy.array(history_errs)[:-patience].min():
@@ -426,7 +475,7 @@ def train(dim_word=100,  # word vector dimensionality
                         p_validation.wait()
                         print("Waited for {0:.1f} seconds".format(time.time()-valid_wait_start))
                     print('Saving  model...',)
-                    params = unzip_from_theano(tparams)
+                    params = unzip_from_theano(tparams, save_dtype)
                     numpy.savez(saveto +'.dev', history_errs=history_errs, uidx=uidx, **params)
                     json.dump(model_options, open('%s.dev.npz.json' % saveto, 'wb'), indent=2)
                     print('Done')
@@ -443,6 +492,11 @@ def train(dim_word=100,  # word vector dimensionality
         if estop:
             break
 
+    # the gradients of the minibatches since the last update (the training data
+    # ran out in the middle of an accumulation) are not thrown away
+    if n_accum > 0:
+        f_update(lrate)
+
     if best_p is not None:
         zip_to_theano(best_p, tparams)
 
@@ -457,7 +511,7 @@ def train(dim_word=100,  # word vector dimensionality
     if best_p is not None:
         params = copy.copy(best_p)
     else:
-        params = unzip_from_theano(tparams)
+        params = unzip_from_theano(tparams, save_dtype)
     numpy.savez(saveto, zipped_params=best_p,
                 history_errs=history_errs,
                 uidx=uidx,
@@ -482,6 +536,8 @@ if __name__ == '__main__':
                          help="load existing model (if '--model' points to existing model)")
     data.add_argument('--overwrite', action='store_true',
                          help="write all models to same file")
+    data.add_argument('--save_float16', action='store_true',
+                         help="store saved models in float16 (half the size; they are loaded back to float32)")
 
     network = parser.add_argument_group('network parameters')
     network.add_argument('--dim_word', type=int, default=512, metavar='INT',
@@ -542,6 +598,29 @@ if __name__ == '__main__':
                          help='do not sort sentences in maxibatch by length')
     training.add_argument('--maxibatch_size', type=int, default=20, metavar='INT',
                          help='size of maxibatch (number of minibatches that are sorted by length) (default: %(default)s)')
+    training.add_argument('--fused_step', action="store_true",
+                         help="compute gradients and update the parameters with a single function, "
+                              "without storing the gradients (less memory, one call per update)")
+    training.add_argument('--accum_steps', type=int, default=1, metavar='INT',
+                         help="accumulate the gradients of INT minibatches per update, for large effective "
+                              "batches with the memory use of one minibatch (default: %(default)s)")
+    training.add_argument('--accum_weighting', type=str, default='sentences', choices=['sentences', 'tokens'],
+                         help="weight the accumulated gradients by the number of sentences (the same as one "
+                              "large batch) or target tokens of each minibatch (default: %(default)s)")
+    training.add_argument('--sparse_update', type=str, nargs='+', default=[], metavar='GROUP',
+                         choices=SPARSE_UPDATE_GROUPS,
+                         help="only update the rows of the words in each batch (and their optimizer state) for "
+                              "these parameter groups: %(choices)s; 'output' needs --sampled_softmax, and "
+                              "none can be used with --decay_c or --map_decay_c (default: none)")
+    training.add_argument('--sampled_softmax', type=int, default=0, metavar='INT',
+                         help="train with a sampled softmax over INT candidate words per batch instead of the "
+                              "full target vocabulary; validation and scoring use the full softmax "
+                              "(default: %(default)s, full softmax)")
+    training.add_argument('--output_chunk_steps', type=int, default=0, metavar='INT',
+                         help="compute the output layer and cost in chunks of INT target positions, recomputing "
+                              "them in the backward pass, so that the [length x batch x vocabulary] logits never "
+                              "exist in full; for longer sentences or larger batches in the same memory "
+                              "(default: %(default)s, off)")
     finetune = training.add_mutually_exclusive_group()
     finetune.add_argument('--finetune', action="store_true",
                         help="train with fixed embedding layer")
@@ -19,11 +19,15 @@ from theano.tensor.shared_randomstreams import RandomStreams
 
 from data_iterator import TextIterator
 from domain_interpolation_data_iterator import DomainInterpolatorTextIterator
-from nmt_utils import prepare_data, gen_sample, pred_probs
+from nmt_utils import prepare_data, gen_sample
 from pyro_utils import setup_remotes, get_random_key, get_unused_port
+from theano_util import cast_params
+from training_profiler import StageProfiler
 from util import load_dict
+from validation import ValidationSet, AsyncValidator
 
 gpu_id = 1
+valid_gpu_id = gpu_id  # used for the validation remote if async_validation is set
 profile = False
 bypass_pyro = False
 
@@ -50,6 +54,12 @@ default_model_options = dict(
     reload_=False,
     finetune=False,
     finetune_only_last=False,
+    fused_step=False,  # compute gradients and update in one call (RemoteMT.x_train_step)
+    accum_steps=1,  # accumulate the gradients of this many minibatches per update
+    accum_weighting='sentences',  # weight accumulated gradients by the number of 'sentences' or target 'tokens'
+    sparse_update=[],  # parameter groups that only update the rows of the words in the batch (see nmt_utils)
+    sampled_softmax=0,  # train on a softmax over this many sampled words instead of the full vocabulary (0: full)
+    output_chunk_steps=0,  # compute the output layer in chunks of this many target positions (0: all at once)
     model_version=0.1,  # store version used for training for compatibility
 )
 
@@ -82,7 +92,12 @@ def train(**kwargs):
                        'pyro_key': pyro_key,
                        'pyro_port': pyro_port})
 
-        with setup_remotes(remote_metadata_list=[dict(script=remote_script, name=pyro_name, gpu_id=gpu_id)],
+        remote_metadata_list = [dict(script=remote_script, name=pyro_name, gpu_id=gpu_id)]
+        if kwargs.get('async_validation'):
+            kwargs['pyro_name_valid'] = 'remote_valid'
+            remote_metadata_list.append(dict(script=remote_script, name='remote_valid', gpu_id=valid_gpu_id))
+
+        with setup_remotes(remote_metadata_list=remote_metadata_list,
                            pyro_port=pyro_port,
                            pyro_key=pyro_key):
             train2(**kwargs)
@@ -108,6 +123,7 @@ def train2(model_options=None,
            validFreq=1000,
            sampleFreq=100,
            overwrite=False,
+           save_float16=False,  # store saved models and the best parameters kept in memory in float16
            external_validation_script=None,
            shuffle_each_epoch=True,
            sort_by_length=True,
@@ -118,6 +134,11 @@ def train2(model_options=None,
            pyro_key=None,  # pyro hmac key
            pyro_port=None,  # pyro nameserver port
            pyro_name=None,  # if None, will import instead of assuming a server is running
+           pyro_name_valid=None,  # remote used for async_validation (if None, will import)
+           async_validation=False,  # validate a parameter snapshot on a separate remote while training continues
+           valid_cache=None,  # keep the padded validation batches in this file across runs
+           metrics_file=None,  # write per-stage timings etc. to this file every dispFreq updates
+           metrics_format='json',  # 'json' (one line per report) or 'prometheus' (text file, rewritten)
            ):
 
     if model_options is None:
@@ -171,11 +192,13 @@ def train2(model_options=None,
                              maxibatch_size=maxibatch_size)
 
     if valid_datasets and validFreq:
-        valid = TextIterator(valid_datasets[0], valid_datasets[1],
-                             dictionaries[:-1], dictionaries[-1],
-                             n_words_source=model_options['n_words_src'], n_words_target=model_options['n_words'],
-                             batch_size=valid_batch_size,
-                             maxlen=maxlen)
+        valid = ValidationSet.from_files(valid_datasets[0], valid_datasets[1],
+                                         dictionaries[:-1], dictionaries[-1],
+                                         n_words_source=model_options['n_words_src'], n_words_target=model_options['n_words'],
+                                         batch_size=valid_batch_size,
+                                         maxlen=maxlen,
+                                         factors=model_options['factors'],
+                                         cache=valid_cache)
     else:
         valid = None
 
@@ -195,8 +218,23 @@ def train2(model_options=None,
 
     remote.init(model_options)
 
+    validator = None
+    if valid and async_validation:
+        if pyro_name_valid:
+            print 'Initilizing remote validation server'
+            remote_valid = Pyro4.Proxy("PYRONAME:{0}".format(pyro_name_valid))
+            remote_valid._pyroHmacKey = pyro_key
+        else:
+            from nmt_remote import RemoteMT
+            remote_valid = RemoteMT()
+        remote_valid.init(model_options, False)
+        validator = AsyncValidator(remote_valid, valid)
+
     print 'Optimization'
 
+    # parameters are computed in floatX, but (optionally) stored in float16
+    save_dtype = 'float16' if save_float16 else None
+
     best_p = None
     bad_counter = 0
     uidx = 0
@@ -221,15 +259,20 @@ def train2(model_options=None,
 
     valid_err = None
 
-    last_disp_samples = 0
-    ud_start = time.time()
+    # with accum_steps > 1, every update uses the gradients of accum_steps consecutive
+    # minibatches (of similar length, as they come from the same sorted maxibatch)
+    accum_steps = model_options.get('accum_steps', 1)
+    accum_weighting = model_options.get('accum_weighting', 'sentences')
+    accum_cost = 0.
+    n_accum = 0
+
+    profiler = StageProfiler(metrics_file, metrics_format)
     p_validation = None
     for eidx in xrange(max_epochs):
         n_samples = 0
 
-        for x, y in train:
+        for x, y in profiler.timed_iter(train, 'data'):
             n_samples += len(x)
-            last_disp_samples += len(x)
             uidx += 1
             remote.set_noise_val(1.)
 
@@ -240,18 +283,33 @@ def train2(model_options=None,
                         model_options['factors'], len(x[0][0])))
                 sys.exit(1)
 
-            x, x_mask, y, y_mask = prepare_data(x, y, maxlen=maxlen)  # TODO: are n_words, n_words_src really not needed?
+            with profiler.stage('prepare_data'):
+                x, x_mask, y, y_mask = prepare_data(x, y, maxlen=maxlen)  # TODO: are n_words, n_words_src really not needed?
 
             if x is None:
                 print 'Minibatch with zero sample under length ', maxlen
                 uidx -= 1
                 continue
 
-            # compute cost, grads and copy grads to shared variables
-            cost = remote.x_f_grad_shared(x, x_mask, y, y_mask)
-
-            # do the update on parameters
-            remote.x_f_update(lrate)
+            profiler.add_batch(x_mask, y_mask)
+
+            if accum_steps > 1:
+                # add the gradients of this minibatch to those collected since the last update
+                weight = y_mask.sum() if accum_weighting == 'tokens' else x_mask.shape[1]
+                with profiler.stage('grad'):
+                    accum_cost += remote.x_f_grad_shared(x, x_mask, y, y_mask, accum_weight=weight)
+                n_accum += 1
+                if n_accum < accum_steps:
+                    uidx -= 1
+                    continue
+
+                with profiler.stage('update'):
+                    remote.x_f_update(lrate)
+                cost, accum_cost, n_accum = accum_cost / accum_steps, 0., 0
+            else:
+                # compute cost and grads and update the parameters
+                with profiler.stage('step'):
+                    cost = remote.x_train_step(x, x_mask, y, y_mask, lrate)
 
             # check for bad numbers, usually we remove non-finite elements
             # and continue training - but not done here
@@ -261,41 +319,47 @@ def train2(model_options=None,
 
             # verbose
             if numpy.mod(uidx, dispFreq) == 0:
-                ud = time.time() - ud_start
-                wps = (last_disp_samples) / float(ud)
-                print 'Epoch ', eidx, 'Update ', uidx, 'Cost ', cost, 'UD ', ud, "{0:.2f} sentences/s".format(wps)
-                ud_start = time.time()
-                last_disp_samples = 0
+                profiler.split_remote(remote.pop_stage_times())
+                stats = profiler.report(epoch=eidx, update=int(uidx), cost=float(cost))
+                print 'Epoch ', eidx, 'Update ', uidx, 'Cost ', cost, 'UD ', stats['elapsed'], \
+                    "{0:.2f} sentences/s".format(stats['sentences_per_second']), \
+                    "{0:.1f}/{1:.1f} src/trg words/s".format(stats['src_words_per_second'],
+                                                            stats['trg_words_per_second'])
+                print 'Stage times ', ' '.join('{0}={1:.2f}s'.format(k, v) for k, v in stats['stage_seconds'].iteritems()), \
+                    'padding efficiency {0:.2f}/{1:.2f}'.format(stats['src_padding_efficiency'],
+                                                                stats['trg_padding_efficiency'])
 
             # save the best model so far, in addition, save the latest model
             # into a separate file with the iteration number for external eval
             if numpy.mod(uidx, saveFreq) == 0:
-                print 'Saving the best model...',
-                if best_p is not None:
-                    params = best_p
-                else:
-                    params = remote.get_params_from_theano()
-                numpy.savez(model_options['saveto'], history_errs=history_errs, uidx=uidx, **params)
-                print 'Done'
-
-                # save with uidx
-                if not overwrite:
-                    print 'Saving the model at iteration {}...'.format(uidx),
-                    saveto_uidx = '{}.iter{}.npz'.format(
-                        os.path.splitext(model_options['saveto'])[0], uidx)
-                    numpy.savez(saveto_uidx, history_errs=history_errs,
-                                uidx=uidx, **remote.get_params_from_theano())
+                with profiler.stage('saving'):
+                    print 'Saving the best model...',
+                    if best_p is not None:
+                        params = best_p
+                    else:
+                        params = remote.get_params_from_theano(save_dtype)
+                    numpy.savez(model_options['saveto'], history_errs=history_errs, uidx=uidx, **params)
                     print 'Done'
 
+                    # save with uidx
+                    if not overwrite:
+                        print 'Saving the model at iteration {}...'.format(uidx),
+                        saveto_uidx = '{}.iter{}.npz'.format(
+                            os.path.splitext(model_options['saveto'])[0], uidx)
+                        numpy.savez(saveto_uidx, history_errs=history_errs,
+                                    uidx=uidx, **remote.get_params_from_theano(save_dtype))
+                        print 'Done'
+
             # generate some samples with the model and display them
             if sampleFreq and numpy.mod(uidx, sampleFreq) == 0:
+                sample_start = time.time()
                 # FIXME: random selection?
                 for jj in xrange(numpy.minimum(5, x.shape[2])):
                     stochastic = True
                     x_current = x[:, :, jj][:, :, None]
 
                     # remove padding
-                    x_current = x_current[:, :x_mask[:, jj].sum(), :]
+                    x_current = x_current[:, :int(x_mask[:, jj].sum()), :]
 
                     sample, score, _, _, _ = gen_sample([remote.x_f_init],
                                                         [remote.x_f_next],
@@ -304,8 +368,8 @@ def train2(model_options=None,
                                                         maxlen=30,
                                                         stochastic=stochastic,
                                                         argmax=False,
-                                                        suppress_unk=False,
-                                                        return_hyp_graph=False)
+                                                        return_hyp_graph=False,
+                                                        log_probs=True)
                     print 'Source ', jj, ': ',
                     for pos in range(x.shape[1]):
                         if x[0, pos, jj] == 0:
@@ -344,17 +408,35 @@ def train2(model_options=None,
                         else:
                             print 'UNK',
                     print
+                profiler.add_time('sampling', time.time() - sample_start)
 
             # validate model on validation set and early stop if necessary
+            # (with async_validation, the result of a run is handled once it is available)
+            valid_errs = valid_params = None
             if valid and validFreq and numpy.mod(uidx, validFreq) == 0:
-                remote.set_noise_val(0.)
-                valid_errs, _ = pred_probs(remote.x_f_log_probs, prepare_data,
-                                                   model_options, valid)
+                if validator is None:
+                    remote.set_noise_val(0.)
+                    with profiler.stage('validation'):
+                        valid.refresh()
+                        valid_errs = valid.score(remote.x_f_log_probs)
+                else:
+                    if validator.busy():
+                        print "Waiting for previous validation run to finish"
+                        with profiler.stage('validation'):
+                            _, valid_errs, valid_params = validator.result()
+                    validator.start(uidx, remote.get_params_from_theano())
+            elif validator is not None and validator.ready():
+                _, valid_errs, valid_params = validator.result()
+
+            if valid_errs is not None:
                 valid_err = valid_errs.mean()
                 history_errs.append(valid_err)
 
                 if uidx == 0 or valid_err <= numpy.array(history_errs).min():
-                    best_p = remote.get_params_from_theano()
+                    if valid_params is not None:
+                        best_p = cast_params(valid_params, save_dtype)
+                    else:
+                        best_p = remote.get_params_from_theano(save_dtype)
                     bad_counter = 0
                 if len(history_errs) > patience and valid_err >= \
                         numpy.array(history_errs)[:-patience].min():
@@ -384,12 +466,17 @@ def train2(model_options=None,
                         print "If this takes too long, consider increasing validation interval, reducing validation set size, or speeding up validation by using multiple processes"
                         valid_wait_start = time.time()
                         p_validation.wait()
+                        profiler.add_time('validation', time.time() - valid_wait_start)
                         print "Waited for {0:.1f} seconds".format(time.time() - valid_wait_start)
-                    print 'Saving  model...',
-                    params = remote.get_params_from_theano()
-                    numpy.savez(model_options['saveto'] + '.dev', history_errs=history_errs, uidx=uidx, **params)
-                    json.dump(model_options, open('%s.dev.npz.json' % model_options['saveto'], 'wb'), indent=2)
-                    print 'Done'
+                    with profiler.stage('saving'):
+                        print 'Saving  model...',
+                        if valid_params is not None:
+                            params = cast_params(valid_params, save_dtype)
+                        else:
+                            params = remote.get_params_from_theano(save_dtype)
+                        numpy.savez(model_options['saveto'] + '.dev', history_errs=history_errs, uidx=uidx, **params)
+                        json.dump(model_options, open('%s.dev.npz.json' % model_options['saveto'], 'wb'), indent=2)
+                        print 'Done'
                     p_validation = Popen([external_validation_script])
 
             # finish after this many updates
@@ -403,12 +490,20 @@ def train2(model_options=None,
         if estop:
             break
 
+    # the gradients of the minibatches since the last update (the training data
+    # ran out in the middle of an accumulation) are not thrown away
+    if n_accum > 0:
+        remote.x_f_update(lrate)
+
+    if validator is not None and validator.busy():
+        validator.result()
+
     if best_p is not None:
         remote.send_params_to_theano(best_p)
 
     if valid:
         remote.set_noise_val(0.)
-        valid_errs, _ = pred_probs(remote.x_f_log_probs, prepare_data, model_options, valid)
+        valid_errs = valid.score(remote.x_f_log_probs)
         valid_err = valid_errs.mean()
 
         print 'Valid ', valid_err
@@ -416,7 +511,7 @@ def train2(model_options=None,
     if best_p is not None:
         params = copy.copy(best_p)
     else:
-        params = remote.get_params_from_theano()
+        params = remote.get_params_from_theano(save_dtype)
     numpy.savez(model_options['saveto'], zipped_params=best_p,
                 history_errs=history_errs,
                 uidx=uidx,
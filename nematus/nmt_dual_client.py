@@ -16,10 +16,12 @@ import numpy
 from theano.tensor.shared_randomstreams import RandomStreams
 
 from data_iterator import TextIterator, MonoIterator
-from nmt_client import default_model_options, pred_probs
+from nmt_client import default_model_options
 from nmt_utils import prepare_data, gen_sample
 from pyro_utils import setup_remotes, get_random_key, get_unused_port
+from training_profiler import StageProfiler
 from util import load_dict
+from validation import ValidationSet
 
 profile = False
 bypass_pyro = False  # True
@@ -35,8 +37,12 @@ def _add_dim(x_pre):
     return xx
 
 
-def _train_foo(remote_mt, _xxx, _yyy, _per_sent_weight, _lrate, maxlen):
-    _x_prep, _x_mask, _y_prep, _y_mask = prepare_data(_add_dim(_xxx), _yyy, maxlen=maxlen)
+def _train_foo(remote_mt, _xxx, _yyy, _per_sent_weight, _lrate, maxlen, profiler=None):
+    if profiler is None:
+        profiler = StageProfiler()
+
+    with profiler.stage('prepare_data'):
+        _x_prep, _x_mask, _y_prep, _y_mask = prepare_data(_add_dim(_xxx), _yyy, maxlen=maxlen)
 
     if _x_prep is None:
         logging.warn('_x_prep is None')
@@ -73,16 +79,19 @@ def _train_foo(remote_mt, _xxx, _yyy, _per_sent_weight, _lrate, maxlen):
         logging.warn('--BAD--    '*40 + 'I DO NOT KNOW WHY, BUT SOMETIMES prepare_data() DECIDES TO THROW SENTENCE AWAY!! TODO!! figure out what is going on. skipping.')
         return None
 
+    profiler.add_batch(_x_mask, _y_mask)
     remote_mt.set_noise_val(0.)
     # returns cost, which is related to log probs BUT may be weighted per sentence, and may include regularization terms!
-    cost = remote_mt.x_f_grad_shared(_x_prep, _x_mask, _y_prep, _y_mask, _per_sent_weight, per_sent_cost=True)
-    remote_mt.x_f_update(_lrate)  # TODO: WAIT TILL END?
+    with profiler.stage('step'):
+        cost = remote_mt.x_train_step(_x_prep, _x_mask, _y_prep, _y_mask, _lrate, _per_sent_weight,
+                                      per_sent_cost=True)  # TODO: WAIT TILL END?
     # check for bad numbers, usually we remove non-finite elements
     # and continue training - but not done here
     if any(numpy.isnan(cost)) or any(numpy.isinf(cost)):
         raise Exception('NaN detected')
     # TODO: this is wasteful! save time and compute at same time as cost above
-    per_sent_neg_log_prob = remote_mt.x_f_log_probs(_x_prep, _x_mask, _y_prep, _y_mask, )
+    with profiler.stage('log_probs'):
+        per_sent_neg_log_prob = remote_mt.x_f_log_probs(_x_prep, _x_mask, _y_prep, _y_mask, )
     # log(prob) is negative; higher is better, i.e. this is a reward
     # -log(prob) is positivel smaller is better, i.e. this is a cost
     # scale by -1. to get back to a reward
@@ -94,10 +103,13 @@ def monolingual_train(mt_systems, lm_1,
                       data, trng, k, maxlen,
                       worddicts_r, worddicts,
                       alpha, learning_rate_big,
-                      learning_rate_small):
+                      learning_rate_small, profiler=None):
 
     logging.info('monolingual_train called')
 
+    if profiler is None:
+        profiler = StageProfiler()
+
     mt_01, mt_10 = mt_systems
     num2word_01, num2word_10 = worddicts_r
     word2num_01, word2num_10 = worddicts
@@ -116,15 +128,16 @@ def monolingual_train(mt_systems, lm_1,
             logging.error('could not print sent 0')
 
         # TRANSLATE 0->1
-        sents1_01, scores_1, _, _, _ = gen_sample([mt_01.x_f_init],
-                                                  [mt_01.x_f_next],
-                                                  numpy.array([sent, ]),
-                                                  trng=trng, k=k,
-                                                  maxlen=maxlen,
-                                                  stochastic=False,
-                                                  argmax=False,
-                                                  suppress_unk=True,
-                                                  return_hyp_graph=False)
+        with profiler.stage('sampling'):
+            sents1_01, scores_1, _, _, _ = gen_sample([mt_01.x_f_init],
+                                                      [mt_01.x_f_next],
+                                                      numpy.array([sent, ]),
+                                                      trng=trng, k=k,
+                                                      maxlen=maxlen,
+                                                      stochastic=False,
+                                                      argmax=False,
+                                                      return_hyp_graph=False,
+                                                      log_probs=True)
 
         try:
             for ii, sent1_01 in enumerate(sents1_01):
@@ -169,7 +182,8 @@ def monolingual_train(mt_systems, lm_1,
 
         # LANGUAGE MODEL SCORE IN LANG 1
         # This will return a per-translation reward; it's a list of LM rewards
-        r_1 = lm_1.score(numpy.array(sents1_01_clean).T)
+        with profiler.stage('lm'):
+            r_1 = lm_1.score(numpy.array(sents1_01_clean).T)
         logging.debug("scores_lm1=%s", r_1)
         batch_per_trans_r1 += r_1 # list extend
 
@@ -242,8 +256,8 @@ def monolingual_train(mt_systems, lm_1,
                                                          maxlen=maxlen,
                                                          stochastic=False,
                                                          argmax=False,
-                                                         suppress_unk=True,
-                                                         return_hyp_graph=False)
+                                                         return_hyp_graph=False,
+                                                         log_probs=True)
             
             logging.debug('[just for degug] sentence 0->1->0 #0 (in system 10 vocab): %s', 
                           ' '.join([num2word_10[1][x] for x in batch_sents0_10_for_debug[0]]))
@@ -261,7 +275,7 @@ def monolingual_train(mt_systems, lm_1,
     logging.info('psw10=%s', per_sent_weight)
 
     r_2 = _train_foo(mt_10, batch_sents1_10_clean, batch_sents0_10_clean,
-                     per_sent_weight, learning_rate_big, maxlen)
+                     per_sent_weight, learning_rate_big, maxlen, profiler)
 
     if r_2 is None:
         logging.warning('prepare_data() failed for some reason. returning early.')
@@ -283,7 +297,7 @@ def monolingual_train(mt_systems, lm_1,
     logging.info('psw01=%s', per_sent_weight)
 
     final_r = _train_foo(mt_01, batch_sents0_10_clean, batch_sents1_10_clean,
-                         per_sent_weight, learning_rate_small, maxlen)
+                         per_sent_weight, learning_rate_small, maxlen, profiler)
 
     logging.info('final_r=%s', final_r)
 
@@ -384,6 +398,8 @@ def train2(model_options_a_b=None,
            language_models=(),
            mt_gpu_ids=(),
            lm_gpu_ids=(),
+           metrics_file=None,  # write per-stage timings etc. to this file every disp_freq steps
+           metrics_format='json',  # 'json' (one line per report) or 'prometheus' (text file, rewritten)
            ):
 
     if model_options_a_b is None:
@@ -449,12 +465,13 @@ def train2(model_options_a_b=None,
                               sort_by_length=sort_by_length,
                               maxibatch_size=maxibatch_size)
 
-        _valid = TextIterator(valid_dataset_a, valid_dataset_b,
-                              dict_a, dict_b,
-                              n_words_source=model_opts['n_words_src'],
-                              n_words_target=model_opts['n_words'],
-                              batch_size=valid_batch_size,
-                              maxlen=maxlen)
+        _valid = ValidationSet.from_files(valid_dataset_a, valid_dataset_b,
+                                          dict_a, dict_b,
+                                          n_words_source=model_opts['n_words_src'],
+                                          n_words_target=model_opts['n_words'],
+                                          batch_size=valid_batch_size,
+                                          maxlen=maxlen,
+                                          factors=model_opts['factors'])
 
         return _train, _valid
 
@@ -529,10 +546,10 @@ def train2(model_options_a_b=None,
         remote_lm_b = RemoteLM()
 
     print 'initializing remote MT0'
-    remote_mt_a_b.init(model_options_a_b)
+    remote_mt_a_b.init(model_options_a_b, suppress_unk=True)
     print 'initializing remote MT1'
     # remote_mt_a_b.set_noise_val(0.5) # TEST: make sure it initilized
-    remote_mt_b_a.init(model_options_b_a)
+    remote_mt_b_a.init(model_options_b_a, suppress_unk=True)
     print 'initializing remote LM0'
     remote_lm_a.init(language_models[0], worddicts_r_b_a[1])  # scoring going INTO language, so use A from BA
     print 'initializing remote LM1'
@@ -585,8 +602,8 @@ def train2(model_options_a_b=None,
 
     valid_err = None
 
-    last_disp_samples = 0
-    ud_start = time.time()
+    profiler = StageProfiler(metrics_file, metrics_format)
+    n_steps = 0
     p_validation = None
     k = 2
     alpha = 0.05
@@ -604,11 +621,13 @@ def train2(model_options_a_b=None,
                                                              [remote_mt_a_b,     remote_mt_b_a    ],
                                                              ['a->b',            'b->a'           ], ):
                 _remote_mt.set_noise_val(0.)
-                valid_errs, _ = pred_probs(_remote_mt.x_f_log_probs, prepare_data, _model_options, _valid, verbose=False)
+                with profiler.stage('validation'):
+                    _valid.refresh()
+                    valid_errs = _valid.score(_remote_mt.x_f_log_probs)
                 valid_err = valid_errs.mean()
                 logging.info('epoch=%d, MT %s valid_err=%.1f', eidx, _name, valid_err)
 
-        for data_type, data in training:
+        for data_type, data in profiler.timed_iter(training, 'data'):
 
             if data_type == 'mt':
                 logging.debug('training on bitext')
@@ -628,7 +647,8 @@ def train2(model_options_a_b=None,
 
                     # TODO: training each system in parallel!
 
-                    x_prep, x_mask, y_prep, y_mask = prepare_data(x, y, maxlen=maxlen)
+                    with profiler.stage('prepare_data'):
+                        x_prep, x_mask, y_prep, y_mask = prepare_data(x, y, maxlen=maxlen)
 
                     _remote_mt.set_noise_val(1.)
 
@@ -637,16 +657,16 @@ def train2(model_options_a_b=None,
                         # uidx -= 1
                         continue
 
-                    cost = _remote_mt.x_f_grad_shared(x_prep, x_mask, y_prep, y_mask)
+                    profiler.add_batch(x_mask, y_mask)
+                    # compute cost and grads and update the parameters
+                    with profiler.stage('step'):
+                        cost = _remote_mt.x_train_step(x_prep, x_mask, y_prep, y_mask, lrate)
 
                     # check for bad numbers, usually we remove non-finite elements
                     # and continue training - but not done here
                     if numpy.isnan(cost) or numpy.isinf(cost):
                         logging.exception('NaN detected')
 
-                    # do the update on parameters
-                    _remote_mt.x_f_update(lrate)
-
             elif data_type == 'mono-a':
                 logging.info('#'*40 + 'training the a -> b -> a loop.')
                 monolingual_train([remote_mt_a_b, remote_mt_b_a],
@@ -654,7 +674,7 @@ def train2(model_options_a_b=None,
                                   [worddicts_r_a_b, worddicts_r_b_a],
                                   [worddicts_a_b,   worddicts_b_a],
                                   alpha, learning_rate_big,
-                                  learning_rate_small)
+                                  learning_rate_small, profiler)
             elif data_type == 'mono-b':
                 logging.info('#'*40 + 'training the b -> a -> b loop.')
                 monolingual_train([remote_mt_b_a, remote_mt_a_b],
@@ -662,8 +682,20 @@ def train2(model_options_a_b=None,
                                   [worddicts_r_b_a, worddicts_r_a_b],
                                   [worddicts_b_a,   worddicts_a_b],
                                   alpha, learning_rate_big,
-                                  learning_rate_small)
+                                  learning_rate_small, profiler)
             else:
                 raise Exception('This should be unreachable. How did you get here?')
 
+            n_steps += 1
+            if disp_freq and n_steps % disp_freq == 0:
+                remote_times = remote_mt_a_b.pop_stage_times()
+                for name, seconds in remote_mt_b_a.pop_stage_times().iteritems():
+                    remote_times[name] = remote_times.get(name, 0.) + seconds
+                profiler.split_remote(remote_times)
+                stats = profiler.report(epoch=eidx, step=n_steps)
+                logging.info('epoch=%d, step=%d, %.2f sentences/s, %.1f/%.1f src/trg words/s, stages: %s',
+                             eidx, n_steps, stats['sentences_per_second'],
+                             stats['src_words_per_second'], stats['trg_words_per_second'],
+                             ' '.join('{0}={1:.2f}s'.format(k, v) for k, v in stats['stage_seconds'].iteritems()))
+
     return None
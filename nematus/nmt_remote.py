@@ -14,7 +14,7 @@ import numpy
 import theano
 import theano.tensor as tensor
 
-from nmt_utils import init_params, build_model, build_sampler
+from nmt_utils import init_params, build_model, build_sampler, sparse_update_params
 import optimizers
 from theano_util import load_params, init_theano_params, itemlist, unzip_from_theano, zip_to_theano
 
@@ -26,13 +26,28 @@ Pyro4.config.SERIALIZER = 'pickle'
 @Pyro4.expose
 class RemoteMT(object):
     # TODO: would be nice to use __init__ here... but Pyro does not pass args??
-    def init(self, model_options):
-        """Exposes: (but Pyro does not see them)
+    def init(self, model_options, training=True, suppress_unk=False):
+        """If training is False, only the sampler and f_log_probs are compiled (e.g. for validation).
+
+        f_next returns log-probabilities (use gen_sample(..., log_probs=True)); with suppress_unk,
+        UNK is excluded from them.
+
+        Exposes: (but Pyro does not see them)
             self.f_init
             self.f_next
             self.f_log_probs
             self.f_grad_shared
             self.f_update
+            self.f_train_step (if model_options['fused_step'] is set; f_grad_shared and f_update are None then)
+
+        With model_options['accum_steps'] > 1, f_grad_shared accumulates the gradients of several
+        minibatches (see x_f_grad_shared) until the next f_update.
+
+        model_options['sparse_update'] lists the parameter groups (nmt_utils.SPARSE_UPDATE_GROUPS)
+        for which only the rows of the words in the batch are updated (not with decay_c or map_decay_c).
+
+        With model_options['sampled_softmax'] > 0, the training cost is a sampled softmax (see
+        nmt_utils._sampled_softmax_cost); f_log_probs always uses the full softmax.
         """
 
         reload_ = model_options['reload_']
@@ -44,6 +59,11 @@ class RemoteMT(object):
         finetune_only_last = model_options['finetune_only_last']
         clip_c = model_options['clip_c']
         optimizer = model_options['optimizer']
+        fused_step = model_options.get('fused_step', False)
+        self.accumulate = model_options.get('accum_steps', 1) > 1
+        if fused_step and self.accumulate:
+            print 'Gradient accumulation needs separate gradient and update steps, not using fused_step'
+            fused_step = False
 
         comp_start = time.time()
 
@@ -60,13 +80,27 @@ class RemoteMT(object):
 
         inps = [x, x_mask, y, y_mask]
 
-        self.f_init, self.f_next = build_sampler(self.tparams, model_options, self.use_noise, trng)
+        self.f_init, self.f_next = build_sampler(self.tparams, model_options, self.use_noise, trng,
+                                                 log_probs=True, suppress_unk=suppress_unk)
 
         # before any regularizer
         print 'Building f_log_probs...',
         self.f_log_probs = theano.function(inps, per_sent_neg_log_prob, profile=profile)
         print 'Done'
 
+        # train on the sampled softmax (f_log_probs keeps the full softmax); the training costs
+        # returned by f_grad_shared are then estimates
+        if model_options.get('sampled_softmax'):
+            per_sent_neg_log_prob = opt_ret['sampled_cost']
+
+        # time spent computing on this side, so the client can tell it apart from Pyro transport
+        self.stage_times = {}
+        self.valid_set = None
+
+        if not training:
+            print 'Total compilation time: {0:.1f}s'.format(time.time() - comp_start)
+            return
+
         # apply per-sentence weight to cost_vec before averaging
         per_sent_weight = tensor.vector('per_sent_weight', dtype='float32')
         per_sent_weight.tag.test_value = numpy.ones(10).astype('float32')
@@ -109,8 +143,14 @@ class RemoteMT(object):
         else:
             updated_params = self.tparams
 
+        # the gradients of sparsely updated parameters only cover the rows of the words in the batch
+        sparse = sparse_update_params(model_options)
+        if sparse and (model_options['decay_c'] > 0. or model_options['map_decay_c'] > 0.):
+            raise ValueError('weight decay (decay_c, map_decay_c) changes every row, it cannot be used with '
+                             'sparse_update')
+
         print 'Computing gradient...',
-        grads = tensor.grad(cost, wrt=itemlist(updated_params))
+        grads, sparse = optimizers.gradients(cost, updated_params, sparse)
         print 'Done'
 
         # apply gradient clipping here
@@ -132,7 +172,16 @@ class RemoteMT(object):
         op_map = {'adam': optimizers.adam, 'adadelta': optimizers.adadelta,
                   'rmsprop': optimizers.rmsprop, 'sgd': optimizers.sgd}
         inps = inps + [per_sent_weight, ]
-        self.f_grad_shared, self.f_update = op_map[optimizer](lr, updated_params, grads, inps, per_sent_neg_log_prob, profile=profile)
+        if fused_step:
+            # one call per update, no shared gradient buffers
+            self.f_grad_shared = self.f_update = None
+            self.f_train_step = op_map[optimizer](lr, updated_params, grads, inps, per_sent_neg_log_prob,
+                                                  profile=profile, fused=True, sparse=sparse)
+        else:
+            self.f_train_step = None
+            self.f_grad_shared, self.f_update = op_map[optimizer](lr, updated_params, grads, inps, per_sent_neg_log_prob,
+                                                                  profile=profile, accumulate=self.accumulate,
+                                                                  sparse=sparse)
         print 'Done'
 
         print 'Total compilation time: {0:.1f}s'.format(time.time() - comp_start)
@@ -158,14 +207,26 @@ class RemoteMT(object):
     def x_f_log_probs(self, x, x_mask, y, y_mask):
         return self.f_log_probs(x, x_mask, y, y_mask)
 
-    def x_f_grad_shared(self, x, x_mask, y, y_mask, per_sent_weight=None, per_sent_cost=False):
+    def x_valid_costs(self, valid_set=None, normalize=False):
+        # score a validation.ValidationSet; it is kept here after the first call,
+        # so that it only crosses the wire once
+        if valid_set is not None:
+            self.valid_set = valid_set
+        return self.valid_set.score(self.f_log_probs, normalize)
+
+    def x_f_grad_shared(self, x, x_mask, y, y_mask, per_sent_weight=None, per_sent_cost=False, accum_weight=1.):
         # compute cost, grads and copy grads to shared variables
         # cost = f_grad_shared(x, x_mask, y, y_mask)
-        if per_sent_weight is None:
-            per_sent_weight = numpy.ones(numpy.array(y).shape[1], dtype=numpy.float32)
-        else:
-            per_sent_weight = numpy.array(per_sent_weight).astype(numpy.float32)
-        cost_vec = self.f_grad_shared(x, x_mask, y, y_mask, per_sent_weight)
+        # when accumulating, the gradients are added to the shared variables, weighted by accum_weight
+        # (e.g. the number of sentences or target words in the minibatch)
+        if self.f_grad_shared is None:
+            raise RuntimeError('model was compiled with fused_step; use x_train_step')
+        inps = [x, x_mask, y, y_mask, self._per_sent_weight(y, per_sent_weight)]
+        if self.accumulate:
+            inps.append(numpy.float32(accum_weight))
+        start = time.time()
+        cost_vec = self.f_grad_shared(*inps)
+        self._add_stage_time('grad', time.time() - start)
         if per_sent_cost:
             return cost_vec
         else:
@@ -174,15 +235,49 @@ class RemoteMT(object):
     def x_f_update(self, lrate):
         # do the update on parameters
         # CALLED AFTER f_grad_shared, which computes gradients
+        start = time.time()
         self.f_update(lrate)
+        self._add_stage_time('update', time.time() - start)
+
+    def x_train_step(self, x, x_mask, y, y_mask, lrate, per_sent_weight=None, per_sent_cost=False):
+        # compute cost and grads and update the parameters in one remote call: a single
+        # call to f_train_step if the model was compiled with fused_step, else f_grad_shared and f_update
+        if self.accumulate:
+            raise RuntimeError('model was compiled for gradient accumulation; use x_f_grad_shared and x_f_update')
+        per_sent_weight = self._per_sent_weight(y, per_sent_weight)
+        start = time.time()
+        if self.f_train_step is not None:
+            cost_vec = self.f_train_step(x, x_mask, y, y_mask, per_sent_weight, lrate)
+        else:
+            cost_vec = self.f_grad_shared(x, x_mask, y, y_mask, per_sent_weight)
+            self.f_update(lrate)
+        self._add_stage_time('step', time.time() - start)
+        if per_sent_cost:
+            return cost_vec
+        else:
+            return cost_vec.sum()
+
+    def _per_sent_weight(self, y, per_sent_weight):
+        if per_sent_weight is None:
+            return numpy.ones(numpy.array(y).shape[1], dtype=numpy.float32)
+        return numpy.array(per_sent_weight).astype(numpy.float32)
+
+    def _add_stage_time(self, name, seconds):
+        self.stage_times[name] = self.stage_times.get(name, 0.) + seconds
+
+    def pop_stage_times(self):
+        # seconds spent in f_grad_shared ('grad'), f_update ('update') and x_train_step ('step') since the last call
+        stage_times, self.stage_times = self.stage_times, {}
+        return stage_times
 
     ############
 
     def set_noise_val(self, val):
         self.use_noise.set_value(val)
 
-    def get_params_from_theano(self):
-        return unzip_from_theano(self.tparams)
+    def get_params_from_theano(self, dtype=None):
+        # dtype='float16' halves the size of the parameters sent back
+        return unzip_from_theano(self.tparams, dtype)
 
     def send_params_to_theano(self, params):
         zip_to_theano(params, self.tparams)
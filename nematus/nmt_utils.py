@@ -4,7 +4,6 @@
 Build a neural machine translation model with soft attention
 """
 
-import copy
 import sys
 from collections import OrderedDict
 
@@ -16,15 +15,12 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from initializers import norm_weight
 from layers import get_layer_param, shared_dropout_layer, get_layer_constr
-from theano_util import concatenate, embedding_name
+from theano_util import concatenate, embedding_name, log_softmax
 from alignment_util import get_alignments
+from beam_search import unmasked_sampler, gen_sample, gen_par_sample
 
 profile = False
 
-# Nematus relies on numpy.log(-numpy.inf) for suppressing unknowns
-# make sure numpy will not raise an exception because of nan
-numpy.seterr(divide='warn', over='warn', under='ignore', invalid='warn')
-
 # batch preparation
 def prepare_data(seqs_x, seqs_y, maxlen=None):
     # x: a list of sentences
@@ -115,14 +111,38 @@ def init_params(options):
     return params
 
 
+# parameters that are indexed by the vocabulary, by group, for sparse optimizer
+# updates (see optimizers.py); returns {parameter name: axis of the vocabulary}.
+# The cost may only look up words in these parameters, so 'output' needs the
+# sampled softmax, and none of them can be used with weight decay.
+SPARSE_UPDATE_GROUPS = ('source_embeddings', 'target_embeddings', 'output')
+
+def sparse_update_params(options, groups=None):
+    if groups is None:
+        groups = options.get('sparse_update') or []
+    params = {}
+    for group in groups:
+        if group == 'source_embeddings':
+            for factor in range(options['factors']):
+                params[embedding_name(factor)] = 0
+        elif group == 'target_embeddings':
+            params['Wemb_dec'] = 0
+        elif group == 'output':
+            params['ff_logit_W'] = 1
+            params['ff_logit_b'] = 0
+        else:
+            raise ValueError('unknown parameter group for sparse updates: {0}'.format(group))
+    return params
+
+
 # bidirectional RNN encoder: take input x (optionally with mask), and produce sequence of context vectors (ctx)
-def _build_encoder(tparams, options, trng, use_noise, x_mask=None, sampling=False):
+def _build_encoder(tparams, options, trng, use_noise, x_mask=None, sampling=False, x=None):
 
-    x = tensor.tensor3('x', dtype='int64')
-    x.tag.test_value = (numpy.random.rand(1, 5, 10)*100).astype('int64')
+    if x is None:
+        x = tensor.tensor3('x', dtype='int64')
+        x.tag.test_value = (numpy.random.rand(1, 5, 10)*100).astype('int64')
 
-    # for the backward rnn, we just need to invert x
-    xr = x[:,::-1]
+    # for the backward rnn, we just need to invert the mask
     if x_mask is None:
         xr_mask = None
     else:
@@ -181,20 +201,9 @@ def _build_encoder(tparams, options, trng, use_noise, x_mask=None, sampling=Fals
                                             rec_dropout=rec_dropout,
                                             profile=profile)
 
-    # word embedding for backward rnn (source)
-    embr = []
-    for factor in range(options['factors']):
-        embr.append(tparams[embedding_name(factor)][xr[factor].flatten()])
-    embr = concatenate(embr, axis=1)
-    embr = embr.reshape([n_timesteps, n_samples, options['dim_word']])
-    if options['use_dropout']:
-        if sampling:
-            embr *= source_dropout
-        else:
-            # we drop out the same words in both directions
-            embr *= source_dropout[::-1]
-
-    projr = get_layer_constr(options['encoder'])(tparams, embr, options,
+    # the backward rnn reads the same embeddings (with the same words dropped out) in
+    # reverse order; Theano merges the two scans into one loop over both directions
+    projr = get_layer_constr(options['encoder'])(tparams, emb[::-1], options,
                                              prefix='encoder_r',
                                              mask=xr_mask,
                                              emb_dropout=emb_dropout_r,
@@ -222,7 +231,18 @@ def build_model(tparams, options):
     y_mask.tag.test_value = numpy.ones(shape=(8, 10)).astype('float32')
 
     x, ctx = _build_encoder(tparams, options, trng, use_noise, x_mask, sampling=False)
-    n_samples = x.shape[2]
+
+    per_sent_neg_log_prob = _build_decoder(tparams, options, trng, use_noise, ctx, x_mask, y, y_mask, opt_ret)
+
+    #print "Print out in build_model()"
+    #print opt_ret
+    return trng, use_noise, x, x_mask, y, y_mask, opt_ret, per_sent_neg_log_prob
+
+
+# decoder of the training model: per-sentence cost of target y (with mask) given the
+# encoder context ctx (with mask x_mask); the attention weights are stored in opt_ret
+def _build_decoder(tparams, options, trng, use_noise, ctx, x_mask, y, y_mask, opt_ret):
+    n_samples = y.shape[1]
     n_timesteps_trg = y.shape[0]
 
     if options['use_dropout']:
@@ -307,29 +327,159 @@ def build_model(tparams, options):
     if options['use_dropout']:
         logit *= shared_dropout_layer((n_samples, options['dim_word']), use_noise, trng, retain_probability_hidden, scaled)
 
+    # training cost over a sample of the vocabulary (the full softmax below stays the model's score)
+    if options.get('sampled_softmax'):
+        opt_ret['sampled_cost'] = _sampled_softmax_cost(tparams, options, trng, logit, y, y_mask)
+
+    if options.get('output_chunk_steps'):
+        return _chunked_output_cost(tparams, options, logit, y, y_mask)
+
     logit = get_layer_constr('ff')(tparams, logit, options,
                                    prefix='ff_logit', activ='linear')
     logit_shp = logit.shape
-    probs = tensor.nnet.softmax(logit.reshape([logit_shp[0]*logit_shp[1],
-                                               logit_shp[2]]))
+    logit = logit.reshape([logit_shp[0]*logit_shp[1], logit_shp[2]])
 
-    # cost
+    # cost: -log softmax of the target words, with Theano's fused softmax cross-entropy, which
+    # computes log-sum-exp of the logits minus the target logit (no log(0)) and the gradient
+    # directly from the logits, without gathering from (or scattering into) the probabilities
     y_flat = y.flatten()
-    y_flat_idx = tensor.arange(y_flat.shape[0]) * options['n_words'] + y_flat
-    per_sent_neg_log_prob = -tensor.log(probs.flatten()[y_flat_idx])
+    per_sent_neg_log_prob = tensor.nnet.crossentropy_softmax_1hot(logit, y_flat)[0]
     per_sent_neg_log_prob = per_sent_neg_log_prob.reshape([y.shape[0], y.shape[1]])
     per_sent_neg_log_prob = (per_sent_neg_log_prob * y_mask).sum(0)  # note: y_mask is float, but only stores 0. or 1.
 
-    #print "Print out in build_model()"
-    #print opt_ret
-    return trng, use_noise, x, x_mask, y, y_mask, opt_ret, per_sent_neg_log_prob
+    return per_sent_neg_log_prob
+
+
+# the cost of the output layer (as in _build_decoder), computed in a scan over chunks of
+# options['output_chunk_steps'] target positions, given the hidden layer below it.
+# The logits and their gradient, [T x B x n_words] otherwise, then only exist for one
+# chunk at a time, and are recomputed chunk by chunk in the backward pass. They are
+# the largest tensors of the model in training, so this bounds the memory that grows
+# with sentence length and batch size, at the cost of computing the logits twice.
+def _chunked_output_cost(tparams, options, hidden, y, y_mask):
+    chunk = options['output_chunk_steps']
+    n_steps = y.shape[0]
+    n_chunks = (n_steps + chunk - 1) // chunk
+    pad = n_chunks * chunk - n_steps
+
+    # padded positions have mask 0 and add nothing to the cost
+    def _split(v):
+        v = tensor.concatenate([v, tensor.zeros([pad] + [v.shape[i] for i in range(1, v.ndim)], dtype=v.dtype)], axis=0)
+        return v.reshape([n_chunks, chunk] + [v.shape[i] for i in range(1, v.ndim)], ndim=v.ndim + 1)
+
+    def _step(hidden_, y_, y_mask_, W, b):
+        logit = tensor.dot(hidden_, W) + b
+        logit = logit.reshape([logit.shape[0] * logit.shape[1], logit.shape[2]])
+        cost = tensor.nnet.crossentropy_softmax_1hot(logit, y_.flatten())[0]
+        return (cost.reshape([y_.shape[0], y_.shape[1]]) * y_mask_).sum(0)
+
+    costs, updates = theano.scan(_step,
+                                 sequences=[_split(hidden), _split(y), _split(y_mask)],
+                                 non_sequences=[tparams['ff_logit_W'], tparams['ff_logit_b']],
+                                 name='output_chunks',
+                                 n_steps=n_chunks,
+                                 profile=profile,
+                                 strict=True)
+    return costs.sum(0)
+
+
+# sampled softmax (Bengio and Senecal, 2008; Jean et al., 2015): per-sentence cost of
+# target y, given the hidden layer below the output layer, where each target word
+# only competes with options['sampled_softmax'] candidates drawn once per batch.
+# The candidates are drawn (with replacement) from a log-uniform distribution over
+# the word ids, which approximates the unigram distribution because the dictionaries
+# are sorted by frequency. The normalizer is estimated by importance sampling: the
+# target word's own score plus the scores of the other candidates, each divided by
+# its expected number of draws (candidates that are the target word are masked).
+# The estimate is unbiased and never below the target word's score, and the cost
+# tends to the full softmax cost as the number of candidates grows; it needs
+# 1 + sampled_softmax output words per position instead of n_words.
+def _sampled_softmax_cost(tparams, options, trng, hidden, y, y_mask):
+    n_words = options['n_words']
+    n_sampled = options['sampled_softmax']
+    log_range = numpy.float32(numpy.log(n_words + 1.))
+
+    def log_expected_count(ids):
+        ids = tensor.cast(ids, 'float32')
+        return tensor.log(n_sampled * (tensor.log(ids + 2.) - tensor.log(ids + 1.)) / log_range)
+
+    u = trng.uniform((n_sampled,), dtype='float32')
+    sampled = tensor.cast(tensor.clip(tensor.floor(tensor.exp(u * log_range)) - 1., 0, n_words - 1), 'int64')
+
+    W = tparams['ff_logit_W']
+    b = tparams['ff_logit_b']
+    hidden = hidden.reshape([hidden.shape[0] * hidden.shape[1], hidden.shape[2]])
+    y_flat = y.flatten()
 
-# build a batched sampler
-def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
+    true_logit = (hidden * W.T[y_flat]).sum(1) + b[y_flat]
+    sampled_logit = tensor.dot(hidden, W[:, sampled]) + b[sampled] - log_expected_count(sampled)[None, :]
+    sampled_logit = tensor.switch(tensor.eq(y_flat[:, None], sampled[None, :]),
+                                  numpy.float32(-1e10), sampled_logit)
+
+    logits = concatenate([true_logit[:, None], sampled_logit], axis=1)
+    cost = tensor.nnet.crossentropy_softmax_1hot(logits, tensor.zeros_like(y_flat))[0]
+    cost = cost.reshape([y.shape[0], y.shape[1]])
+    return (cost * y_mask).sum(0)
+
+
+# build a scorer that encodes each source sentence only once, for scoring many
+# translations of the same sources (e.g. n-best lists):
+# f_encode(x, x_mask) returns the context of a batch of (distinct) sources;
+# f_decode(ctx, x_mask, src_idx, y, y_mask) returns the cost of each target sentence,
+# where column j of y is a translation of source src_idx[j] (a column of ctx and x_mask).
+# The costs are those of build_model (with use_noise off).
+def build_rescorer(tparams, options, return_alignment=False):
+    trng = RandomStreams(1234)
+    use_noise = theano.shared(numpy.float32(0.))
 
     x_mask = tensor.matrix('x_mask', dtype='float32')
     x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype('float32')
 
+    x, ctx = _build_encoder(tparams, options, trng, use_noise, x_mask, sampling=False)
+
+    print >>sys.stderr, 'Building f_encode...',
+    f_encode = theano.function([x, x_mask], ctx, name='f_encode', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    ctx = tensor.tensor3('ctx', dtype='float32')
+    src_idx = tensor.vector('src_idx', dtype='int64')
+    y = tensor.matrix('y', dtype='int64')
+    y_mask = tensor.matrix('y_mask', dtype='float32')
+
+    opt_ret = dict()
+    cost = _build_decoder(tparams, options, trng, use_noise, ctx[:, src_idx], x_mask[:, src_idx], y, y_mask, opt_ret)
+
+    print >>sys.stderr, 'Building f_decode...',
+    outs = cost
+    if return_alignment:
+        outs = [cost, opt_ret['dec_alphas']]
+    f_decode = theano.function([ctx, x_mask, src_idx, y, y_mask], outs, name='f_decode', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    return f_encode, f_decode
+
+# encoder and initial decoder state of the sampler, for input x (with mask)
+def _build_sampler_init(tparams, options, use_noise, trng, x, x_mask):
+
+    x, ctx = _build_encoder(tparams, options, trng, use_noise, x_mask=x_mask, sampling=True, x=x)
+
+    # get the input for decoder rnn initializer mlp
+    ctx_mean = ctx.mean(0)
+    # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
+
+    if options['use_dropout'] and options['model_version'] < 0.1:
+        ctx_mean *= 1-options['dropout_hidden']
+
+    init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
+                                    prefix='ff_state', activ='tanh')
+
+    return init_state, ctx
+
+
+# one step of the sampler: previous words y, context and previous decoder state
+# to unnormalized scores over the target vocabulary, next state and attention
+def _build_sampler_step(tparams, options, y, ctx, init_state, x_mask):
+
     if options['use_dropout'] and options['model_version'] < 0.1:
         retain_probability_emb = 1-options['dropout_embedding']
         retain_probability_hidden = 1-options['dropout_hidden']
@@ -344,27 +494,6 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
         emb_dropout_d = theano.shared(numpy.array([1.]*2, dtype='float32'))
         ctx_dropout_d = theano.shared(numpy.array([1.]*4, dtype='float32'))
 
-    x, ctx = _build_encoder(tparams, options, trng, use_noise, x_mask=x_mask, sampling=True)
-
-    # get the input for decoder rnn initializer mlp
-    ctx_mean = ctx.mean(0)
-    # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
-
-    if options['use_dropout'] and options['model_version'] < 0.1:
-        ctx_mean *= retain_probability_hidden
-
-    init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
-                                    prefix='ff_state', activ='tanh')
-
-    print >>sys.stderr, 'Building f_init...',
-    outs = [init_state, ctx]
-    f_init = theano.function([x, x_mask], outs, name='f_init', profile=profile)
-    print >>sys.stderr, 'Done'
-
-    # x: 1 x 1
-    y = tensor.vector('y_sampler', dtype='int64')
-    init_state = tensor.matrix('init_state', dtype='float32')
-
     # if it's the first word, emb should be all zero and it is indicated by -1
     emb = tensor.switch(y[:, None] < 0,
                         tensor.alloc(0., 1, tparams['Wemb_dec'].shape[1]),
@@ -414,12 +543,54 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     logit = get_layer_constr('ff')(tparams, logit, options,
                               prefix='ff_logit', activ='linear')
 
+    return logit, next_state, dec_alphas
+
+
+# exclude UNK (index 1) from a normalized output distribution, given as
+# probabilities or log-probabilities (the other words are not renormalized)
+def _suppress_unk(next_probs, log_probs=False):
+    if log_probs:
+        return tensor.set_subtensor(next_probs[:, 1], numpy.float32(-numpy.inf))
+    return tensor.set_subtensor(next_probs[:, 1], numpy.float32(0.))
+
+
+# build a batched sampler
+# with log_probs=True, f_next returns log-probabilities instead of probabilities
+# (use gen_sample(..., log_probs=True)); with suppress_unk=True, UNK gets
+# probability 0 in the output of f_next
+def build_sampler(tparams, options, use_noise, trng, return_alignment=False,
+                  log_probs=False, suppress_unk=False):
+
+    x = tensor.tensor3('x', dtype='int64')
+    x.tag.test_value = (numpy.random.rand(1, 5, 10)*100).astype('int64')
+    x_mask = tensor.matrix('x_mask', dtype='float32')
+    x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype('float32')
+
+    init_state, ctx = _build_sampler_init(tparams, options, use_noise, trng, x, x_mask)
+
+    print >>sys.stderr, 'Building f_init...',
+    outs = [init_state, ctx]
+    f_init = theano.function([x, x_mask], outs, name='f_init', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    # x: 1 x 1
+    y = tensor.vector('y_sampler', dtype='int64')
+    init_state = tensor.matrix('init_state', dtype='float32')
+
+    logit, next_state, dec_alphas = _build_sampler_step(tparams, options, y, ctx, init_state, x_mask)
+
     # compute the softmax probability
     next_probs = tensor.nnet.softmax(logit)
 
     # sample from softmax distribution to get the sample
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
 
+    if log_probs:
+        next_probs = log_softmax(logit)
+
+    if suppress_unk:
+        next_probs = _suppress_unk(next_probs, log_probs=log_probs)
+
     # compile a function to do the whole thing above, next word probability,
     # sampled word for the next target, next hidden state to be used
     print >>sys.stderr, 'Building f_next..',
@@ -435,185 +606,83 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     return f_init, f_next
 
 
-# generate sample, either with stochastic sampling or beam search. Note that,
-# this function iteratively calls f_init and f_next functions.
-def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
-               stochastic=True, argmax=False, return_alignment=False, suppress_unk=False,
-               return_hyp_graph=False):
-    """
-    :param f_init: *list* of f_init functions. Each: state0, ctx0 = f_init(x)
-    :param f_next: *list* of f_next functions. Each: next_prob, next_word, next_state = f_next(word, ctx, state)
-    :param x: a [BATCHED?] sequence of word ids followed by 0 (0 = eos id)
-    :param trng: theano RandomStreams
-    :param k: beam width
-    :param maxlen: max length of a sentences
-    :param stochastic: bool, do stochastic sampling
-    :param argmax: bool, something to do with argmax of highest word prob...
-    :param return_alignment:
-    :param suppress_unk:
-    :param return_hyp_graph:
-    :return:
-    """
-
-    # k is the beam size we have
-    if k > 1:
-        assert not stochastic, \
-            'Beam search does not support stochastic sampling'
-
-    sample = []
-    sample_score = []
-    sample_word_probs = []
-    alignment = []
-    hyp_graph = None
-    if stochastic:
-        sample_score = 0
-    if return_hyp_graph:
-        from hypgraph import HypGraph
-        hyp_graph = HypGraph()
-
-    live_k = 1
-    dead_k = 0
-
-    hyp_samples = [[]] * live_k
-    word_probs = [[]] * live_k
-    hyp_scores = numpy.zeros(live_k).astype('float32')
-    hyp_states = []
+# build a sampler that evaluates all models of an ensemble in a single call.
+# To gen_sample, the result looks like a single model: the decoder states and
+# contexts of the members are concatenated along their last axis, and f_next
+# returns the combined log-probabilities (use gen_sample(..., log_probs=True)).
+# combine='mean_log' averages the log-probabilities of the members,
+# combine='log_mean' takes the log of their averaged probabilities.
+def build_ensemble_sampler(tparams_list, options_list, use_noise, trng, combine='mean_log', return_alignment=False,
+                           suppress_unk=False):
+
+    assert combine in ('mean_log', 'log_mean'), 'unknown ensemble combination: %s' % combine
+
+    num_models = len(tparams_list)
+
+    x = tensor.tensor3('x', dtype='int64')
+    x.tag.test_value = (numpy.random.rand(1, 5, 10)*100).astype('int64')
+    x_mask = tensor.matrix('x_mask', dtype='float32')
+    x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype('float32')
+
+    init_states = []
+    ctxs = []
+    for tparams, options in zip(tparams_list, options_list):
+        init_state, ctx = _build_sampler_init(tparams, options, use_noise, trng, x, x_mask)
+        init_states.append(init_state)
+        ctxs.append(ctx)
+
+    print >>sys.stderr, 'Building f_init (ensemble of %d)...' % num_models,
+    outs = [concatenate(init_states, axis=1), concatenate(ctxs, axis=2)]
+    f_init = theano.function([x, x_mask], outs, name='f_init', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    y = tensor.vector('y_sampler', dtype='int64')
+    ctx = tensor.tensor3('ctx_sampler', dtype='float32')
+    init_state = tensor.matrix('init_state', dtype='float32')
+
+    log_probs = []
+    next_states = []
+    dec_alphas = []
+    state_offset = 0
+    ctx_offset = 0
+    for tparams, options in zip(tparams_list, options_list):
+        dim = options['dim']
+        ctxdim = 2 * options['dim']
+        logit, next_state, alphas = _build_sampler_step(tparams, options, y,
+                                                        ctx[:, :, ctx_offset:ctx_offset+ctxdim],
+                                                        init_state[:, state_offset:state_offset+dim],
+                                                        x_mask)
+        log_probs.append(log_softmax(logit))
+        next_states.append(next_state)
+        dec_alphas.append(alphas)
+        state_offset += dim
+        ctx_offset += ctxdim
+
+    if combine == 'mean_log':
+        next_log_probs = sum(log_probs) / num_models
+    else:
+        log_probs = tensor.stack(log_probs)
+        max_log_probs = log_probs.max(axis=0)
+        next_log_probs = max_log_probs + \
+            tensor.log(tensor.exp(log_probs - max_log_probs[None, :, :]).mean(axis=0))
+
+    # sample from the (renormalized) combined distribution
+    next_sample = trng.multinomial(pvals=tensor.nnet.softmax(next_log_probs)).argmax(1)
+
+    if suppress_unk:
+        next_log_probs = _suppress_unk(next_log_probs, log_probs=True)
+
+    print >>sys.stderr, 'Building f_next (ensemble of %d)..' % num_models,
+    inps = [y, ctx, init_state, x_mask]
+    outs = [next_log_probs, next_sample, concatenate(next_states, axis=1)]
+
     if return_alignment:
-        hyp_alignment = [[] for _ in xrange(live_k)]
-
-    # for ensemble decoding, we keep track of states and probability distribution
-    # for each model in the ensemble
-    num_models = len(f_init)
-    next_state = [None]*num_models
-    ctx0 = [None]*num_models
-    next_p = [None]*num_models
-    dec_alphas = [None]*num_models
-    # get initial state of decoder rnn and encoder context
-    for i in xrange(num_models):
-        ret = f_init[i](x)
-        next_state[i] = ret[0]
-        ctx0[i] = ret[1]
-    next_w = -1 * numpy.ones((1,)).astype('int64')  # bos indicator
-
-    # x is a sequence of word ids followed by 0, eos id
-    for ii in xrange(maxlen):
-        for i in xrange(num_models):
-            ctx = numpy.tile(ctx0[i], [live_k, 1])
-            inps = [next_w, ctx, next_state[i]]
-            ret = f_next[i](*inps)
-            # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
-            next_p[i], next_w_tmp, next_state[i] = ret[0], ret[1], ret[2]
-            if return_alignment:
-                dec_alphas[i] = ret[3]
-
-            if suppress_unk:
-                next_p[i][:,1] = -numpy.inf
-        if stochastic:
-            if argmax:
-                nw = sum(next_p)[0].argmax()
-            else:
-                nw = next_w_tmp[0]
-            sample.append(nw)
-            sample_score += numpy.log(next_p[0][0, nw])
-            if nw == 0:
-                break
-        else:
-            cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
-            probs = sum(next_p)/num_models
-            cand_flat = cand_scores.flatten()
-            probs_flat = probs.flatten()
-            ranks_flat = cand_flat.argpartition(k-dead_k-1)[:(k-dead_k)]
-
-            # averaging the attention weights accross models
-            if return_alignment:
-                mean_alignment = sum(dec_alphas)/num_models
-
-            voc_size = next_p[0].shape[1]
-            # index of each k-best hypothesis
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
-
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(k-dead_k).astype('float32')
-            new_word_probs = []
-            new_hyp_states = []
-            if return_alignment:
-                # holds the history of attention weights for each time step for each of the surviving hypothesis
-                # dimensions (live_k * target_words * source_hidden_units]
-                # at each time step we append the attention weights corresponding to the current target word
-                new_hyp_alignment = [[] for _ in xrange(k-dead_k)]
-
-            # ti -> index of k-best hypothesis
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti]+[wi])
-                new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()])
-                new_hyp_scores[idx] = copy.copy(costs[idx])
-                new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                if return_alignment:
-                    # get history of attention weights for the current hypothesis
-                    new_hyp_alignment[idx] = copy.copy(hyp_alignment[ti])
-                    # extend the history with current attention weights
-                    new_hyp_alignment[idx].append(mean_alignment[ti])
-
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            word_probs = []
-            if return_alignment:
-                hyp_alignment = []
-
-            # sample and sample_score hold the k-best translations and their scores
-            for idx in xrange(len(new_hyp_samples)):
-                if return_hyp_graph:
-                    word, history = new_hyp_samples[idx][-1], new_hyp_samples[idx][:-1]
-                    score = new_hyp_scores[idx]
-                    word_prob = new_word_probs[idx][-1]
-                    hyp_graph.add(word, history, word_prob=word_prob, cost=score)
-                if new_hyp_samples[idx][-1] == 0:
-                    sample.append(new_hyp_samples[idx])
-                    sample_score.append(new_hyp_scores[idx])
-                    sample_word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        alignment.append(new_hyp_alignment[idx])
-                    dead_k += 1
-                else:
-                    new_live_k += 1
-                    hyp_samples.append(new_hyp_samples[idx])
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(new_hyp_states[idx])
-                    word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        hyp_alignment.append(new_hyp_alignment[idx])
-            hyp_scores = numpy.array(hyp_scores)
-
-            live_k = new_live_k
-
-            if new_live_k < 1:
-                break
-            if dead_k >= k:
-                break
-
-            next_w = numpy.array([w[-1] for w in hyp_samples])
-            next_state = [numpy.array(state) for state in zip(*hyp_states)]
-
-    if not stochastic:
-        # dump every remaining one
-        if live_k > 0:
-            for idx in xrange(live_k):
-                sample.append(hyp_samples[idx])
-                sample_score.append(hyp_scores[idx])
-                sample_word_probs.append(word_probs[idx])
-                if return_alignment:
-                    alignment.append(hyp_alignment[idx])
-
-    if not return_alignment:
-        alignment = [None for i in range(len(sample))]
-
-    return sample, sample_score, sample_word_probs, alignment, hyp_graph
+        outs.append(sum(dec_alphas) / num_models)
+
+    f_next = theano.function(inps, outs, name='f_next', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    return f_init, f_next
 
 
 # calculate the log probablities on a given corpus using translation model
@@ -648,154 +717,13 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, norma
             lengths = numpy.array([numpy.count_nonzero(s) for s in y_mask.T])
             pprobs /= lengths
 
-        for pp in pprobs:
-            probs.append(pp)
+        probs.extend(pprobs)
 
-        if numpy.isnan(numpy.mean(probs)):
+        # only check the new batch; checking the mean of all probs so far is quadratic in the set size
+        if numpy.isnan(pprobs).any():
             ipdb.set_trace()
 
         if verbose:
             print >>sys.stderr, '%d samples computed' % n_done
 
     return numpy.array(probs), alignments_json
-
-
-# generate sample, either with stochastic sampling or beam search. Note that,
-# this function iteratively calls f_init and f_next functions.
-def gen_par_sample(f_init, f_next, x, x_mask, k=1, maxlen=30, suppress_unk=False):
-    """
-    :param f_init: *list* of f_init functions. Each: state0, ctx0 = f_init(x, X_MASK)
-    :param f_next: *list* of f_next functions. Each: next_prob, next_word, next_state = f_next(word, ctx, state, X_MASK)
-    :param x: a BATCHED sequence of word ids, each terminated by 0 (0 = eos id)
-    :param k: beam width
-    :param maxlen: max length of a sentences
-    :param suppress_unk:
-    :return:
-    """
-    # k is the beam size we have
-    batch_size = x.shape[2]
-    sample = [[] for i in range(batch_size)]
-    sample_score = [[] for i in range(batch_size)]
-    sample_word_probs = [[] for i in range(batch_size)]
-    live_k = [1] * batch_size
-    dead_k = [0] * batch_size # num completed sentences
-
-    hyp_samples = [[]] * batch_size * 1 # wrote 1 explictly to denote 1 live_k per sent
-    word_probs = [[]] * batch_size * 1
-    hyp_scores = numpy.zeros(batch_size * 1).astype('float32')
-    # for ensemble decoding, we keep track of states and probability distribution
-    # for each model in the ensemble
-    num_models = len(f_init)
-    next_state = [None]*num_models
-    ctx0 = [None]*num_models # initial context
-    next_ps = [None]*num_models
-    # get initial state of decoder rnn and encoder context
-    for i in xrange(num_models):
-        ret = f_init[i](x, x_mask)
-        next_state[i] = ret[0]
-        ctx0[i] = ret[1]
-    next_w = -1 * numpy.ones((batch_size,)).astype('int64')  # bos (beginning of sent) indicator
-
-    # -- OK --
-    # x is a sequence of word ids followed by 0, eos id
-    for ii in xrange(maxlen):
-        for i in xrange(num_models):
-            # Encoder context does not change, just need to know how many are required
-            # numpy.tile(ctx0[i], [live_k, 1]) -- prev: simply repeat context live_k times (and propagate up a dimension)
-            # New: tile each context per sent, then concat them together.
-            ctx = numpy.concatenate([numpy.tile(ctx0[i][:,sent_idx:sent_idx+1], [live_k_per_sent, 1]) for sent_idx, live_k_per_sent in enumerate(live_k)], axis = 1)
-            mask = numpy.concatenate([numpy.tile(x_mask[:,sent_idx:sent_idx+1], [1, live_k_per_sent]) for sent_idx, live_k_per_sent in enumerate(live_k)], axis = 1)
-            
-            inps = [next_w, ctx, next_state[i], mask] # prepare parameters for f_next
-            ret = f_next[i](*inps)  
-            # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
-            next_ps[i], next_ws_tmp, next_state[i] = ret[0], ret[1], ret[2]
-            if suppress_unk:
-                next_ps[i][:, 1] = -numpy.inf
-        # We do the same thing with the same flat structures. just our interpretations now differ!
-        voc_size = next_ps[0].shape[1] # should be constant
-        cand_scores = hyp_scores[:, None] - sum(numpy.log(next_ps))
-        probs = sum(next_ps)/num_models
-        cand_flat = cand_scores.flatten()
-        probs_flat = probs.flatten()
-        # OK argpartition in pieces.
-        # Wait if we are argpartitioning across sent boundaries, two words can come out of a single hyp! wait that's ok though! great.
-        #ranks_flat = cand_flat.argpartition(k-dead_k-1)[:(k-dead_k)] # Basically, top k-dead_k (INDICES OF)
-        sent_boundaries = numpy.cumsum([0] + live_k) * voc_size # Mult by vocab size because the softmaxes are flattened too
-        # start, end = start index and end index for a sentence (not inclusive on end)
-        # argpartition each piece. add 'start' to it because np thinks its a new small array, so remember the start idx
-        ranks_flat = numpy.concatenate([start + cand_flat[start:end].argpartition(k - dead_per_sent-1)[:(k-dead_per_sent)] 
-                                          for start, end, dead_per_sent in zip(sent_boundaries[:-1], sent_boundaries[1:], dead_k)], axis = 0)
-        
-        # averaging the attention weights across models
-        # index of each k-best hypothesis
-        trans_indices = ranks_flat / voc_size # Hmm. Which element of beam did it come from
-        word_indices = ranks_flat % voc_size # and what word was it. That implies the cand scores are the entire softmax...
-        costs = cand_flat[ranks_flat] # Get the probs
-        new_hyp_samples = [] 
-        new_hyp_scores = numpy.zeros(len(ranks_flat)).astype('float32')
-        new_word_probs = []
-        new_hyp_states = []
-        # ti -> index of k-best hypothesis
-        for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-            # hyps/etc will proceed in order, since ranks flat goes in order of sentences.
-            new_hyp_samples.append(hyp_samples[ti]+[wi]) # looks like appending the next word to the existing hypothesis, and adding that to a list of new hypotheses
-            new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()]) # Not sure, I think same thing but for probabilities. the '+' -- the second element is a list so probably still a list of word probs over the hyp
-            new_hyp_scores[idx] = copy.copy(costs[idx]) # the total cost with the new prob added
-            new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)]) # copy the state over too
-        # check the finished samples
-        new_live_k = [0] * batch_size
-        hyp_samples = []
-        hyp_scores = []
-        hyp_states = []
-        word_probs = []
-        # sample and sample_score hold the k-best translations and their scores
-        # In the flattened 'sample' array, markers between sentences will be based on the cumulative sum of live_ks
-        #ipdb.set_trace()
-
-        live_k_tmp = [k-dead_k_sent for dead_k_sent in dead_k]
-        sample_sent_boundaries = numpy.cumsum(live_k_tmp)
-        sent_idx = 0
-        for idx in xrange(len(new_hyp_samples)):
-            # Need to know which sent it came from
-            while idx >= sample_sent_boundaries[sent_idx]:
-                sent_idx += 1
-            if new_hyp_samples[idx][-1] == 0: # If eos (End of sent)
-                #ipdb.set_trace()
-
-                sample[sent_idx].append(new_hyp_samples[idx]) # I think 'sample' are only for finished samples
-                sample_score[sent_idx].append(new_hyp_scores[idx])
-                sample_word_probs[sent_idx].append(new_word_probs[idx])
-                dead_k[sent_idx] += 1 # finished the sent.
-            else:
-                new_live_k[sent_idx] += 1 # count live k's
-                # Live ones are flat.
-                hyp_samples.append(new_hyp_samples[idx])
-                hyp_scores.append(new_hyp_scores[idx])
-                hyp_states.append(new_hyp_states[idx])
-                word_probs.append(new_word_probs[idx])
-        hyp_scores = numpy.array(hyp_scores)
-        live_k = new_live_k
-        # Conservative break conditions...
-        if sum(new_live_k) < 1:
-            break
-        if min(dead_k) >= k:
-            break
-        next_w = numpy.array([w[-1] for w in hyp_samples])
-        next_state = [numpy.array(state) for state in zip(*hyp_states)]
-    # dump every remaining one
-    sample_sent_boundaries = numpy.cumsum(live_k)
-    sent_idx = 0
-    for idx in xrange(len(hyp_samples)):
-        while idx >= sample_sent_boundaries[sent_idx]:
-            sent_idx += 1
-        #if live_k > 0: 
-        sample[sent_idx].append(hyp_samples[idx])
-        sample_score[sent_idx].append(hyp_scores[idx])
-        sample_word_probs[sent_idx].append(word_probs[idx])
-    return sample, sample_score, sample_word_probs
-
-# My notes: doing it in par:
-# All of this stuff, topk etc, is done in numpy. Only f_next() etc are done in theano/GPU.
-# So just need some extra handling steps after-the-fact.
-# It doesn't look like there is any conflict with sending different sentences in, for f_next()
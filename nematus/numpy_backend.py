@@ -0,0 +1,302 @@
+'''
+Inference without Theano: the encoder, the conditional GRU decoder with
+attention and the readout of nmt_utils.build_sampler, computed with NumPy
+(and whatever BLAS it is linked against) from the parameters of a model.npz.
+
+build_numpy_sampler returns an f_init/f_next pair with the same inputs and
+outputs as the compiled functions of build_sampler, so it can be passed to
+gen_sample or gen_par_sample (through unmasked_sampler for the former). There
+is nothing to compile, so a decoder is ready as soon as the parameters are
+loaded, and each call only pays for the matrix products it does.
+
+Of models quantized with quantize.py, the embeddings stay in int8, and the
+other matrices are multiplied as quantized_product says (see quantize.py:
+'float32' dequantizes them once, 'blocks' and 'int8' keep them in int8, which
+takes a quarter of the memory, and are slower with NumPy). Of models
+stored in float16 (see util.cast_params), the embeddings stay in
+float16 and only the rows that are looked up are converted; the other
+matrices are converted to float32 once, as converting them for every product
+would cost more than the product itself.
+
+Only the 'gru' encoder and the 'gru_cond' decoder are supported.
+'''
+
+import numpy
+
+from quantize import QuantizedMatrix, SCALE_SUFFIX, PRODUCTS, scale_name, is_embedding
+from util import embedding_name
+
+
+def _dot(x, W):
+    # numpy.dot only calls BLAS for matrices: fold the leading axes of x into one
+    if x.ndim != 2:
+        return _dot(x.reshape(-1, x.shape[-1]), W).reshape(x.shape[:-1] + W.shape[1:])
+    if isinstance(W, QuantizedMatrix):
+        return W.rdot(x)
+    return numpy.dot(x, W)
+
+
+def _sigmoid(x):
+    # same as 1 / (1 + exp(-x)), without overflowing for large negative x
+    return 0.5 * numpy.tanh(0.5 * x) + 0.5
+
+
+def _log_softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    return x - numpy.log(numpy.exp(x).sum(axis=1, keepdims=True))
+
+
+def _softmax(x):
+    e = numpy.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _multinomial(probs, rng):
+    # one sample per row of probs
+    u = rng.uniform(size=(probs.shape[0], 1)).astype(probs.dtype)
+    sample = (probs.cumsum(axis=1) < u).sum(axis=1)
+    return numpy.minimum(sample, probs.shape[1] - 1).astype('int64')
+
+
+class NumpyModel(object):
+    """The sampler of one model (see _build_sampler_init and _build_sampler_step)."""
+
+    def __init__(self, params, options, quantized_product='float32'):
+        assert options['encoder'] == 'gru', 'unsupported encoder: %s' % options['encoder']
+        assert options['decoder'] == 'gru_cond', 'unsupported decoder: %s' % options['decoder']
+        assert quantized_product in PRODUCTS, 'unknown product for int8 matrices: %s' % quantized_product
+
+        self.options = options
+        self.params = {}
+        for k in params.keys():
+            if k.endswith(SCALE_SUFFIX):
+                continue
+            if params[k].dtype == numpy.int8 and quantized_product == 'float32' and not is_embedding(k):
+                # int8 matrix from quantize.py, dequantized once
+                self.params[k] = params[k] * params[scale_name(k)]
+            elif params[k].dtype == numpy.int8:
+                # int8 matrix from quantize.py, kept in int8 (embeddings are only looked up by row)
+                self.params[k] = QuantizedMatrix(params[k], params[scale_name(k)],
+                                                 'blocks' if quantized_product == 'float32' else quantized_product)
+            elif params[k].dtype == numpy.float16 and is_embedding(k):
+                self.params[k] = params[k]
+            else:
+                self.params[k] = numpy.asarray(params[k], dtype='float32')
+        self.dim = options['dim']
+
+        # at test time, models trained before version 0.1 scale by the retain
+        # probabilities instead of using dropout
+        self.retain_emb = self.retain_hidden = self.retain_source = self.retain_target = 1.
+        if options['use_dropout'] and options['model_version'] < 0.1:
+            self.retain_emb = 1 - options['dropout_embedding']
+            self.retain_hidden = 1 - options['dropout_hidden']
+            self.retain_source = 1 - options['dropout_source']
+            self.retain_target = 1 - options['dropout_target']
+
+        # projection of the context of the last single sentence seen by f_init,
+        # reused while f_next is called with copies of it (see _project_context)
+        self._ctx = None
+        self._pctx = None
+
+    def _embed(self, name, idx):
+        # float32 rows of an embedding matrix (int8, float16 or float32)
+        return numpy.asarray(self.params[name][idx], dtype='float32')
+
+    def _ff(self, x, prefix):
+        return _dot(x, self.params[prefix + '_W']) + self.params[prefix + '_b']
+
+    def _gru(self, emb, mask, prefix):
+        p = self.params
+        dim = p[prefix + '_Ux'].shape[1]
+        rh = self.retain_hidden
+
+        state_below_ = _dot(emb * self.retain_emb, p[prefix + '_W']) + p[prefix + '_b']
+        state_belowx = _dot(emb * self.retain_emb, p[prefix + '_Wx']) + p[prefix + '_bx']
+
+        h = numpy.zeros((emb.shape[1], dim), dtype='float32')
+        states = numpy.empty((emb.shape[0], emb.shape[1], dim), dtype='float32')
+        for t in xrange(emb.shape[0]):
+            preact = _sigmoid(_dot(h * rh, p[prefix + '_U']) + state_below_[t])
+            r = preact[:, :dim]
+            u = preact[:, dim:]
+            h_ = numpy.tanh(_dot(h * rh, p[prefix + '_Ux']) * r + state_belowx[t])
+            h_ = u * h + (1. - u) * h_
+            m = mask[t][:, None]
+            h = m * h_ + (1. - m) * h
+            states[t] = h
+        return states
+
+    def encode(self, x, x_mask):
+        """Context of the source sentences x [factors, time, batch]: [time, batch, 2*dim]."""
+        n_timesteps, n_samples = x.shape[1], x.shape[2]
+        emb = numpy.concatenate([self._embed(embedding_name(factor), x[factor].flatten())
+                                 for factor in xrange(self.options['factors'])], axis=1)
+        emb = emb.reshape([n_timesteps, n_samples, self.options['dim_word']]) * self.retain_source
+
+        proj = self._gru(emb, x_mask, 'encoder')
+        projr = self._gru(emb[::-1], x_mask[::-1], 'encoder_r')
+        return numpy.concatenate([proj, projr[::-1]], axis=2)
+
+    def init(self, x, x_mask):
+        ctx = self.encode(x, x_mask)
+        ctx_mean = ctx.mean(0) * self.retain_hidden
+        init_state = numpy.tanh(self._ff(ctx_mean, 'ff_state'))
+        return init_state, ctx
+
+    def _project_context(self, ctx):
+        # gen_sample calls f_next with the context of one sentence, copied for
+        # each live hypothesis; its projection is then only computed once
+        p = self.params
+        cached = self._ctx
+        if cached is not None and ctx.shape[0] == cached.shape[0] and ctx.shape[2] == cached.shape[2] \
+                and numpy.array_equal(ctx, numpy.broadcast_to(cached, ctx.shape)):
+            return numpy.broadcast_to(self._pctx, ctx.shape[:2] + self._pctx.shape[2:])
+        return _dot(ctx * self.retain_hidden, p['decoder_Wc_att']) + p['decoder_b_att']
+
+    def remember_context(self, ctx):
+        if ctx.shape[1] == 1:
+            self._ctx = ctx
+            self._pctx = _dot(ctx * self.retain_hidden, self.params['decoder_Wc_att']) + \
+                self.params['decoder_b_att']
+        else:
+            self._ctx = self._pctx = None
+
+    def step(self, y, ctx, state, x_mask):
+        """Unnormalized scores of the next word, next decoder state and attention weights [batch, time]."""
+        p = self.params
+        dim = self.dim
+        rh = self.retain_hidden
+
+        # if it's the first word, the embedding is all zero (indicated by -1)
+        emb = self._embed('Wemb_dec', numpy.maximum(y, 0)) * (y >= 0)[:, None]
+        emb = emb * self.retain_target
+
+        # conditional GRU, first transition
+        preact1 = _sigmoid(_dot(state * rh, p['decoder_U']) +
+                           _dot(emb * self.retain_emb, p['decoder_W']) + p['decoder_b'])
+        r1 = preact1[:, :dim]
+        u1 = preact1[:, dim:]
+        h1 = numpy.tanh(_dot(state * rh, p['decoder_Ux']) * r1 +
+                        _dot(emb * self.retain_emb, p['decoder_Wx']) + p['decoder_bx'])
+        h1 = u1 * state + (1. - u1) * h1
+
+        # attention
+        pctx = self._project_context(ctx)
+        pctx = numpy.tanh(pctx + _dot(h1 * rh, p['decoder_W_comb_att'])[None, :, :])
+        alpha = _dot(pctx * rh, p['decoder_U_att'])[:, :, 0] + p['decoder_c_tt']
+        alpha = numpy.exp(alpha - alpha.max(0, keepdims=True)) * x_mask
+        alpha /= alpha.sum(0, keepdims=True)
+        ctxs = (ctx * alpha[:, :, None]).sum(0)
+
+        # second transition
+        preact2 = _sigmoid(_dot(h1 * rh, p['decoder_U_nl']) + p['decoder_b_nl'] +
+                           _dot(ctxs * rh, p['decoder_Wc']))
+        r2 = preact2[:, :dim]
+        u2 = preact2[:, dim:]
+        h2 = numpy.tanh((_dot(h1 * rh, p['decoder_Ux_nl']) + p['decoder_bx_nl']) * r2 +
+                        _dot(ctxs * rh, p['decoder_Wcx']))
+        next_state = u2 * h1 + (1. - u2) * h2
+
+        # readout
+        logit = numpy.tanh(self._ff(next_state * rh, 'ff_logit_lstm') +
+                           self._ff(emb * self.retain_emb, 'ff_logit_prev') +
+                           self._ff(ctxs * rh, 'ff_logit_ctx'))
+        logit = self._ff(logit * rh, 'ff_logit')
+
+        return logit, next_state, alpha.T
+
+
+def _suppress_unk(next_probs, log_probs=False):
+    next_probs[:, 1] = -numpy.inf if log_probs else 0.
+    return next_probs
+
+
+# NumPy equivalent of nmt_utils.build_sampler, for a model given by its
+# parameters (e.g. numpy.load('model.npz')) and options
+def build_numpy_sampler(params, options, return_alignment=False, log_probs=False, suppress_unk=False,
+                        seed=1234, quantized_product='float32'):
+
+    model = NumpyModel(params, options, quantized_product)
+    rng = numpy.random.RandomState(seed)
+
+    def f_init(x, x_mask):
+        init_state, ctx = model.init(x, x_mask.astype('float32'))
+        model.remember_context(ctx)
+        return [init_state, ctx]
+
+    def f_next(y, ctx, state, x_mask):
+        logit, next_state, dec_alphas = model.step(y, ctx, state, x_mask.astype('float32'))
+        next_probs = _softmax(logit)
+        next_sample = _multinomial(next_probs, rng)
+        if log_probs:
+            next_probs = _log_softmax(logit)
+        if suppress_unk:
+            next_probs = _suppress_unk(next_probs, log_probs=log_probs)
+        outs = [next_probs, next_sample, next_state]
+        if return_alignment:
+            outs.append(dec_alphas)
+        return outs
+
+    return f_init, f_next
+
+
+# NumPy equivalent of nmt_utils.build_ensemble_sampler: decoder states and
+# contexts of the members are concatenated along their last axis, f_next
+# returns the combined log-probabilities
+def build_numpy_ensemble_sampler(params_list, options_list, combine='mean_log', return_alignment=False,
+                                 suppress_unk=False, seed=1234, quantized_product='float32'):
+
+    assert combine in ('mean_log', 'log_mean'), 'unknown ensemble combination: %s' % combine
+
+    models = [NumpyModel(params, options, quantized_product)
+              for params, options in zip(params_list, options_list)]
+    num_models = len(models)
+    rng = numpy.random.RandomState(seed)
+
+    def f_init(x, x_mask):
+        x_mask = x_mask.astype('float32')
+        init_states = []
+        ctxs = []
+        for model in models:
+            init_state, ctx = model.init(x, x_mask)
+            model.remember_context(ctx)
+            init_states.append(init_state)
+            ctxs.append(ctx)
+        return [numpy.concatenate(init_states, axis=1), numpy.concatenate(ctxs, axis=2)]
+
+    def f_next(y, ctx, state, x_mask):
+        x_mask = x_mask.astype('float32')
+        log_probs = []
+        next_states = []
+        dec_alphas = []
+        state_offset = 0
+        ctx_offset = 0
+        for model in models:
+            dim = model.dim
+            logit, next_state, alphas = model.step(y, ctx[:, :, ctx_offset:ctx_offset+2*dim],
+                                                   state[:, state_offset:state_offset+dim], x_mask)
+            log_probs.append(_log_softmax(logit))
+            next_states.append(next_state)
+            dec_alphas.append(alphas)
+            state_offset += dim
+            ctx_offset += 2 * dim
+
+        if combine == 'mean_log':
+            next_log_probs = sum(log_probs) / num_models
+        else:
+            log_probs = numpy.array(log_probs)
+            max_log_probs = log_probs.max(axis=0)
+            next_log_probs = max_log_probs + \
+                numpy.log(numpy.exp(log_probs - max_log_probs[None, :, :]).mean(axis=0))
+
+        next_sample = _multinomial(_softmax(next_log_probs), rng)
+
+        if suppress_unk:
+            next_log_probs = _suppress_unk(next_log_probs, log_probs=True)
+
+        outs = [next_log_probs, next_sample, numpy.concatenate(next_states, axis=1)]
+        if return_alignment:
+            outs.append(sum(dec_alphas) / num_models)
+        return outs
+
+    return f_init, f_next
@@ -5,120 +5,273 @@ Optimizers
 import numpy
 import theano
 import theano.tensor as tensor
-
-from theano_util import itemlist
+from theano.compile.ops import Shape_i
+from theano.gof.graph import inputs as graph_inputs, io_toposort
+from theano.tensor.elemwise import DimShuffle
+from theano.tensor.extra_ops import Unique
+from theano.tensor.subtensor import AdvancedSubtensor1
 
 
 # Calling convention:
 # f_grad_shared, f_update = name(hyperp, tparams, grads, inputs (list), cost)
 # with profile as an optional argument
+#
+# With fused=True, a single function is returned instead:
+# f_train_step = name(hyperp, tparams, grads, inputs (list), cost, fused=True)
+# cost = f_train_step(*(inputs + [lr]))
+# computes the cost and gradients and updates the parameters (and optimizer
+# state) in one call, without keeping the gradients in shared variables.
+# The updates are the same as those of f_grad_shared followed by f_update.
+#
+# With accumulate=True, f_grad_shared takes an additional weight after the
+# inputs and adds the weighted gradients to the shared variables instead of
+# overwriting them; f_update uses the weighted mean of the gradients collected
+# since the last update, and resets them. Weighting each minibatch by its
+# number of sentences gives the gradient of one batch made of all of them.
+#
+# sparse (as returned by gradients) maps the names of parameters that are
+# indexed by the vocabulary (embeddings, output layer) to the axis of the
+# vocabulary and the indices of the slices along it that the batch looks up,
+# i.e. the words seen in the batch; their gradients in grads only cover these
+# slices. Only these slices are updated, together with their optimizer state
+# ("lazy" updates: the state of the other rows is not decayed). Adam then keeps
+# a step count per row for the bias correction, so that rarely seen rows are
+# corrected for the updates they actually received. With sgd, sparse updates
+# give the same result as dense ones.
+
+
+def _lookups(cost, p, axis):
+    # the nodes of the graph of cost that look up slices of p along axis (p[idx],
+    # or p.T[idx] for axis 1, which is also how Theano builds p[:, idx])
+    views = set([p]) if axis == 0 else set()
+    lookups = []
+    for node in io_toposort(graph_inputs([cost]), [cost]):
+        for i, var in enumerate(node.inputs):
+            if var is not p and var not in views:
+                continue
+            if var is p and axis == 1 and isinstance(node.op, DimShuffle) and tuple(node.op.new_order) == (1, 0):
+                views.add(node.outputs[0])
+            elif var in views and i == 0 and isinstance(node.op, AdvancedSubtensor1):
+                lookups.append(node)
+            elif not isinstance(node.op, (tensor.Shape, Shape_i)):
+                raise ValueError('sparse update of {0}: the cost uses it other than by looking up words (e.g. '
+                                 'in weight decay or the full softmax)'.format(p.name))
+    if not lookups:
+        raise ValueError('sparse update of {0}: the cost does not look up any words in it'.format(p.name))
+    return lookups
+
+
+def _merge_rows(indices, rows):
+    # unique indices, and the sum of the rows of each
+    unique, inverse = Unique(return_inverse=True)(indices)
+    shape = [unique.shape[0]] + [rows.shape[i] for i in xrange(1, rows.ndim)]
+    return unique, tensor.inc_subtensor(tensor.zeros(shape, dtype=rows.dtype)[inverse], rows)
+
+
+def gradients(cost, tparams, sparse=None):
+    """The gradients of cost w.r.t. tparams, and the sparse argument of the optimizers.
+
+    sparse maps parameter names to the axis of the vocabulary (see
+    nmt_utils.sparse_update_params). The gradient of these parameters is taken
+    w.r.t. the slices that the cost looks up, so it is never computed for the
+    whole vocabulary: its row i is the gradient of the slice indices[i] (the
+    indices are unique), and {name: (axis, indices)} is returned for the
+    optimizer.
+    """
+    sparse = dict((k, axis) for k, axis in (sparse or {}).iteritems() if k in tparams)
+    lookups = dict((k, _lookups(cost, tparams[k], axis)) for k, axis in sparse.iteritems())
+
+    wrt = []
+    for k, p in tparams.iteritems():
+        wrt += [node.outputs[0] for node in lookups[k]] if k in sparse else [p]
+    grads = iter(tensor.grad(cost, wrt=wrt))
+
+    result = []
+    indices = {}
+    for k, p in tparams.iteritems():
+        if k not in sparse:
+            result.append(next(grads))
+            continue
+        idx = tensor.concatenate([tensor.cast(node.inputs[1], 'int64') for node in lookups[k]])
+        rows = tensor.concatenate([next(grads) for _ in lookups[k]])
+        idx, rows = _merge_rows(idx, rows)
+        result.append(rows)
+        indices[k] = (sparse[k], idx)
+    return result, indices
+
+
+def _gradients(tparams, grads, inp, cost, profile=False, fused=False, accumulate=False, sparse=None):
+    # returns f_grad_shared (None if fused), the gradients as seen by the update,
+    # the updates that f_update has to apply to the gradient buffers, and sparse
+    # as seen by the update. The rows of sparse gradients (and their indices)
+    # are kept in buffers whose size changes with the batch.
+    sparse = sparse or {}
+    if fused:
+        if accumulate:
+            raise ValueError('gradient accumulation needs separate f_grad_shared and f_update')
+        return None, grads, [], sparse
 
-def adam(lr, tparams, grads, inp, cost, beta1=0.9, beta2=0.999, e=1e-8, profile=False):
+    gshared = []
+    ishared = {}
+    for k, p in tparams.iteritems():
+        if k in sparse:
+            shape = list(p.get_value().shape)
+            del shape[sparse[k][0]]
+            gshared.append(theano.shared(numpy.zeros([0] + shape, dtype=p.dtype), name='%s_grad' % k))
+            ishared[k] = theano.shared(numpy.zeros(0, dtype='int64'), name='%s_grad_indices' % k)
+        else:
+            gshared.append(theano.shared(p.get_value() * numpy.float32(0.), name='%s_grad' % k))
 
-    gshared = [theano.shared(p.get_value() * 0., name='%s_grad' % k)
-               for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+    if not accumulate:
+        gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+        gsup += [(ishared[k], sparse[k][1]) for k in ishared]
+        f_grad_shared = theano.function(inp, cost, updates=gsup, profile=profile)
+        return f_grad_shared, gshared, [], dict((k, (sparse[k][0], ishared[k])) for k in ishared)
 
-    f_grad_shared = theano.function(inp, cost, updates=gsup, profile=profile)
+    weight = tensor.scalar(name='grad_weight')
+    weight_sum = theano.shared(numpy.float32(0.), name='grad_weight_sum')
+    gsup = []
+    reset = []
+    update_grads = []
+    update_sparse = {}
+    for k, gs, g in zip(tparams.keys(), gshared, grads):
+        if k in sparse:
+            # collect the rows of all minibatches; rows of the same word are added up by f_update
+            gsup.append((gs, tensor.concatenate([gs, weight * g])))
+            gsup.append((ishared[k], tensor.concatenate([ishared[k], sparse[k][1]])))
+            reset += [(gs, gs[:0]), (ishared[k], ishared[k][:0])]
+            idx, rows = _merge_rows(ishared[k], gs)
+            update_grads.append(rows / weight_sum)
+            update_sparse[k] = (sparse[k][0], idx)
+        else:
+            gsup.append((gs, gs + weight * g))
+            reset.append((gs, gs * numpy.float32(0.)))
+            update_grads.append(gs / weight_sum)
+    gsup.append((weight_sum, weight_sum + weight))
+    f_grad_shared = theano.function(inp + [weight], cost, updates=gsup, profile=profile)
 
-    updates = []
+    reset.append((weight_sum, numpy.float32(0.)))
+    return f_grad_shared, update_grads, reset, update_sparse
+
+
+def _take(x, idx, axis):
+    return x[idx] if axis == 0 else x[(slice(None),) * axis + (idx,)]
+
+
+def _view(x, idx, axis):
+    # the part of x that is updated: all of it, or the slices idx along axis
+    return x if idx is None else _take(x, idx, axis)
+
+
+def _store(x, idx, axis, value):
+    # the update of x that writes value (from _view) back
+    if idx is None:
+        return x, value
+    return x, tensor.set_subtensor(_take(x, idx, axis), value)
+
+
+def _sparse_params(tparams, grads, sparse):
+    # yield (name, parameter, gradient of _view(parameter, idx, axis), updated indices or None, axis)
+    for (k, p), g in zip(tparams.iteritems(), grads):
+        if k not in sparse:
+            yield k, p, g, None, None
+        else:
+            axis, idx = sparse[k]
+            # rows of the gradient, with the vocabulary moved from the first axis to axis
+            order = range(1, axis + 1) + [0] + range(axis + 1, g.ndim)
+            yield k, p, g.dimshuffle(*order), idx, axis
+
+
+def _compile(lr, inp, cost, f_grad_shared, updates, profile=False, fused=False):
+    if fused:
+        return theano.function(inp + [lr], cost, updates=updates,
+                               on_unused_input='ignore', profile=profile)
+
+    f_update = theano.function([lr], [], updates=updates,
+                               on_unused_input='ignore', profile=profile)
+
+    return f_grad_shared, f_update
+
+
+def adam(lr, tparams, grads, inp, cost, beta1=0.9, beta2=0.999, e=1e-8, profile=False,
+         fused=False, accumulate=False, sparse=None):
+
+    f_grad_shared, gshared, updates, sparse = _gradients(tparams, grads, inp, cost, profile, fused, accumulate, sparse)
 
     t_prev = theano.shared(numpy.float32(0.))
     t = t_prev + 1.
     lr_t = lr * tensor.sqrt(1. - beta2**t) / (1. - beta1**t)
 
-    for p, g in zip(tparams.values(), gshared):
+    for k, p, g, idx, axis in _sparse_params(tparams, gshared, sparse):
         m = theano.shared(p.get_value() * 0., p.name + '_mean')
         v = theano.shared(p.get_value() * 0., p.name + '_variance')
-        m_t = beta1 * m + (1. - beta1) * g
-        v_t = beta2 * v + (1. - beta2) * g**2
-        step = lr_t * m_t / (tensor.sqrt(v_t) + e)
-        p_t = p - step
-        updates.append((m, m_t))
-        updates.append((v, v_t))
-        updates.append((p, p_t))
+        m_t = beta1 * _view(m, idx, axis) + (1. - beta1) * g
+        v_t = beta2 * _view(v, idx, axis) + (1. - beta2) * g**2
+        if idx is None:
+            lr_p = lr_t
+        else:
+            # bias correction with the number of updates of each row
+            t_rows = theano.shared(numpy.zeros(p.get_value().shape[axis], dtype='float32'), p.name + '_steps')
+            t_p = t_rows[idx] + 1.
+            updates.append((t_rows, tensor.set_subtensor(t_rows[idx], t_p)))
+            lr_p = lr * tensor.sqrt(1. - beta2**t_p) / (1. - beta1**t_p)
+            lr_p = lr_p.dimshuffle(*['x' if a != axis else 0 for a in xrange(p.ndim)])
+        step = lr_p * m_t / (tensor.sqrt(v_t) + e)
+        p_t = _view(p, idx, axis) - step
+        updates.append(_store(m, idx, axis, m_t))
+        updates.append(_store(v, idx, axis, v_t))
+        updates.append(_store(p, idx, axis, p_t))
     updates.append((t_prev, t))
 
-    f_update = theano.function([lr], [], updates=updates,
-                               on_unused_input='ignore', profile=profile)
+    return _compile(lr, inp, cost, f_grad_shared, updates, profile, fused)
 
-    return f_grad_shared, f_update
+def adadelta(lr, tparams, grads, inp, cost, profile=False, fused=False, accumulate=False, sparse=None):
 
-def adadelta(lr, tparams, grads, inp, cost, profile=False):
-    zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.),
-                                  name='%s_grad' % k)
-                    for k, p in tparams.iteritems()]
-    running_up2 = [theano.shared(p.get_value() * numpy.float32(0.),
-                                 name='%s_rup2' % k)
-                   for k, p in tparams.iteritems()]
-    running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.),
-                                    name='%s_rgrad2' % k)
-                      for k, p in tparams.iteritems()]
-
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
-    rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2))
-             for rg2, g in zip(running_grads2, grads)]
-
-    f_grad_shared = theano.function(inp, cost, updates=zgup+rg2up,
-                                    profile=profile)
-
-    updir = [-tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2 + 1e-6) * zg
-             for zg, ru2, rg2 in zip(zipped_grads, running_up2,
-                                     running_grads2)]
-    ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2))
-             for ru2, ud in zip(running_up2, updir)]
-    param_up = [(p, p + ud) for p, ud in zip(itemlist(tparams), updir)]
-
-    f_update = theano.function([lr], [], updates=ru2up+param_up,
-                               on_unused_input='ignore', profile=profile)
+    f_grad_shared, zipped_grads, updates, sparse = _gradients(tparams, grads, inp, cost, profile, fused, accumulate, sparse)
 
-    return f_grad_shared, f_update
+    for k, p, zg, idx, axis in _sparse_params(tparams, zipped_grads, sparse):
+        running_up2 = theano.shared(p.get_value() * numpy.float32(0.), name='%s_rup2' % k)
+        running_grads2 = theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2' % k)
 
+        ru2 = _view(running_up2, idx, axis)
+        rg2_new = 0.95 * _view(running_grads2, idx, axis) + 0.05 * (zg ** 2)
 
-def rmsprop(lr, tparams, grads, inp, cost, profile=False):
-    zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.),
-                                  name='%s_grad' % k)
-                    for k, p in tparams.iteritems()]
-    running_grads = [theano.shared(p.get_value() * numpy.float32(0.),
-                                   name='%s_rgrad' % k)
-                     for k, p in tparams.iteritems()]
-    running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.),
-                                    name='%s_rgrad2' % k)
-                      for k, p in tparams.iteritems()]
-
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
-    rgup = [(rg, 0.95 * rg + 0.05 * g) for rg, g in zip(running_grads, grads)]
-    rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2))
-             for rg2, g in zip(running_grads2, grads)]
-
-    f_grad_shared = theano.function(inp, cost, updates=zgup+rgup+rg2up,
-                                    profile=profile)
-
-    updir = [theano.shared(p.get_value() * numpy.float32(0.),
-                           name='%s_updir' % k)
-             for k, p in tparams.iteritems()]
-    updir_new = [(ud, 0.9 * ud - 1e-4 * zg / tensor.sqrt(rg2 - rg ** 2 + 1e-4))
-                 for ud, zg, rg, rg2 in zip(updir, zipped_grads, running_grads,
-                                            running_grads2)]
-    param_up = [(p, p + udn[1])
-                for p, udn in zip(itemlist(tparams), updir_new)]
-    f_update = theano.function([lr], [], updates=updir_new+param_up,
-                               on_unused_input='ignore', profile=profile)
+        # the step uses the new running averages
+        ud = -tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2_new + 1e-6) * zg
+        updates.append(_store(running_grads2, idx, axis, rg2_new))
+        updates.append(_store(running_up2, idx, axis, 0.95 * ru2 + 0.05 * (ud ** 2)))
+        updates.append(_store(p, idx, axis, _view(p, idx, axis) + ud))
 
-    return f_grad_shared, f_update
+    return _compile(lr, inp, cost, f_grad_shared, updates, profile, fused)
 
 
-def sgd(lr, tparams, grads, inp, cost, profile=False):
-    gshared = [theano.shared(p.get_value() * 0.,
-                             name='%s_grad' % k)
-               for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+def rmsprop(lr, tparams, grads, inp, cost, profile=False, fused=False, accumulate=False, sparse=None):
 
-    f_grad_shared = theano.function(inp, cost, updates=gsup,
-                                    profile=profile)
+    f_grad_shared, zipped_grads, updates, sparse = _gradients(tparams, grads, inp, cost, profile, fused, accumulate, sparse)
 
-    pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), gshared)]
-    f_update = theano.function([lr], [], updates=pup, profile=profile)
+    for k, p, zg, idx, axis in _sparse_params(tparams, zipped_grads, sparse):
+        running_grads = theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad' % k)
+        running_grads2 = theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2' % k)
+        updir = theano.shared(p.get_value() * numpy.float32(0.), name='%s_updir' % k)
 
-    return f_grad_shared, f_update
+        rg_new = 0.95 * _view(running_grads, idx, axis) + 0.05 * zg
+        rg2_new = 0.95 * _view(running_grads2, idx, axis) + 0.05 * (zg ** 2)
+
+        # the step uses the new running averages
+        ud_new = 0.9 * _view(updir, idx, axis) - 1e-4 * zg / tensor.sqrt(rg2_new - rg_new ** 2 + 1e-4)
+        updates.append(_store(running_grads, idx, axis, rg_new))
+        updates.append(_store(running_grads2, idx, axis, rg2_new))
+        updates.append(_store(updir, idx, axis, ud_new))
+        updates.append(_store(p, idx, axis, _view(p, idx, axis) + ud_new))
+
+    return _compile(lr, inp, cost, f_grad_shared, updates, profile, fused)
+
+
+def sgd(lr, tparams, grads, inp, cost, profile=False, fused=False, accumulate=False, sparse=None):
+
+    f_grad_shared, gshared, updates, sparse = _gradients(tparams, grads, inp, cost, profile, fused, accumulate, sparse)
+
+    for k, p, g, idx, axis in _sparse_params(tparams, gshared, sparse):
+        updates.append(_store(p, idx, axis, _view(p, idx, axis) - lr * g))
 
+    return _compile(lr, inp, cost, f_grad_shared, updates, profile, fused)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Post-training int8 quantization of model parameters.
+
+Each quantized matrix is stored as int8 values together with one float32 scale
+per row (embeddings, which are looked up by row) or per column (weights that
+multiply from the right, x * W: one scale per output unit), so that the
+original matrix is approximately values * scale. Vectors and the attention
+vector decoder_U_att are kept in float32.
+
+The NumPy backend (numpy_backend.py, translate.py --backend numpy) looks up
+rows of the quantized embeddings in int8; Theano code loads the parameters
+back to float32 with dequantize_params. For the other matrices, the backend
+computes the products x * W in one of three ways (PRODUCTS, translate.py
+--quantized-product):
+
+- float32: the matrices are dequantized once when the model is loaded, so
+  decoding is as fast as with the float32 model, and takes as much memory.
+- blocks: the matrices stay in int8, and are converted to float32 block by
+  block at every product: a quarter of the memory, but slower.
+- int8: the matrices stay in int8, and each row of x is quantized to int8 as
+  well (one scale per row), so that the product is an int8 x int8 product
+  accumulated in int32, scaled once per output. This is the product an int8
+  matrix library runs; NumPy has none, and its integer products do not use
+  BLAS, so it is the slowest of the three here.
+
+NumPy (with OpenBLAS, one core) takes for 5 rows of x times a 512 x 30000
+matrix: float32 15 ms, blocks 36 ms, int8 85 ms; times a 1024 x 2048 matrix:
+float32 1.9 ms, blocks 2.8 ms, int8 11 ms. No int8 product beats float32 BLAS
+in NumPy, so the memory bandwidth saved by int8 weights only becomes a speed
+gain with an int8 matrix library. evaluate (--dev) reports the BLEU, speed
+and parameter memory of each product.
+
+With --float16, all float32 parameters are instead stored in float16 (see
+util.cast_params), as models trained with --save_float16 are.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy
+
+from util import cast_params
+
+
+SCALE_SUFFIX = '_qscale'
+
+
+def scale_name(name):
+    return name + SCALE_SUFFIX
+
+
+def is_embedding(name):
+    # source embeddings (see util.embedding_name) and target embeddings
+    return name == 'Wemb_dec' or re.match(r'^Wemb\d*$', name) is not None
+
+
+# how the NumPy backend multiplies with quantized matrices (see the module docstring)
+PRODUCTS = ('float32', 'blocks', 'int8')
+
+
+def default_quantized(params):
+    """the names of all matrices (except those with a single row or column)"""
+    return [k for k in params.keys() if not k.endswith(SCALE_SUFFIX) and params[k].ndim == 2 and
+            min(params[k].shape) > 1]
+
+
+def quantize_matrix(W, axis):
+    """int8 values and float32 scales (shaped to broadcast against them) of W, one scale
+    per row (axis=0) or per column (axis=1)"""
+    W = numpy.asarray(W, dtype='float32')
+    scale = numpy.abs(W).max(axis=1-axis, keepdims=True) / numpy.float32(127.)
+    scale[scale == 0] = 1.
+    values = numpy.clip(numpy.round(W / scale), -127, 127).astype('int8')
+    return values, scale.astype('float32')
+
+
+def quantize_params(params, names=None):
+    if names is None:
+        names = default_quantized(params)
+    quantized = OrderedDict()
+    for k in params.keys():
+        if k in names:
+            quantized[k], quantized[scale_name(k)] = quantize_matrix(params[k], axis=0 if is_embedding(k) else 1)
+        else:
+            quantized[k] = params[k]
+    return quantized
+
+
+def dequantize_params(params):
+    """float32 parameters from (possibly) quantized or float16 ones"""
+    dequantized = OrderedDict()
+    for k in params.keys():
+        if k.endswith(SCALE_SUFFIX):
+            continue
+        if params[k].dtype == numpy.int8:
+            dequantized[k] = params[k] * params[scale_name(k)]
+        elif params[k].dtype == numpy.float16:
+            dequantized[k] = params[k].astype('float32')
+        else:
+            dequantized[k] = params[k]
+    return dequantized
+
+
+class QuantizedMatrix(object):
+    """An int8 matrix with per-row or per-column scales, as used by the NumPy backend.
+
+    Row lookups (m[idx]) return float32 rows. Products x * m (rdot) are computed
+    as product says: 'blocks' converts block_size columns at a time to float32,
+    so that the whole matrix is never held in float32; 'int8' quantizes the rows
+    of x and multiplies int8 by int8 (see the module docstring).
+    """
+
+    block_size = 1024
+
+    def __init__(self, values, scale, product='blocks'):
+        assert product in ('blocks', 'int8'), 'unknown product for int8 matrices: %s' % product
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+        self.product = product
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scale.nbytes
+
+    def __getitem__(self, idx):
+        if self.scale.shape[0] == 1:
+            return self.values[idx] * self.scale[0]
+        return self.values[idx] * self.scale[idx]
+
+    def rdot(self, x):
+        # x * (values * scale): per-row scales multiply x, per-column scales the result
+        if self.scale.shape[0] != 1:
+            x = x * self.scale[:, 0]
+        if self.product == 'int8':
+            out = self._int8_dot(x)
+        else:
+            n = self.shape[1]
+            out = numpy.empty((x.shape[0], n), dtype='float32')
+            for c in xrange(0, n, self.block_size):
+                out[:, c:c+self.block_size] = numpy.dot(x, self.values[:, c:c+self.block_size].astype('float32'))
+        if self.scale.shape[0] == 1:
+            out *= self.scale
+        return out
+
+    def _int8_dot(self, x):
+        # x * values with x quantized to int8 (one scale per row); int32 accumulators do not
+        # overflow for up to 2**31 / 127**2 = 133143 inputs
+        x_values, x_scale = quantize_matrix(x, axis=0)
+        acc = numpy.einsum('ij,jk->ik', x_values, self.values, dtype='int32', casting='unsafe')
+        return acc.astype('float32') * x_scale
+
+
+def params_nbytes(params):
+    return sum(p.nbytes for p in params.values())
+
+
+def _translate(model, source, k, n_process, product):
+    translate = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'translate.py')
+    with tempfile.NamedTemporaryFile(suffix='.out', delete=False) as output:
+        pass
+    t0 = time.time()
+    subprocess.check_call([sys.executable, translate, '-m', model, '-i', source, '-o', output.name,
+                           '-k', str(k), '-p', str(n_process), '-n', '--backend', 'numpy',
+                           '--quantized-product', product])
+    seconds = time.time() - t0
+    return output.name, seconds
+
+
+def _bleu(hypothesis, reference):
+    multi_bleu = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'multi-bleu.perl')
+    with open(hypothesis) as f:
+        out = subprocess.check_output(['perl', multi_bleu, reference], stdin=f)
+    # BLEU = 26.17, 58.0/32.4/20.1/12.9 (BP=...)
+    return float(out.split(',')[0].split('=')[1])
+
+
+def evaluate(model, quantized_model, source, reference, k=5, n_process=1, products=PRODUCTS):
+    """BLEU, translation time and parameter memory (with the NumPy backend) of the model, and
+    of the quantized model with each product"""
+    from numpy_backend import NumpyModel
+    from compat import fill_options
+    from util import load_config
+
+    results = []
+    for name, product in [(model, 'float32')] + [(quantized_model, product) for product in products]:
+        options = load_config(name)
+        fill_options(options)
+        memory = params_nbytes(NumpyModel(numpy.load(name), options, quantized_product=product).params)
+        hypothesis, seconds = _translate(name, source, k, n_process, product)
+        bleu = _bleu(hypothesis, reference)
+        os.remove(hypothesis)
+        results.append(dict(model=name, product=product, bleu=bleu, seconds=seconds, memory=memory,
+                            file_size=os.path.getsize(name)))
+    return results
+
+
+def main(model, saveto, names=None, source=None, reference=None, k=5, n_process=1, float16=False,
+         products=PRODUCTS):
+    params = numpy.load(model)
+    if float16:
+        quantized = cast_params(params, 'float16')
+        sys.stderr.write('Stored parameters in float16: ')
+        # there are no int8 matrices to multiply
+        products = ['float32']
+    else:
+        quantized = quantize_params(params, names)
+        n_quantized = len([name for name in quantized.keys() if name.endswith(SCALE_SUFFIX)])
+        sys.stderr.write('Quantized {0} matrices: '.format(n_quantized))
+    sys.stderr.write('parameters {0:.1f} MB -> {1:.1f} MB\n'.format(
+        params_nbytes(params) / 2.**20, params_nbytes(quantized) / 2.**20))
+    numpy.savez(saveto, **quantized)
+    for suffix in ('.json', '.pkl'):
+        if os.path.exists(model + suffix):
+            shutil.copyfile(model + suffix, saveto + suffix)
+
+    if source is not None:
+        results = evaluate(model, saveto, source, reference, k=k, n_process=n_process, products=products)
+        base = results[0]
+        print 'model\tproduct\tBLEU\ttranslation time (s)\tparameter memory (MB)\tfile size (MB)'
+        for r in results:
+            print '{0}\t{1}\t{2:.2f}\t{3:.1f}\t{4:.1f}\t{5:.1f}'.format(
+                r['model'], r['product'], r['bleu'], r['seconds'], r['memory'] / 2.**20, r['file_size'] / 2.**20)
+        for r in results[1:]:
+            print '{0}: BLEU delta: {1:+.2f}, speed: {2:.2f}x, memory: {3:.2f}x'.format(
+                r['product'], r['bleu'] - base['bleu'], base['seconds'] / r['seconds'],
+                float(r['memory']) / base['memory'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', '-m', type=str, required=True, metavar='PATH',
+                        help="model to quantize")
+    parser.add_argument('--output', '-o', type=str, required=True, metavar='PATH',
+                        help="quantized model (its config is copied along)")
+    parser.add_argument('--params', type=str, nargs='+', default=None, metavar='NAME',
+                        help="quantize these matrices (default: all matrices except decoder_U_att)")
+    parser.add_argument('--float16', action='store_true',
+                        help="store all parameters in float16 instead of quantizing matrices to int8")
+    parser.add_argument('--dev', type=str, nargs=2, default=None, metavar=('SOURCE', 'REFERENCE'),
+                        help="translate SOURCE with the model and the quantized model (NumPy backend) and "
+                             "report the BLEU against REFERENCE, translation time and parameter memory")
+    parser.add_argument('--products', type=str, nargs='+', choices=PRODUCTS, default=PRODUCTS,
+                        help="products with which --dev translates with the quantized model (see "
+                             "translate.py --quantized-product) (default: all)")
+    parser.add_argument('-k', type=int, default=5,
+                        help="Beam size for --dev (default: %(default)s))")
+    parser.add_argument('-p', type=int, default=1,
+                        help="Number of processes for --dev (default: %(default)s))")
+
+    args = parser.parse_args()
+
+    source, reference = args.dev if args.dev else (None, None)
+    main(args.model, args.output, names=args.params, source=source, reference=reference,
+         k=args.k, n_process=args.p, float16=args.float16, products=args.products)
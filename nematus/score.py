@@ -7,66 +7,18 @@ import argparse
 import sys
 import tempfile
 
-import numpy
-import theano
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
-
 from alignment_util import combine_source_target_text_1to1
 from compat import fill_options
-from data_iterator import TextIterator
-from nmt import (pred_probs, build_model, prepare_data)
-from theano_util import init_theano_params
+from scoring import score_pairs
 from util import load_config
 
 
-def rescore_model(source_file, target_file, saveto, models, options, b, normalize, verbose, alignweights):
-
-    trng = RandomStreams(1234)
-
-    fs_log_probs = []
-
-    for model, option in zip(models, options):
-
-        # load model parameters and set theano shared variables
-        params = numpy.load(model)
-        tparams = init_theano_params(params)
-
-        trng, use_noise, \
-            x, x_mask, y, y_mask, \
-            opt_ret, \
-            cost = \
-            build_model(tparams, option)
-        inps = [x, x_mask, y, y_mask]
-        use_noise.set_value(0.)
-
-        if alignweights:
-            sys.stderr.write("\t*** Save weight mode ON, alignment matrix will be saved.\n")
-            outputs = [cost, opt_ret['dec_alphas']]
-            f_log_probs = theano.function(inps, outputs)
-        else:
-            f_log_probs = theano.function(inps, cost)
-
-        fs_log_probs.append(f_log_probs)
-
-    def _score(pairs, alignweights=False):
-        # sample given an input sequence and obtain scores
-        scores = []
-        alignments = []
-        for i, f_log_probs in enumerate(fs_log_probs):
-            score, alignment = pred_probs(f_log_probs, prepare_data, options[i], pairs, normalize=normalize, alignweights = alignweights)
-            scores.append(score)
-            alignments.append(alignment)
-
-        return scores, alignments
-
-    pairs = TextIterator(source_file.name, target_file.name,
-                         options[0]['dictionaries'][:-1], options[0]['dictionaries'][1],
-                         n_words_source=options[0]['n_words_src'], n_words_target=options[0]['n_words'],
-                         batch_size=b,
-                         maxlen=float('inf'),
-                         sort_by_length=False) #TODO: sorting by length could be more efficient, but we'd want to resort after
+def rescore_model(source_file, target_file, saveto, models, options, b, normalize, verbose, alignweights,
+                  n_process=1):
 
-    scores, alignments = _score(pairs, alignweights)
+    scores, alignments = score_pairs(source_file.name, target_file.name, models, options, b=b,
+                                     normalize=normalize, alignweights=alignweights,
+                                     n_process=n_process, verbose=verbose)
 
     source_file.seek(0)
     target_file.seek(0)
@@ -82,13 +34,13 @@ def rescore_model(source_file, target_file, saveto, models, options, b, normaliz
         ### writing out the alignments.
         temp_name = saveto.name + ".json"
         with tempfile.NamedTemporaryFile(prefix=temp_name) as align_OUT:
-            for line in all_alignments:
+            for line in alignments:
                 align_OUT.write(line + "\n")
             ### combining the actual source and target words.
             combine_source_target_text_1to1(source_file, target_file, saveto.name, align_OUT)
 
 def main(models, source_file, nbest_file, saveto, b=80,
-         normalize=False, verbose=False, alignweights=False):
+         normalize=False, verbose=False, alignweights=False, n_process=1):
 
     # load model model_options
     options = []
@@ -97,12 +49,16 @@ def main(models, source_file, nbest_file, saveto, b=80,
 
         fill_options(options[-1])
 
-    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights)
+    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights,
+                  n_process=n_process)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', type=int, default=80,
                         help="Minibatch size (default: %(default)s))")
+    parser.add_argument('-p', type=int, default=1,
+                        help="Number of processes; with several models, ensemble members are scored "
+                             "in parallel if there are enough processes (default: %(default)s))")
     parser.add_argument('-n', action="store_true",
                         help="Normalize scores by sentence length")
     parser.add_argument('-v', action="store_true", help="verbose mode.")
@@ -123,4 +79,5 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     main(args.models, args.source, args.target,
-         args.output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign)
+         args.output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign,
+         n_process=args.p)
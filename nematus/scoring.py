@@ -0,0 +1,229 @@
+'''
+Scoring of sentence pairs with one or more models, sharded across worker processes
+(used by score.py and rescore.py).
+
+The sentence pairs are sorted by length and split into minibatches (so that little
+time is spent on padding), which are sent to a pool of workers. If there
+are several models and enough processes, the models are split into groups that score
+every minibatch in parallel, each group with its own share of the workers. Every
+worker compiles its models once; scores are returned in the original order.
+
+With group_by_source (for n-best lists), each distinct (source, target) pair is
+scored once, and translations of the same source are batched together so that
+the encoder runs once per distinct source and batch (see nmt_utils.build_rescorer).
+'''
+
+import sys
+from multiprocessing import Process, Queue
+
+import numpy
+
+from data_iterator import TextIterator
+
+
+def _prepare_grouped(sources, targets, factors):
+    # like prepare_data, but for distinct sources and the targets that refer to them
+    x = numpy.zeros((factors, max(len(s) for s in sources) + 1, len(sources))).astype('int64')
+    x_mask = numpy.zeros(x.shape[1:]).astype('float32')
+    for idx, s_x in enumerate(sources):
+        if s_x:
+            x[:, :len(s_x), idx] = zip(*s_x)
+        x_mask[:len(s_x) + 1, idx] = 1.
+
+    y = numpy.zeros((max(len(s) for s in targets) + 1, len(targets))).astype('int64')
+    y_mask = numpy.zeros(y.shape).astype('float32')
+    for idx, s_y in enumerate(targets):
+        y[:len(s_y), idx] = s_y
+        y_mask[:len(s_y) + 1, idx] = 1.
+
+    return x, x_mask, y, y_mask
+
+
+def score_model(queue, rqueue, pid, group, models, options, normalize, alignweights, verbose,
+                group_by_source=False):
+
+    import theano
+    from theano_util import init_theano_params
+    from nmt_utils import build_model, build_rescorer, prepare_data, pred_probs
+    from alignment_util import get_alignments
+    from quantize import dequantize_params
+
+    fs_log_probs = []
+
+    for model, option in zip(models, options):
+
+        # load model parameters (in float32, if quantized) and set theano shared variables
+        params = dequantize_params(numpy.load(model))
+        tparams = init_theano_params(params)
+
+        if group_by_source:
+            fs_log_probs.append(build_rescorer(tparams, option, return_alignment=alignweights))
+            continue
+
+        trng, use_noise, \
+            x, x_mask, y, y_mask, \
+            opt_ret, \
+            cost = \
+            build_model(tparams, option)
+        inps = [x, x_mask, y, y_mask]
+        use_noise.set_value(0.)
+
+        if alignweights:
+            sys.stderr.write("\t*** Save weight mode ON, alignment matrix will be saved.\n")
+            outputs = [cost, opt_ret['dec_alphas']]
+            f_log_probs = theano.function(inps, outputs)
+        else:
+            f_log_probs = theano.function(inps, cost)
+
+        fs_log_probs.append(f_log_probs)
+
+    while True:
+        req = queue.get()
+        if req is None:
+            break
+
+        idx, pairs = req[0], req[1]
+        if verbose:
+            sys.stderr.write('{0} - {1}\n'.format(pid, idx))
+
+        scores = []
+        alignments = []
+        for f_log_probs, option in zip(fs_log_probs, options):
+            if group_by_source:
+                sources, targets, src_idx = pairs
+                f_encode, f_decode = f_log_probs
+                x, x_mask, y, y_mask = _prepare_grouped(sources, targets, option['factors'])
+                src_idx = numpy.array(src_idx, dtype='int64')
+                out = f_decode(f_encode(x, x_mask), x_mask, src_idx, y, y_mask)
+                alignment = []
+                if alignweights:
+                    score, attention = out
+                    alignment = list(get_alignments(attention, x_mask[:, src_idx], y_mask))
+                else:
+                    score = out
+                # normalize scores according to output length
+                if normalize:
+                    score = score / y_mask.sum(0)
+            else:
+                score, alignment = pred_probs(f_log_probs, prepare_data, option, [pairs],
+                                              verbose=False, normalize=normalize, alignweights=alignweights)
+            scores.append(score)
+            alignments.append(alignment)
+
+        rqueue.put((idx, group, scores, alignments))
+
+    return
+
+
+def score_pairs(source_file, target_file, models, options, b=80, normalize=False,
+                alignweights=False, n_process=1, verbose=False, sort_by_length=True,
+                group_by_source=False):
+    """Score all sentence pairs in source_file/target_file (file names) with every model.
+
+    Returns a list with one array of per-pair scores per model (in input order), and
+    the alignments of the first model (JSON lines, in input order) if alignweights is set.
+    """
+
+    # split models into groups that score in parallel, and processes between the groups
+    n_groups = max(1, min(len(models), n_process))
+    groups = [range(g, len(models), n_groups) for g in xrange(n_groups)]
+    queues = [Queue() for _ in groups]
+    rqueue = Queue()
+
+    processes = [None] * n_process
+    for pidx in xrange(n_process):
+        group = pidx % n_groups
+        processes[pidx] = Process(
+            target=score_model,
+            args=(queues[group], rqueue, pidx, group,
+                  [models[i] for i in groups[group]], [options[i] for i in groups[group]],
+                  normalize, alignweights, verbose, group_by_source))
+        processes[pidx].start()
+
+    pairs = TextIterator(source_file, target_file,
+                         options[0]['dictionaries'][:-1], options[0]['dictionaries'][-1],
+                         n_words_source=options[0]['n_words_src'], n_words_target=options[0]['n_words'],
+                         batch_size=b,
+                         maxlen=float('inf'),
+                         sort_by_length=False)
+
+    source, target = [], []
+    for x, y in pairs:
+        source.extend(x)
+        target.extend(y)
+
+    # items are what is actually scored: one per input line, or one per distinct pair
+    if group_by_source:
+        item_ids = {}
+        source_ids = {}
+        item_source = []  # source id of each item
+        item_line = []  # first input line of each item
+        line_item = []
+        for i in xrange(len(target)):
+            source_key = tuple(tuple(w) for w in source[i])
+            key = (source_key, tuple(target[i]))
+            if key not in item_ids:
+                item_ids[key] = len(item_line)
+                item_source.append(source_ids.setdefault(source_key, len(source_ids)))
+                item_line.append(i)
+            line_item.append(item_ids[key])
+        # translations of the same source end up next to each other
+        order = sorted(xrange(len(item_line)),
+                       key=lambda u: (len(source[item_line[u]]), item_source[u], len(target[item_line[u]])))
+        if verbose:
+            sys.stderr.write('{0} distinct pairs, {1} distinct sources in {2} lines\n'.format(
+                len(item_line), len(source_ids), len(target)))
+    else:
+        item_line = line_item = range(len(target))
+        order = range(len(target))
+        if sort_by_length:
+            order.sort(key=lambda i: (len(target[i]), len(source[i])))
+    batches = [order[start:start + b] for start in xrange(0, len(order), b)]
+    n_batches = len(batches)
+
+    for idx, batch in enumerate(batches):
+        if group_by_source:
+            sources, src_idx, local_ids = [], [], {}
+            for u in batch:
+                if item_source[u] not in local_ids:
+                    local_ids[item_source[u]] = len(sources)
+                    sources.append(source[item_line[u]])
+                src_idx.append(local_ids[item_source[u]])
+            job = (sources, [target[item_line[u]] for u in batch], src_idx)
+        else:
+            job = ([source[i] for i in batch], [target[i] for i in batch])
+        for queue in queues:
+            queue.put((idx, job))
+
+    for pidx in xrange(n_process):
+        queues[pidx % n_groups].put(None)
+
+    results = {}
+    for i in xrange(n_batches * n_groups):
+        idx, group, scores, alignments = rqueue.get()
+        results[idx, group] = scores, alignments
+        if verbose and numpy.mod(i, 10) == 0:
+            sys.stderr.write('Batch {0} / {1} Done\n'.format(i + 1, n_batches * n_groups))
+
+    for process in processes:
+        process.join()
+
+    # scatter the scores back to input order
+    line_item = numpy.array(line_item, dtype='int64')
+    scores = [None] * len(models)
+    for group, members in enumerate(groups):
+        for j, model_idx in enumerate(members):
+            item_scores = numpy.zeros(len(item_line), dtype='float32')
+            for idx, batch in enumerate(batches):
+                item_scores[batch] = results[idx, group][0][j]
+            scores[model_idx] = item_scores[line_item]
+
+    alignments = []
+    if alignweights:
+        item_alignments = [None] * len(item_line)
+        for idx, batch in enumerate(batches):
+            for u, alignment in zip(batch, results[idx, 0][1][0]):
+                item_alignments[u] = alignment
+        alignments = [item_alignments[u] for u in line_item]
+
+    return scores, alignments
@@ -9,19 +9,23 @@ import numpy
 import theano
 import theano.tensor as tensor
 
+# without Theano (for the NumPy backend), but also used with it
+from util import cast_params, embedding_name
+from quantize import dequantize_params
+
 
 # push parameters to Theano shared variables
 def zip_to_theano(params, tparams):
     for kk, vv in params.iteritems():
-        tparams[kk].set_value(vv)
+        tparams[kk].set_value(numpy.asarray(vv, dtype=tparams[kk].dtype))
 
 
-# pull parameters from Theano shared variables
-def unzip_from_theano(zipped):
+# pull parameters from Theano shared variables (see cast_params for dtype)
+def unzip_from_theano(zipped, dtype=None):
     new_params = OrderedDict()
     for kk, vv in zipped.iteritems():
         new_params[kk] = vv.get_value()
-    return new_params
+    return cast_params(new_params, dtype)
 
 
 # get the list of parameters: Note that tparams must be OrderedDict
@@ -36,18 +40,23 @@ def pp(pp, name):
 def init_theano_params(params):
     tparams = OrderedDict()
     for kk, pp in params.iteritems():
-        tparams[kk] = theano.shared(params[kk], name=kk)
+        if pp.dtype == numpy.int8:
+            raise ValueError('{0} is quantized; load the parameters with quantize.dequantize_params'.format(kk))
+        if pp.dtype == numpy.float16:
+            # stored in float16 (see cast_params), computed in floatX
+            pp = pp.astype(theano.config.floatX)
+        tparams[kk] = theano.shared(pp, name=kk)
     return tparams
 
 
-# load parameters
+# load parameters (quantized ones, see quantize.py, are dequantized)
 def load_params(path, params):
-    pp = numpy.load(path)
+    pp = dequantize_params(numpy.load(path))
     for kk, vv in params.iteritems():
         if kk not in pp:
             warnings.warn('%s is not in the archive' % kk)
             continue
-        params[kk] = pp[kk]
+        params[kk] = numpy.asarray(pp[kk], dtype=vv.dtype)
 
     return params
 
@@ -59,6 +68,15 @@ def linear(x):
     return x
 
 
+def log_softmax(x):
+    """
+    Numerically stable log of the softmax over the last axis of `x`.
+    """
+    x_max = x.max(axis=-1, keepdims=True)
+    x_shifted = x - x_max
+    return x_shifted - tensor.log(tensor.exp(x_shifted).sum(axis=-1, keepdims=True))
+
+
 def concatenate(tensor_list, axis=0):
     """
     Alternative implementation of `theano.tensor.concatenate`.
@@ -102,12 +120,3 @@ def concatenate(tensor_list, axis=0):
         offset += tt.shape[axis]
 
     return out
-
-# return name of word embedding for factor i
-# special handling of factor 0 for backward compatibility
-def embedding_name(i):
-    if i == 0:
-        return 'Wemb'
-    else:
-        return 'Wemb'+str(i)
-
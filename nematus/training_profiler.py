@@ -0,0 +1,155 @@
+'''
+Lightweight wall-clock profiler for the training loops (nmt_client, nmt_dual_client).
+
+Records time per stage (data loading, prepare_data, training step, Pyro
+transport, validation, saving, ...), source/target words per second and padding
+efficiency (mask sum / mask size), and periodically writes them either as one
+JSON object per line or as a Prometheus text file (node_exporter textfile format).
+'''
+
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageProfiler(object):
+    """Accumulates per-stage wall time and token counts between two calls to report()."""
+
+    def __init__(self, metrics_file=None, metrics_format='json', prefix='nematus_train'):
+        if metrics_format not in ('json', 'prometheus'):
+            raise ValueError('unknown metrics format: {0}'.format(metrics_format))
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.prefix = prefix
+        self.total_times = OrderedDict()
+        self.total_words = [0, 0]
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.counts = OrderedDict()
+        self.sentences = 0
+        self.batches = 0
+        self.words = [0, 0]  # source, target (non-padding tokens)
+        self.cells = [0, 0]  # source, target (tensor size incl. padding)
+        self.start = time.time()
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.total_times[name] = self.total_times.get(name, 0.) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed_iter(self, iterable, name='data'):
+        """Iterate over iterable, charging the time spent in next() to stage name."""
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_time(name, time.time() - start)
+                return
+            self.add_time(name, time.time() - start)
+            yield item
+
+    def add_batch(self, x_mask, y_mask):
+        """Count words and padding of a prepared minibatch (masks as returned by prepare_data)."""
+        self.batches += 1
+        self.sentences += x_mask.shape[1]
+        for side, mask in enumerate((x_mask, y_mask)):
+            words = int(mask.sum())
+            self.words[side] += words
+            self.total_words[side] += words
+            self.cells[side] += mask.size
+
+    def split_remote(self, remote_times, name='pyro'):
+        """Move the part of client-side stage time not spent computing on the remote to stage name.
+
+        remote_times maps stage names to the seconds the remote itself spent in them
+        (see RemoteMT.pop_stage_times); whatever is left of the client-side time
+        was spent on (de)serialization and transport."""
+        transport = 0.
+        for stage, remote_seconds in remote_times.iteritems():
+            if stage not in self.times:
+                continue
+            overhead = max(0., self.times[stage] - remote_seconds)
+            self.times[stage] -= overhead
+            self.total_times[stage] -= overhead
+            transport += overhead
+        if transport:
+            self.times[name] = self.times.get(name, 0.) + transport
+            self.total_times[name] = self.total_times.get(name, 0.) + transport
+
+    def stats(self, **extra):
+        elapsed = max(time.time() - self.start, 1e-6)
+        stages = OrderedDict((name, seconds) for name, seconds in self.times.iteritems())
+        stages['other'] = max(0., elapsed - sum(self.times.values()))
+        stats = OrderedDict()
+        stats['time'] = time.time()
+        stats.update(extra)
+        stats['elapsed'] = elapsed
+        stats['batches'] = self.batches
+        stats['sentences'] = self.sentences
+        stats['sentences_per_second'] = self.sentences / elapsed
+        stats['src_words_per_second'] = self.words[0] / elapsed
+        stats['trg_words_per_second'] = self.words[1] / elapsed
+        stats['src_padding_efficiency'] = float(self.words[0]) / self.cells[0] if self.cells[0] else None
+        stats['trg_padding_efficiency'] = float(self.words[1]) / self.cells[1] if self.cells[1] else None
+        stats['stage_seconds'] = stages
+        stats['stage_calls'] = OrderedDict(self.counts)
+        stats['total_stage_seconds'] = OrderedDict(self.total_times)
+        stats['total_src_words'] = self.total_words[0]
+        stats['total_trg_words'] = self.total_words[1]
+        return stats
+
+    def report(self, **extra):
+        """Write the statistics collected since the last report (if a metrics file is set),
+        start a new interval, and return the statistics."""
+        stats = self.stats(**extra)
+        if self.metrics_file:
+            if self.metrics_format == 'json':
+                with open(self.metrics_file, 'a') as f:
+                    f.write(json.dumps(stats) + '\n')
+            else:
+                self._write_prometheus(stats)
+        self.reset()
+        return stats
+
+    def _write_prometheus(self, stats):
+        p = self.prefix
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append('# HELP {0}_{1} {2}'.format(p, name, help_))
+            lines.append('# TYPE {0}_{1} {2}'.format(p, name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                lines.append('{0}_{1}{2} {3!r}'.format(p, name, labels, float(value)))
+
+        for key in stats:
+            if key not in ('time', 'elapsed') and isinstance(stats[key], (int, long, float)) \
+                    and not key.startswith('total_'):
+                metric(key, 'gauge', 'last reporting interval', [('', stats[key])])
+        metric('stage_seconds', 'gauge', 'wall time per stage in the last reporting interval',
+               [('{{stage="{0}"}}'.format(k), v) for k, v in stats['stage_seconds'].iteritems()])
+        metric('stage_seconds_total', 'counter', 'wall time per stage since start',
+               [('{{stage="{0}"}}'.format(k), v) for k, v in stats['total_stage_seconds'].iteritems()])
+        metric('words_total', 'counter', 'non-padding tokens seen since start',
+               [('{side="src"}', stats['total_src_words']), ('{side="trg"}', stats['total_trg_words'])])
+
+        # write to a temporary file and rename, so that scrapers never see a partial file
+        tmp = self.metrics_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.metrics_file)
@@ -5,50 +5,99 @@ Translates a source file using a translation model.
 import argparse
 import json
 import sys
+import time
 from multiprocessing import Process, Queue
 
 import numpy
 
+from alignment_util import AlignmentArchive, format_matrix, format_matrix_json
 from compat import fill_options
 from hypgraph import HypGraphRenderer
-from util import load_dict, load_config
+from quantize import PRODUCTS
+from translation_cache import TranslationCache
+from translation_job import ShardedJob
+from util import load_dict, load_config, checksum
 
 
 def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose,
-                    nbest, return_alignment, suppress_unk, return_hyp_graph):
+                    nbest, return_alignment, suppress_unk, return_hyp_graph,
+                    maxlen_a=0., maxlen_b=200, early_stop=False, max_cands_per_hyp=None,
+                    prune_abs=None, prune_rel=None, ensemble_combine=None, adaptive_beam=None, beam_min=1,
+                    backend='theano', quantized_product='float32'):
 
-    from theano_util import (init_theano_params)
-    from nmt import (build_sampler, gen_sample)
+    from beam_search import (gen_sample, unmasked_sampler)
 
-    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
-    from theano import shared
-    trng = RandomStreams(1234)
-    use_noise = shared(numpy.float32(0.))
+    # evaluate all members of an ensemble with one call per step
+    fused = ensemble_combine is not None and len(models) > 1
 
-    fs_init = []
-    fs_next = []
+    if backend == 'numpy':
+        # nothing to compile: the samplers are ready once the parameters are loaded
+        from numpy_backend import (build_numpy_sampler, build_numpy_ensemble_sampler)
+        trng = None
 
-    for model, option in zip(models, options):
-        # load model parameters and set theano shared variables
-        params = numpy.load(model)
-        tparams = init_theano_params(params)
+        if fused:
+            samplers = [build_numpy_ensemble_sampler([numpy.load(model) for model in models], options,
+                                                     combine=ensemble_combine, return_alignment=return_alignment,
+                                                     suppress_unk=suppress_unk, quantized_product=quantized_product)]
+        else:
+            samplers = [build_numpy_sampler(numpy.load(model), option, return_alignment=return_alignment,
+                                            log_probs=True, suppress_unk=suppress_unk,
+                                            quantized_product=quantized_product)
+                        for model, option in zip(models, options)]
+    else:
+        from theano_util import (init_theano_params)
+        from nmt import (build_sampler)
+        from nmt_utils import (build_ensemble_sampler)
+        from quantize import (dequantize_params)
+
+        from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+        from theano import shared
+        trng = RandomStreams(1234)
+        use_noise = shared(numpy.float32(0.))
+
+        if fused:
+            tparams_list = [init_theano_params(dequantize_params(numpy.load(model))) for model in models]
+            samplers = [build_ensemble_sampler(tparams_list, options, use_noise, trng,
+                                               combine=ensemble_combine, return_alignment=return_alignment,
+                                               suppress_unk=suppress_unk)]
+        else:
+            samplers = []
+            for model, option in zip(models, options):
+                # load model parameters (in float32, if quantized) and set theano shared variables
+                params = dequantize_params(numpy.load(model))
+                tparams = init_theano_params(params)
 
-        # word index
-        f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=return_alignment)
+                # word index; f_next returns log-probabilities, with UNK suppressed in the graph
+                samplers.append(build_sampler(tparams, option, use_noise, trng, return_alignment=return_alignment,
+                                              log_probs=True, suppress_unk=suppress_unk))
 
+    fs_init = []
+    fs_next = []
+    for f_init, f_next in samplers:
+        f_init, f_next = unmasked_sampler(f_init, f_next)
         fs_init.append(f_init)
         fs_next.append(f_next)
 
     def _translate(seq):
+        # maximum translation length, relative to the source length (without eos)
+        maxlen = max(1, int(maxlen_a * (len(seq) - 1) + maxlen_b))
+
         # sample given an input sequence and obtain scores
         sample, score, word_probs, alignment, hyp_graph = gen_sample(fs_init, fs_next,
                                                                      numpy.array(seq).T.reshape([len(seq[0]),
                                                                                                  len(seq), 1]),
-                                                                     trng=trng, k=k, maxlen=200,
+                                                                     trng=trng, k=k, maxlen=maxlen,
                                                                      stochastic=False, argmax=False,
                                                                      return_alignment=return_alignment,
-                                                                     suppress_unk=suppress_unk,
-                                                                     return_hyp_graph=return_hyp_graph)
+                                                                     return_hyp_graph=return_hyp_graph,
+                                                                     normalize=normalize,
+                                                                     early_stop=early_stop,
+                                                                     max_cands_per_hyp=max_cands_per_hyp,
+                                                                     prune_abs=prune_abs,
+                                                                     prune_rel=prune_rel,
+                                                                     adaptive_beam=adaptive_beam,
+                                                                     beam_min=beam_min,
+                                                                     log_probs=True)
 
         # normalize scores according to sequence lengths
         if normalize:
@@ -78,23 +127,12 @@ def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose,
 # prints alignment weights for a hypothesis
 # dimension (target_words+1 * source_words+1)
 def print_matrix(hyp, file):
-    # each target word has corresponding alignment weights
-    for target_word_alignment in hyp:
-        # each source hidden state has a corresponding weight
-        for w in target_word_alignment:
-            print >> file, w,
-        print >> file, ""
-    print >> file, ""
+    # one row of weights (over the source words + eos) per target word
+    file.write(format_matrix(hyp))
 
 
 def print_matrix_json(hyp, source, target, sid, tid, file):
-    source.append("</s>")
-    target.append("</s>")
-    links = []
-    for ti, target_word_alignment in enumerate(hyp):
-        for si, w in enumerate(target_word_alignment):
-            links.append((target[ti], source[si], str(w), sid, tid))
-    json.dump(links, file, ensure_ascii=False, indent=2)
+    file.write(format_matrix_json(hyp, source, target, sid, tid))
 
 
 def print_matrices(mm, file):
@@ -105,7 +143,10 @@ def print_matrices(mm, file):
 
 def main(models, source_file, saveto, save_alignment=None, k=5,
          normalize=False, n_process=5, chr_level=False, verbose=False,
-         nbest=False, suppress_unk=False, a_json=False, print_word_probabilities=False, return_hyp_graph=False):
+         nbest=False, suppress_unk=False, a_json=False, a_npz=False, print_word_probabilities=False, return_hyp_graph=False,
+         maxlen_a=0., maxlen_b=200, early_stop=False, max_cands_per_hyp=None, prune_abs=None, prune_rel=None,
+         ensemble_combine=None, adaptive_beam=None, beam_min=1, job_dir=None, shard_size=1000, lock_timeout=3600,
+         cache_path=None, cache_size=100000, backend='theano', quantized_product='float32'):
     # load model model_options
     options = []
     for model in models:
@@ -143,6 +184,42 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
     word_idict_trg[0] = '<eos>'
     word_idict_trg[1] = 'UNK'
 
+    # translation memory: keyed by the models, dictionaries and decoding settings
+    cache = None
+    if cache_path is not None:
+        if return_hyp_graph:
+            sys.stderr.write('Warning: the translation cache is not used with --search_graph\n')
+        else:
+            cache = TranslationCache(cache_path, cache_size)
+            cache_key = TranslationCache.key(
+                models, dictionaries, options=json.dumps(options, sort_keys=True), k=k, normalize=normalize,
+                nbest=nbest, suppress_unk=suppress_unk, chr_level=chr_level, alignment=save_alignment is not None,
+                maxlen_a=maxlen_a, maxlen_b=maxlen_b, early_stop=early_stop, max_cands_per_hyp=max_cands_per_hyp,
+                prune_abs=prune_abs, prune_rel=prune_rel, ensemble_combine=ensemble_combine,
+                adaptive_beam=adaptive_beam, beam_min=beam_min, backend=backend, quantized_product=quantized_product)
+    line_counts = dict(lines=0, decoded=0)
+
+    # search graphs are either rendered (one PNG, overwritten for every sentence) or
+    # all stored in one file (one JSON object per line, see HypGraph.export)
+    graph_out = None
+    if return_hyp_graph and return_hyp_graph.endswith('.json'):
+        graph_out = open(return_hyp_graph, 'w')
+
+    # the job directory is checked before starting the workers
+    if job_dir is not None:
+        lines = source_file.readlines()
+        # models and dictionaries are identified by their contents, so that a model
+        # retrained in place does not continue the job of the old one
+        settings = dict(models=checksum(list(models) + list(dictionaries)), backend=backend,
+                        k=k, normalize=normalize, nbest=nbest, suppress_unk=suppress_unk,
+                        chr_level=chr_level, print_word_probabilities=print_word_probabilities,
+                        alignment=save_alignment is not None, a_json=a_json, a_npz=a_npz,
+                        maxlen_a=maxlen_a, maxlen_b=maxlen_b, early_stop=early_stop,
+                        max_cands_per_hyp=max_cands_per_hyp, prune_abs=prune_abs, prune_rel=prune_rel,
+                        ensemble_combine=ensemble_combine, adaptive_beam=adaptive_beam, beam_min=beam_min,
+                        quantized_product=quantized_product)
+        job = ShardedJob(job_dir, lines, shard_size, settings, lock_timeout)
+
     # create input and output queues for processes
     queue = Queue()
     rqueue = Queue()
@@ -151,7 +228,9 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
         processes[midx] = Process(
             target=translate_model,
             args=(queue, rqueue, midx, models, options, k, normalize, verbose, nbest,
-                  save_alignment is not None, suppress_unk, return_hyp_graph))
+                  save_alignment is not None, suppress_unk, return_hyp_graph,
+                  maxlen_a, maxlen_b, early_stop, max_cands_per_hyp, prune_abs, prune_rel,
+                  ensemble_combine, adaptive_beam, beam_min, backend, quantized_product))
         processes[midx].start()
 
     # utility function
@@ -164,7 +243,12 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
         return ' '.join(ww)
 
     def _send_jobs(f):
+        # identical lines are translated once, and lines found in the cache not at all
         source_sentences = []
+        line_job = []  # the job that translates each line
+        job_ids = {}
+        job_tokens = []
+        results = []  # per job: its translation (None until done)
         for idx, line in enumerate(f):
             if chr_level:
                 words = list(line.decode('utf-8').strip())
@@ -182,75 +266,161 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
                 x.append(w)
 
             x += [[0]*options[0]['factors']]
-            queue.put((idx, x))
             source_sentences.append(words)
-        return idx+1, source_sentences
+
+            tokens = tuple(words)
+            if tokens not in job_ids:
+                job_ids[tokens] = len(results)
+                job_tokens.append(tokens)
+                results.append(cache.get(cache_key, tokens) if cache is not None else None)
+                if results[-1] is None:
+                    queue.put((job_ids[tokens], x))
+                    line_counts['decoded'] += 1
+            line_job.append(job_ids[tokens])
+        line_counts['lines'] += len(line_job)
+        return source_sentences, (line_job, job_tokens, results)
 
     def _finish_processes():
         for midx in xrange(n_process):
             queue.put(None)
 
-    def _retrieve_jobs(n_samples):
-        trans = [None] * n_samples
+    def _retrieve_jobs(jobs):
+        line_job, job_tokens, trans = jobs
+        n_lines = len(line_job)
+        n_samples = sum(1 for t in trans if t is None)
         out_idx = 0
-        for idx in xrange(n_samples):
+        for idx in xrange(n_samples + 1):
+            # yield whatever is ready (before the first response: cached translations)
+            while out_idx < n_lines and trans[line_job[out_idx]] is not None:
+                yield trans[line_job[out_idx]]
+                out_idx += 1
+            if idx == n_samples:
+                break
             resp = rqueue.get()
             trans[resp[0]] = resp[1]
+            if cache is not None:
+                cache.put(cache_key, job_tokens[resp[0]], resp[1])
             if verbose and numpy.mod(idx, 10) == 0:
                 sys.stderr.write('Sample {0} / {1} Done\n'.format((idx+1), n_samples))
-            while out_idx < n_samples and trans[out_idx] is not None:
-                yield trans[out_idx]
-                out_idx += 1
 
-    sys.stderr.write('Translating {0} ...\n'.format(source_file.name))
-    n_samples, source_sentences = _send_jobs(source_file)
-    _finish_processes()
-
-    for i, trans in enumerate(_retrieve_jobs(n_samples)):
-        if nbest:
-            samples, scores, word_probs, alignment, hyp_graph = trans
-            if return_hyp_graph:
-                renderer = HypGraphRenderer(hyp_graph)
-                renderer.wordify(word_idict_trg)
-                renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
-            order = numpy.argsort(scores)
-            for j in order:
+    def _save_hyp_graph(hyp_graph, sid):
+        if graph_out is not None:
+            data = hyp_graph.export()
+            data['id'] = sid
+            graph_out.write(json.dumps(data) + '\n')
+        else:
+            renderer = HypGraphRenderer(hyp_graph)
+            renderer.wordify(word_idict_trg)
+            renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
+
+    def _write_translations(translations, source_sentences, out, align_out, offset=0):
+        # offset: line number of the first sentence in the input (for sentence ids)
+        archive = AlignmentArchive() if align_out is not None and a_npz else None
+        for i, trans in enumerate(translations):
+            if nbest:
+                samples, scores, word_probs, alignment, hyp_graph = trans
+                if return_hyp_graph:
+                    _save_hyp_graph(hyp_graph, offset + i)
+                order = numpy.argsort(scores)
+                for rank, j in enumerate(order):
+                    if print_word_probabilities:
+                        probs = " ||| " + " ".join("{0}".format(prob) for prob in word_probs[j])
+                    else:
+                        probs = ""
+                    out.write('{0} ||| {1} ||| {2}{3}\n'.format(offset + i, _seqs2words(samples[j]), scores[j], probs))
+                    # print alignment matrix for each hypothesis
+                    # header: sentence id ||| translation ||| score ||| source ||| source_token_count+eos translation_token_count+eos
+                    if archive is not None:
+                        archive.add(alignment[j], offset + i, rank)
+                    elif align_out is not None:
+                        if a_json:
+                            print_matrix_json(alignment[j], source_sentences[i], _seqs2words(samples[j]).split(),
+                                              offset + i, offset + i + j, align_out)
+                        else:
+                            align_out.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
+                                offset + i, _seqs2words(samples[j]), scores[j], ' '.join(source_sentences[i]),
+                                len(source_sentences[i]) + 1, len(samples[j])))
+                            print_matrix(alignment[j], align_out)
+            else:
+                samples, scores, word_probs, alignment, hyp_graph = trans
+                if return_hyp_graph:
+                    _save_hyp_graph(hyp_graph, offset + i)
+                out.write(_seqs2words(samples) + "\n")
                 if print_word_probabilities:
-                    probs = " ||| " + " ".join("{0}".format(prob) for prob in word_probs[j])
-                else:
-                    probs = ""
-                saveto.write('{0} ||| {1} ||| {2}{3}\n'.format(i, _seqs2words(samples[j]), scores[j], probs))
-                # print alignment matrix for each hypothesis
-                # header: sentence id ||| translation ||| score ||| source ||| source_token_count+eos translation_token_count+eos
-                if save_alignment is not None:
+                    for prob in word_probs:
+                        out.write("{} ".format(prob))
+                    out.write('\n')
+                if archive is not None:
+                    archive.add(alignment, offset + i)
+                elif align_out is not None:
                     if a_json:
-                        print_matrix_json(alignment[j], source_sentences[i], _seqs2words(samples[j]).split(),
-                                          i, i + j, save_alignment)
+                        print_matrix_json(alignment, source_sentences[i], _seqs2words(trans[0]).split(),
+                                          offset + i, offset + i, align_out)
                     else:
-                        save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
-                            i, _seqs2words(samples[j]), scores[j], ' '.join(source_sentences[i]),
-                            len(source_sentences[i]) + 1, len(samples[j])))
-                        print_matrix(alignment[j], save_alignment)
-        else:
-            samples, scores, word_probs, alignment, hyp_graph = trans
-            if return_hyp_graph:
-                renderer = HypGraphRenderer(hyp_graph)
-                renderer.wordify(word_idict_trg)
-                renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
-            saveto.write(_seqs2words(samples) + "\n")
-            if print_word_probabilities:
-                for prob in word_probs:
-                    saveto.write("{} ".format(prob))
-                saveto.write('\n')
-            if save_alignment is not None:
-                if a_json:
-                    print_matrix_json(alignment, source_sentences[i], _seqs2words(trans[0]).split(), i, i,
-                                      save_alignment)
-                else:
-                    save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
-                        i, _seqs2words(trans[0]), 0, ' '.join(source_sentences[i]), len(source_sentences[i]) + 1,
-                        len(trans[0])))
-                    print_matrix(alignment, save_alignment)
+                        align_out.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
+                            offset + i, _seqs2words(trans[0]), 0, ' '.join(source_sentences[i]), len(source_sentences[i]) + 1,
+                            len(trans[0])))
+                        print_matrix(alignment, align_out)
+        if archive is not None:
+            archive.save(align_out)
+
+    if job_dir is None:
+        sys.stderr.write('Translating {0} ...\n'.format(source_file.name))
+        source_sentences, jobs = _send_jobs(source_file)
+        _finish_processes()
+
+        _write_translations(_retrieve_jobs(jobs), source_sentences, saveto, save_alignment)
+    else:
+        suffixes = ('out', 'align') if save_alignment is not None else ('out',)
+
+        def _touching(translations, n):
+            for trans in translations:
+                job.touch(n)
+                yield trans
+
+        while not job.all_done():
+            n = job.claim_next()
+            if n is None:
+                sys.stderr.write('Waiting for shards claimed by other processes ...\n')
+                time.sleep(10)
+                continue
+            start, end = job.shard_range(n)
+            sys.stderr.write('Translating shard {0} / {1} (lines {2}-{3}) ...\n'.format(n + 1, job.n_shards, start, end))
+            try:
+                source_sentences, jobs = _send_jobs(lines[start:end])
+                with open(job.tmp_path(n, 'out'), 'w') as out:
+                    if save_alignment is not None:
+                        with open(job.tmp_path(n, 'align'), 'wb') as align_out:
+                            _write_translations(_touching(_retrieve_jobs(jobs), n),
+                                                source_sentences, out, align_out, start)
+                    else:
+                        _write_translations(_touching(_retrieve_jobs(jobs), n),
+                                            source_sentences, out, None, start)
+            except:
+                job.release(n)
+                raise
+            job.commit(n, suffixes)
+
+        _finish_processes()
+
+        job.concatenate(saveto, 'out')
+        if save_alignment is not None and a_npz:
+            archive = AlignmentArchive()
+            for n in xrange(job.n_shards):
+                archive.extend(AlignmentArchive.load(job.path(n, 'align')))
+            archive.save(save_alignment)
+        elif save_alignment is not None:
+            job.concatenate(save_alignment, 'align')
+
+    if graph_out is not None:
+        graph_out.close()
+
+    if cache is not None:
+        cache.save()
+        sys.stderr.write('Translation cache: {0} hits, {1} misses (hit rate {2:.1%}), {3} entries\n'.format(
+            cache.hits, cache.misses, cache.hit_rate(), len(cache)))
+    if cache is not None or line_counts['decoded'] < line_counts['lines']:
+        sys.stderr.write('Decoded {0} of {1} lines\n'.format(line_counts['decoded'], line_counts['lines']))
 
     sys.stderr.write('Done\n')
 
@@ -276,14 +446,65 @@ if __name__ == "__main__":
     parser.add_argument('--output_alignment', '-a', type=argparse.FileType('w'),
                         default=None, metavar='PATH',
                         help="Output file for alignment weights (default: standard output)")
-    parser.add_argument('--json_alignment', action="store_true",
-                        help="Output alignment in json format")
+    alignment_format = parser.add_mutually_exclusive_group()
+    alignment_format.add_argument('--json_alignment', action="store_true",
+                                  help="Output alignment in json format")
+    alignment_format.add_argument('--npz_alignment', action="store_true",
+                                  help="Output alignment as a single binary .npz file "
+                                       "(see alignment_util.AlignmentArchive)")
     parser.add_argument('--n-best', action="store_true",
                         help="Write n-best list (of size k)")
     parser.add_argument('--suppress-unk', action="store_true", help="Suppress hypotheses containing UNK.")
     parser.add_argument('--print-word-probabilities', '-wp', action="store_true",
                         help="Print probabilities of each word")
-    parser.add_argument('--search_graph', '-sg', help="Output file for search graph rendered as PNG image")
+    parser.add_argument('--search_graph', '-sg',
+                        help="Output file for search graph rendered as PNG image, or, if it ends in .json, "
+                             "for the search graphs of all sentences (one JSON object per line)")
+    parser.add_argument('--ensemble-combine', choices=['mean_log', 'log_mean'], default=None,
+                        help="Evaluate an ensemble with one fused function per step, combining the models' "
+                             "log-probabilities (mean_log) or probabilities (log_mean) (default: separate calls)")
+    parser.add_argument('--backend', choices=['theano', 'numpy'], default='theano',
+                        help="Compute the model with Theano, or with NumPy (no compilation before the first "
+                             "sentence; see numpy_backend.py) (default: %(default)s)")
+    parser.add_argument('--quantized-product', choices=PRODUCTS, default='float32',
+                        help="With --backend numpy, how to multiply with the int8 matrices of a model quantized "
+                             "with quantize.py: dequantize them once (float32, as fast as the float32 model), "
+                             "or keep them in int8 and convert blocks at every product (blocks) or multiply "
+                             "int8 by int8 (int8), which are slower in NumPy; see quantize.py "
+                             "(default: %(default)s)")
+    parser.add_argument('--maxlen-a', type=float, default=0., metavar='FLOAT',
+                        help="Maximum translation length is maxlen_a * source length + maxlen_b (default: %(default)s)")
+    parser.add_argument('--maxlen-b', type=int, default=200, metavar='INT',
+                        help="Maximum translation length is maxlen_a * source length + maxlen_b (default: %(default)s)")
+    parser.add_argument('--early-stop', action="store_true",
+                        help="Stop the search once no live hypothesis can beat the best finished one")
+    parser.add_argument('--max-cands-per-hyp', type=int, default=None, metavar='INT',
+                        help="Keep at most INT continuations of each hypothesis per step (default: no limit)")
+    parser.add_argument('--prune-abs', type=float, default=None, metavar='FLOAT',
+                        help="Drop candidates whose cost exceeds the best candidate's by more than FLOAT (default: off)")
+    parser.add_argument('--prune-rel', type=float, default=None, metavar='FLOAT',
+                        help="Drop candidates whose probability is below FLOAT times the best candidate's (default: off)")
+    parser.add_argument('--adaptive-beam', type=float, default=None, metavar='FLOAT',
+                        help="Adaptive beam width: start with --beam-min hypotheses, double the width (up to k) "
+                             "while the costs of the two best candidates are less than FLOAT apart and halve it "
+                             "once the best one leads by FLOAT (default: off)")
+    parser.add_argument('--beam-min', type=int, default=1, metavar='INT',
+                        help="Initial and minimum beam width with --adaptive-beam (default: %(default)s)")
+    parser.add_argument('--job-dir', type=str, default=None, metavar='PATH',
+                        help="Translate in resumable shards, kept in PATH; finished shards are skipped on restart, "
+                             "and several processes (also on different hosts) can share PATH (default: off)")
+    parser.add_argument('--shard-size', type=int, default=1000, metavar='INT',
+                        help="Lines per shard with --job-dir (default: %(default)s)")
+    parser.add_argument('--lock-timeout', type=int, default=3600, metavar='SECONDS',
+                        help="With --job-dir, take over a shard whose lock has not been refreshed "
+                             "for SECONDS (default: %(default)s)")
+
+    parser.add_argument('--cache', type=str, default=None, metavar='PATH', dest='cache_path',
+                        help="Keep a persistent translation memory in PATH: sentences translated before "
+                             "with the same models and settings are not decoded again (default: off)")
+    parser.add_argument('--cache-size', type=int, default=100000, metavar='INT',
+                        help="Maximum number of translations kept in the cache; the least recently used "
+                             "are dropped first (default: %(default)s)")
 
     args = parser.parse_args()
 
@@ -291,4 +512,10 @@ if __name__ == "__main__":
          args.output, k=args.k, normalize=args.n, n_process=args.p,
          chr_level=args.c, verbose=args.v, nbest=args.n_best, suppress_unk=args.suppress_unk, 
          print_word_probabilities=args.print_word_probabilities, save_alignment=args.output_alignment,
-         a_json=args.json_alignment, return_hyp_graph=args.search_graph)
+         a_json=args.json_alignment, a_npz=args.npz_alignment, return_hyp_graph=args.search_graph,
+         maxlen_a=args.maxlen_a, maxlen_b=args.maxlen_b, early_stop=args.early_stop,
+         max_cands_per_hyp=args.max_cands_per_hyp, prune_abs=args.prune_abs, prune_rel=args.prune_rel,
+         ensemble_combine=args.ensemble_combine, adaptive_beam=args.adaptive_beam, beam_min=args.beam_min,
+         job_dir=args.job_dir, shard_size=args.shard_size,
+         lock_timeout=args.lock_timeout, cache_path=args.cache_path, cache_size=args.cache_size,
+         backend=args.backend, quantized_product=args.quantized_product)
@@ -0,0 +1,83 @@
+'''
+Persistent translation memory for translate.py (--cache).
+
+Translations are stored under the source tokens and a key that identifies the
+model(s) and every decoding option that affects the result (see key()). The
+cache keeps at most max_entries translations and evicts the least recently used
+one first. It is kept in memory during a run and written back to disk at the end
+(to a temporary file which is then renamed, so a crashed run never leaves a
+corrupt cache; if several runs share a cache file, the last one to finish wins).
+'''
+
+import cPickle as pkl
+import os
+import sys
+from collections import OrderedDict
+
+from util import checksum
+
+
+class TranslationCache(object):
+
+    VERSION = 1
+
+    def __init__(self, path=None, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    data = pkl.load(f)
+                if data.get('version') == self.VERSION:
+                    self.entries = data['entries']
+                else:
+                    sys.stderr.write('Translation cache {0} has an old format, starting a new one\n'.format(path))
+            except (EOFError, IOError, pkl.UnpicklingError) as e:
+                sys.stderr.write('Could not read translation cache {0} ({1}), starting a new one\n'.format(path, e))
+        self._evict()
+
+    @staticmethod
+    def key(models, dictionaries, **settings):
+        """Identify the models (and dictionaries) by their contents, together with the decoding settings."""
+        return checksum(list(models) + list(dictionaries), sorted(settings.items()))
+
+    def get(self, key, tokens):
+        entry = (key, tuple(tokens))
+        try:
+            value = self.entries.pop(entry)
+        except KeyError:
+            self.misses += 1
+            return None
+        # move to the most recently used end
+        self.entries[entry] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, tokens, value):
+        entry = (key, tuple(tokens))
+        self.entries.pop(entry, None)
+        self.entries[entry] = value
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pkl.dump({'version': self.VERSION, 'entries': self.entries}, f, pkl.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
@@ -0,0 +1,157 @@
+'''
+Resumable translation jobs (see translate.py --job-dir).
+
+The input is split into fixed-size shards. The output of each shard is written to
+a temporary file and renamed when complete, so a shard is either done or not. A
+process claims a shard by creating its lock file (O_EXCL). Several translate.py
+runs, on one host or on several hosts sharing the job directory, can therefore
+work on the same job; a lock that has not been refreshed for lock_timeout seconds
+(its owner died) is taken over, by renaming it away (only one process can) and
+creating a new one. Once all shards are done, their outputs are concatenated in
+order.
+'''
+
+import errno
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+
+
+class ShardedJob(object):
+
+    def __init__(self, job_dir, lines, shard_size=1000, settings=None, lock_timeout=3600):
+        self.job_dir = job_dir
+        self.n_lines = len(lines)
+        self.shard_size = shard_size
+        self.lock_timeout = lock_timeout
+        self.n_shards = max(1, (self.n_lines + shard_size - 1) // shard_size)
+
+        if not os.path.isdir(job_dir):
+            try:
+                os.makedirs(job_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # make sure that all processes working on this directory do the same job
+        h = hashlib.sha1()
+        for line in lines:
+            h.update(line)
+        description = dict(input_checksum=h.hexdigest(), n_lines=self.n_lines,
+                           shard_size=shard_size, settings=settings)
+        description = json.loads(json.dumps(description))  # normalize (tuples, unicode)
+        job_file = os.path.join(job_dir, 'job.json')
+        try:
+            fd = os.open(job_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(description, f, indent=2)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            with open(job_file) as f:
+                existing = json.load(f)
+            if existing != description:
+                sys.stderr.write('Error: job directory {0} belongs to a different job '
+                                 '(input, shard size, models or settings differ)\n'.format(job_dir))
+                sys.exit(1)
+
+    def shard_range(self, n):
+        return n * self.shard_size, min(self.n_lines, (n + 1) * self.shard_size)
+
+    def path(self, n, suffix):
+        return os.path.join(self.job_dir, 'shard.{0:06d}.{1}'.format(n, suffix))
+
+    def tmp_path(self, n, suffix):
+        return '{0}.{1}.{2}.tmp'.format(self.path(n, suffix), socket.gethostname(), os.getpid())
+
+    def is_done(self, n):
+        return os.path.exists(self.path(n, 'out'))
+
+    def all_done(self):
+        return all(self.is_done(n) for n in xrange(self.n_shards))
+
+    def claim(self, n):
+        """Try to lock shard n for this process; return True on success."""
+        lock = self.path(n, 'lock')
+        for _ in xrange(2):
+            if self.is_done(n):
+                return False
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    st = os.stat(lock)
+                except OSError:  # released in the meantime
+                    continue
+                if time.time() - st.st_mtime <= self.lock_timeout or not self._take_over(lock, st):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write('{0} {1} {2}\n'.format(socket.gethostname(), os.getpid(), time.time()))
+            # it may have been finished between the check above and taking the lock
+            if self.is_done(n):
+                self.release(n)
+                return False
+            return True
+        return False
+
+    def _take_over(self, lock, st):
+        # rename is atomic: of several processes that found the same stale lock, only
+        # one moves it away. Another may instead move the new lock of the winner, which
+        # it notices (different file) and puts back.
+        stale = '{0}.{1}.{2}.stale'.format(lock, socket.gethostname(), os.getpid())
+        try:
+            os.rename(lock, stale)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        moved = os.stat(stale)
+        if (moved.st_dev, moved.st_ino, moved.st_mtime) != (st.st_dev, st.st_ino, st.st_mtime):
+            try:
+                os.link(stale, lock)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.remove(stale)
+            return False
+        sys.stderr.write('Taking over stale lock {0}\n'.format(lock))
+        os.remove(stale)
+        return True
+
+    def claim_next(self):
+        """Lock the first shard that is neither done nor locked; return its number or None."""
+        for n in xrange(self.n_shards):
+            if self.claim(n):
+                return n
+        return None
+
+    def touch(self, n):
+        # keep the lock from becoming stale while the shard is being translated
+        try:
+            os.utime(self.path(n, 'lock'), None)
+        except OSError:
+            pass
+
+    def commit(self, n, suffixes=('out',)):
+        """Move the finished temporary outputs of shard n into place ('out' last) and unlock it."""
+        for suffix in sorted(suffixes, key=lambda s: s == 'out'):
+            os.rename(self.tmp_path(n, suffix), self.path(n, suffix))
+        self.release(n)
+
+    def release(self, n):
+        try:
+            os.remove(self.path(n, 'lock'))
+        except OSError:
+            pass
+
+    def concatenate(self, out, suffix='out'):
+        for n in xrange(self.n_shards):
+            with open(self.path(n, suffix)) as f:
+                for chunk in iter(lambda: f.read(1 << 20), ''):
+                    out.write(chunk)
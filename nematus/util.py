@@ -4,11 +4,15 @@ Utility functions
 
 import sys
 import json
+import hashlib
 import cPickle as pkl
 #import _pickle as pkl # uncomment this line if python3
 
+from collections import OrderedDict
 from copy import deepcopy
 
+import numpy
+
 def build_model_options(default_model_options, model_dir, lang0, lang1):
     model_options = deepcopy(default_model_options)
     model_options.update(json.loads(open(model_dir+'model.npz.json').read()))
@@ -47,6 +51,19 @@ def load_config(basename):
             sys.exit(1)
 
 
+def checksum(filenames, *extra):
+    """SHA1 hex digest over the contents of filenames (in order) and the repr of any extra values."""
+    h = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                h.update(chunk)
+        h.update('\0')
+    for value in extra:
+        h.update(repr(value))
+    return h.hexdigest()
+
+
 def seqs2words(seq, inverse_target_dictionary, warn=True):
     words = []
     for w in seq:
@@ -63,3 +80,24 @@ def seqs2words(seq, inverse_target_dictionary, warn=True):
 
 def deBPE(sent):
     return sent.replace('@@ ', '')
+
+
+# float32 parameters converted to dtype (None: unchanged), e.g. 'float16' to
+# store models in half the space; load_params and init_theano_params convert
+# them back to the type of the model
+def cast_params(params, dtype=None):
+    if dtype is None:
+        return params
+    cast = OrderedDict()
+    for kk, vv in params.iteritems():
+        cast[kk] = vv.astype(dtype) if vv.dtype == numpy.float32 else vv
+    return cast
+
+
+# return name of word embedding for factor i
+# special handling of factor 0 for backward compatibility
+def embedding_name(i):
+    if i == 0:
+        return 'Wemb'
+    else:
+        return 'Wemb'+str(i)
@@ -0,0 +1,183 @@
+'''
+Validation engine: the validation set is read, mapped to word ids and padded once,
+kept in memory as length-sorted minibatches, and can be scored either in place
+or on a separate remote against a snapshot of the parameters (AsyncValidator).
+
+ValidationSet.from_files() identifies the batches by a checksum of the corpus,
+dictionaries and settings; they can be cached on disk across runs and are rebuilt
+by refresh() when any of the files changes.
+'''
+
+import cPickle as pkl
+import os
+import sys
+import threading
+
+import numpy
+
+from data_iterator import TextIterator
+from nmt_utils import prepare_data
+from util import checksum
+
+
+class ValidationSet(object):
+    """Length-sorted, padded validation minibatches.
+
+    iterator: a TextIterator over the validation corpus (consumed once)
+    batch_size: sentences per minibatch (default: the iterator's batch size)
+    """
+
+    def __init__(self, iterator, batch_size=None, factors=1):
+        self.key = None
+        self._from_files = None  # arguments to from_files(), if built from files
+
+        source, target = [], []
+        for x, y in iterator:
+            # ensure consistency in number of factors
+            if len(x[0][0]) != factors:
+                sys.stderr.write('Error: mismatch between number of factors in settings ({0}), and number in validation corpus ({1})\n'.format(factors, len(x[0][0])))
+                sys.exit(1)
+            source.extend(x)
+            target.extend(y)
+
+        if batch_size is None:
+            batch_size = iterator.batch_size
+
+        # sorting by length keeps padding (and thus wasted computation) to a minimum
+        order = sorted(xrange(len(target)), key=lambda i: (len(target[i]), len(source[i])))
+
+        self.n_sentences = len(order)
+        self.batches = []
+        for start in xrange(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            x, x_mask, y, y_mask = prepare_data([source[i] for i in idx], [target[i] for i in idx])
+            self.batches.append((numpy.array(idx), x, x_mask, y, y_mask))
+
+    @classmethod
+    def from_files(cls, source, target, source_dicts, target_dict,
+                   batch_size=80, maxlen=100, n_words_source=-1, n_words_target=-1,
+                   factors=1, cache=None):
+        """Build the validation set from the corpus files (like TextIterator).
+
+        If cache is a file name, the batches are stored there and reused by later runs
+        as long as the corpus, the dictionaries and the settings are unchanged.
+        """
+        kwargs = dict(source=source, target=target, source_dicts=list(source_dicts), target_dict=target_dict,
+                      batch_size=batch_size, maxlen=maxlen, n_words_source=n_words_source,
+                      n_words_target=n_words_target, factors=factors, cache=cache)
+        files = [source, target] + list(source_dicts) + [target_dict]
+        key = checksum(files, batch_size, maxlen, n_words_source, n_words_target, factors)
+
+        valid_set = None
+        if cache and os.path.exists(cache):
+            with open(cache, 'rb') as f:
+                valid_set = pkl.load(f)
+            if valid_set.key != key:
+                print 'Validation cache {0} is out of date'.format(cache)
+                valid_set = None
+
+        if valid_set is None:
+            iterator = TextIterator(source, target, source_dicts, target_dict,
+                                    n_words_source=n_words_source, n_words_target=n_words_target,
+                                    batch_size=batch_size, maxlen=maxlen)
+            valid_set = cls(iterator, batch_size, factors)
+            valid_set.key = key
+            if cache:
+                with open(cache + '.tmp', 'wb') as f:
+                    pkl.dump(valid_set, f, pkl.HIGHEST_PROTOCOL)
+                os.rename(cache + '.tmp', cache)
+
+        valid_set._from_files = kwargs
+        valid_set._stat = _stat(files)
+        return valid_set
+
+    def refresh(self):
+        """Rebuild the batches if the files they were built from have changed; return True if so.
+
+        Only compares file sizes and modification times, unless these changed.
+        """
+        if self._from_files is None:
+            return False
+        kwargs = self._from_files
+        files = [kwargs['source'], kwargs['target']] + kwargs['source_dicts'] + [kwargs['target_dict']]
+        stat = _stat(files)
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        if checksum(files, kwargs['batch_size'], kwargs['maxlen'], kwargs['n_words_source'],
+                    kwargs['n_words_target'], kwargs['factors']) == self.key:
+            return False
+        print 'Validation data changed, rebuilding'
+        self.__dict__.update(ValidationSet.from_files(**kwargs).__dict__)
+        return True
+
+    def __len__(self):
+        return self.n_sentences
+
+    def score(self, f_log_probs, normalize=False):
+        """Return the per-sentence costs (in the order the iterator produced the sentences)."""
+        costs = numpy.zeros(self.n_sentences, dtype='float32')
+        for idx, x, x_mask, y, y_mask in self.batches:
+            pprobs = numpy.asarray(f_log_probs(x, x_mask, y, y_mask))
+            # normalize scores according to output length
+            if normalize:
+                pprobs = pprobs / y_mask.sum(0)
+            costs[idx] = pprobs
+        return costs
+
+
+class AsyncValidator(object):
+    """Scores a ValidationSet on a separate remote (a RemoteMT, possibly behind Pyro)
+    in a background thread, so that training continues while validation runs.
+
+    The validation set is sent to the remote with the first job and kept there;
+    every job then only transfers the parameter snapshot and the costs.
+    """
+
+    def __init__(self, remote, valid_set, normalize=False):
+        self.remote = remote
+        self.valid_set = valid_set
+        self.normalize = normalize
+        self._sent = False
+        self._thread = None
+        self._result = None
+
+    def busy(self):
+        return self._thread is not None
+
+    def ready(self):
+        return self._thread is not None and not self._thread.is_alive()
+
+    def start(self, uidx, params):
+        """Validate params (a snapshot from get_params_from_theano) taken at update uidx."""
+        if self.busy():
+            raise RuntimeError('previous validation job has not been collected')
+        if self.valid_set.refresh():
+            self._sent = False
+
+        def _run():
+            try:
+                self.remote.send_params_to_theano(params)
+                self.remote.set_noise_val(0.)
+                costs = self.remote.x_valid_costs(None if self._sent else self.valid_set, self.normalize)
+                self._sent = True
+                self._result = (uidx, costs, params)
+            except Exception as e:
+                self._result = e
+
+        self._result = None
+        self._thread = threading.Thread(target=_run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def result(self):
+        """Wait for the running job and return (uidx, costs, params)."""
+        self._thread.join()
+        self._thread = None
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+def _stat(filenames):
+    return [(os.path.getsize(f), os.path.getmtime(f)) for f in filenames]
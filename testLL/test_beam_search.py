@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the adaptive beam width and the ensemble word probabilities of gen_sample and gen_par_sample
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+from nematus.nmt_utils import unmasked_sampler, gen_sample, gen_par_sample
+from nematus.numpy_backend import build_numpy_sampler
+
+from test_numpy_backend import random_model, random_batch
+
+
+class TestAdaptiveBeam(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        params, options = random_model(21)
+        # more peaked output distributions than random_model's, so that hypotheses finish
+        params['ff_logit_W'] *= numpy.float32(4.)
+        self.f_init, self.f_next = build_numpy_sampler(params, options, log_probs=True)
+        self.sentences = [random_batch(self.rng, 1)[0] for _ in xrange(5)]
+
+    def search(self, x, k, **kwargs):
+        f_init, f_next = unmasked_sampler(self.f_init, self.f_next)
+        stats = dict()
+        sample, score, _, _, _ = gen_sample([f_init], [f_next], x, k=k, maxlen=15, stochastic=False,
+                                            argmax=False, log_probs=True, stats=stats, **kwargs)
+        return sample, score, float(stats['hyps']) / stats['steps']
+
+    def test_beam_min_k_is_fixed_beam(self):
+        for x in self.sentences:
+            sample, score, _ = self.search(x, 5)
+            sample_ad, score_ad, _ = self.search(x, 5, adaptive_beam=1., beam_min=5)
+            self.assertEqual(sample_ad, sample)
+            numpy.testing.assert_allclose(score_ad, score)
+
+    def test_zero_gap_is_greedy(self):
+        # the beam never widens
+        for x in self.sentences:
+            sample, score, beam = self.search(x, 1)
+            sample_ad, score_ad, beam_ad = self.search(x, 5, adaptive_beam=0., beam_min=1)
+            self.assertEqual(sample_ad, sample)
+            self.assertEqual(beam_ad, 1.)
+
+    def test_width_adapts(self):
+        for x in self.sentences:
+            _, _, beam = self.search(x, 5)
+            _, _, beam_ad = self.search(x, 5, adaptive_beam=numpy.inf, beam_min=1)
+            # the beam starts with one hypothesis, then doubles at every step
+            self.assertTrue(1. < beam_ad < beam)
+
+    def test_par_sample(self):
+        # the width is adapted as in gen_sample (one sentence per batch, as padding changes the context mean)
+        for x in self.sentences:
+            par_sample = gen_par_sample([self.f_init], [self.f_next], x, numpy.ones(x.shape[1:], dtype='float32'),
+                                        k=5, maxlen=15, log_probs=True, adaptive_beam=2., beam_min=1)[0][0]
+            sample, _, _ = self.search(x, 5, adaptive_beam=2., beam_min=1)
+            self.assertEqual(sorted(par_sample), sorted(sample))
+
+
+class TestEnsembleWordProbs(unittest.TestCase):
+
+    def test_log_probs(self):
+        # the word probabilities of an ensemble are the mean of the members' probabilities,
+        # whether f_next returns probabilities or log-probabilities
+        rng = numpy.random.RandomState(2)
+        models = [random_model(seed) for seed in (22, 23)]
+        x = random_batch(rng, 1)[0]
+        x_mask = numpy.ones(x.shape[1:], dtype='float32')
+        samples, par_samples = [], []
+        for log_probs in (False, True):
+            f_init, f_next = zip(*[build_numpy_sampler(params, options, log_probs=log_probs)
+                                   for params, options in models])
+            f_init_um, f_next_um = zip(*[unmasked_sampler(*f) for f in zip(f_init, f_next)])
+            samples.append(gen_sample(list(f_init_um), list(f_next_um), x, k=3, maxlen=10, stochastic=False,
+                                      argmax=False, log_probs=log_probs))
+            sample, score, word_probs = gen_par_sample(list(f_init), list(f_next), x, x_mask, k=3, maxlen=10,
+                                                       log_probs=log_probs)
+            par_samples.append((sample[0], score[0], word_probs[0]))
+
+        for probs, log in (samples, par_samples):
+            self.assertEqual(log[0], probs[0])
+            self.assertEqual(len(log[2]), len(probs[2]))
+            for word_probs_log, word_probs in zip(log[2], probs[2]):
+                numpy.testing.assert_allclose(word_probs_log, word_probs, rtol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
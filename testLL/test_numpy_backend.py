@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the NumPy inference backend for consistency with the Theano sampler
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from copy import deepcopy
+
+import numpy
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+import theano
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from nematus.nmt_client import default_model_options
+from nematus.nmt_utils import (init_params, build_sampler, build_ensemble_sampler, unmasked_sampler,
+                               gen_sample, gen_par_sample)
+from nematus.theano_util import init_theano_params, cast_params, load_params
+from nematus.numpy_backend import NumpyModel, build_numpy_sampler, build_numpy_ensemble_sampler
+from nematus.quantize import (quantize_params, dequantize_params, quantize_matrix, scale_name,
+                             QuantizedMatrix)
+
+N_WORDS_SRC = 50
+N_WORDS = 60
+
+
+def random_model(seed, **options):
+    model_options = deepcopy(default_model_options)
+    model_options.update(dim_word=12, dim=16, dim_per_factor=[12], n_words_src=N_WORDS_SRC, n_words=N_WORDS)
+    model_options.update(options)
+    numpy.random.seed(seed)
+    params = init_params(model_options)
+    # larger weights than at initialization, so that the output distributions are
+    # peaked (no ties in beam search), and non-zero biases, so that a mix-up shows
+    for k in params:
+        if params[k].ndim == 1:
+            params[k] = numpy.random.uniform(-0.5, 0.5, params[k].shape).astype('float32')
+        else:
+            params[k] *= numpy.float32(5.)
+    return params, model_options
+
+
+def matrices(params):
+    # all matrices that can be quantized (not decoder_U_att, a single column)
+    return [k for k in params if params[k].ndim == 2 and min(params[k].shape) > 1]
+
+
+def random_batch(rng, n, factors=1, min_len=2, max_len=9):
+    lengths = rng.randint(min_len, max_len + 1, size=n)
+    x = numpy.zeros((factors, lengths.max(), n), dtype='int64')
+    x_mask = numpy.zeros((lengths.max(), n), dtype='float32')
+    for i, length in enumerate(lengths):
+        x[:, :length - 1, i] = rng.randint(2, N_WORDS_SRC, size=(factors, length - 1))
+        x_mask[:length, i] = 1.
+    return x, x_mask
+
+
+class TestNumpyBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        self.trng = RandomStreams(1234)
+        self.use_noise = theano.shared(numpy.float32(0.))
+
+    def samplers(self, params, options, **kwargs):
+        f_theano = build_sampler(init_theano_params(params), options, self.use_noise, self.trng, **kwargs)
+        f_numpy = build_numpy_sampler(params, options, **kwargs)
+        return f_theano, f_numpy
+
+    def assert_steps_equal(self, f_theano, f_numpy, x, x_mask, steps=4):
+        (theano_init, theano_next), (numpy_init, numpy_next) = f_theano, f_numpy
+        state, ctx = theano_init(x, x_mask)
+        state_np, ctx_np = numpy_init(x, x_mask)
+        numpy.testing.assert_allclose(ctx_np, ctx, atol=1e-5)
+        numpy.testing.assert_allclose(state_np, state, atol=1e-5)
+
+        y = -1 * numpy.ones(x.shape[2], dtype='int64')
+        for _ in xrange(steps):
+            ret = theano_next(y, ctx, state, x_mask)
+            ret_np = numpy_next(y, ctx, state, x_mask)
+            self.assertEqual(len(ret_np), len(ret))
+            numpy.testing.assert_allclose(ret_np[0], ret[0], atol=1e-4)
+            numpy.testing.assert_allclose(ret_np[2], ret[2], atol=1e-5)
+            for extra, extra_np in zip(ret[3:], ret_np[3:]):
+                numpy.testing.assert_allclose(extra_np, extra, atol=1e-5)
+            self.assertEqual(ret_np[1].shape, ret[1].shape)
+            self.assertEqual(ret_np[1].dtype, ret[1].dtype)
+            state = ret[2]
+            y = ret[0].argmax(1)
+
+    def test_padded_batch(self):
+        params, options = random_model(1)
+        x, x_mask = random_batch(self.rng, 5)
+        f_theano, f_numpy = self.samplers(params, options, return_alignment=True)
+        self.assert_steps_equal(f_theano, f_numpy, x, x_mask)
+
+    def test_log_probs_suppress_unk(self):
+        params, options = random_model(2)
+        x, x_mask = random_batch(self.rng, 3)
+        f_theano, f_numpy = self.samplers(params, options, log_probs=True, suppress_unk=True)
+        self.assert_steps_equal(f_theano, f_numpy, x, x_mask)
+
+    def test_factors(self):
+        params, options = random_model(3, factors=2, dim_per_factor=[8, 4])
+        x, x_mask = random_batch(self.rng, 4, factors=2)
+        self.assert_steps_equal(*(self.samplers(params, options, log_probs=True) + (x, x_mask)))
+
+    def test_old_model_dropout_scaling(self):
+        params, options = random_model(4, use_dropout=True, model_version=0, dropout_embedding=0.1,
+                                       dropout_hidden=0.2, dropout_source=0.3, dropout_target=0.4)
+        x, x_mask = random_batch(self.rng, 3)
+        self.assert_steps_equal(*(self.samplers(params, options, log_probs=True) + (x, x_mask)))
+
+    def test_beam_search(self):
+        params, options = random_model(5)
+        f_theano, f_numpy = self.samplers(params, options, log_probs=True, return_alignment=True)
+        for _ in xrange(5):
+            x, _ = random_batch(self.rng, 1)
+            results = [gen_sample([f_init], [f_next], x, trng=self.trng, k=5, maxlen=15, stochastic=False,
+                                  argmax=False, return_alignment=True, log_probs=True)
+                       for f_init, f_next in (unmasked_sampler(*f_theano), unmasked_sampler(*f_numpy))]
+            (samples, scores, _, alignments, _), (samples_np, scores_np, _, alignments_np, _) = results
+            self.assertEqual(samples_np, samples)
+            numpy.testing.assert_allclose(scores_np, scores, rtol=1e-4)
+            for alignment, alignment_np in zip(alignments, alignments_np):
+                numpy.testing.assert_allclose(alignment_np, alignment, atol=1e-5)
+
+    def test_par_sample(self):
+        params, options = random_model(6)
+        f_theano, f_numpy = self.samplers(params, options)
+        x, x_mask = random_batch(self.rng, 4)
+        results = [gen_par_sample([f_init], [f_next], x, x_mask, k=3, maxlen=10)
+                   for f_init, f_next in (f_theano, f_numpy)]
+        self.assertEqual(results[1][0], results[0][0])
+
+    def test_ensemble(self):
+        models = [random_model(7), random_model(8, dim=20)]
+        params_list = [params for params, _ in models]
+        options_list = [options for _, options in models]
+        x, x_mask = random_batch(self.rng, 3)
+        for combine in ('mean_log', 'log_mean'):
+            f_theano = build_ensemble_sampler([init_theano_params(params) for params in params_list], options_list,
+                                              self.use_noise, self.trng, combine=combine, return_alignment=True,
+                                              suppress_unk=True)
+            f_numpy = build_numpy_ensemble_sampler(params_list, options_list, combine=combine,
+                                                   return_alignment=True, suppress_unk=True)
+            self.assert_steps_equal(f_theano, f_numpy, x, x_mask)
+
+    def test_sampling(self):
+        params, options = random_model(9)
+        f_init, f_next = unmasked_sampler(*build_numpy_sampler(params, options))
+        x, _ = random_batch(self.rng, 1)
+        sample, score, _, _, _ = gen_sample([f_init], [f_next], x, k=1, maxlen=20, stochastic=True, argmax=False)
+        self.assertTrue(0 < len(sample) <= 20)
+        self.assertTrue(all(0 <= w < N_WORDS for w in sample))
+        self.assertTrue(numpy.isfinite(score))
+
+    def test_quantize(self):
+        params, options = random_model(10)
+        quantized = quantize_params(params)
+        self.assertEqual([name for name in params if quantized[name].dtype == numpy.int8], matrices(params))
+        for name in ('Wemb', 'Wemb_dec', 'ff_logit_W', 'decoder_U', 'decoder_Wc'):
+            self.assertEqual(quantized[name].dtype, numpy.int8)
+        self.assertEqual(quantized[scale_name('Wemb_dec')].shape, (N_WORDS, 1))  # per word
+        self.assertEqual(quantized[scale_name('ff_logit_W')].shape, (1, N_WORDS))  # per output word
+        self.assertEqual(quantized['decoder_U_att'].dtype, numpy.float32)
+
+        dequantized = dequantize_params(quantized)
+        self.assertEqual(dequantized.keys(), params.keys())
+        for name in params:
+            step = quantized[scale_name(name)] if scale_name(name) in quantized else 0.
+            self.assertTrue((numpy.abs(dequantized[name] - params[name]) <= step / 2. + 1e-6).all())
+
+    def test_load_quantized(self):
+        # Theano code gets the dequantized parameters, never the raw int8 values
+        params, options = random_model(17)
+        quantized = quantize_params(params, matrices(params))
+        with self.assertRaises(ValueError):
+            init_theano_params(quantized)
+
+        tmp_dir = tempfile.mkdtemp(prefix='nematus-quantized')
+        try:
+            path = os.path.join(tmp_dir, 'model.npz')
+            numpy.savez(path, **quantized)
+            loaded = load_params(path, init_params(options))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(loaded.keys(), params.keys())
+        for name, value in dequantize_params(quantized).iteritems():
+            numpy.testing.assert_array_equal(loaded[name], value)
+
+    def test_quantized_inference(self):
+        # int8 matrices in the NumPy backend compute the same as the dequantized float32 model,
+        # whether dequantized once (float32) or block by block at every product (blocks)
+        params, options = random_model(11)
+        quantized = quantize_params(params)
+        x, x_mask = random_batch(self.rng, 3)
+        f_float = build_numpy_sampler(dequantize_params(quantized), options, log_probs=True, return_alignment=True)
+        for product in ('float32', 'blocks'):
+            f_int8 = build_numpy_sampler(quantized, options, log_probs=True, return_alignment=True,
+                                         quantized_product=product)
+            self.assert_steps_equal(f_float, f_int8, x, x_mask)
+
+        # the embeddings stay in int8 with every product
+        model = NumpyModel(quantized, options)
+        self.assertEqual(model.params['ff_logit_W'].dtype, numpy.float32)
+        self.assertIsInstance(model.params['Wemb_dec'], QuantizedMatrix)
+        model = NumpyModel(quantized, options, quantized_product='int8')
+        self.assertIsInstance(model.params['ff_logit_W'], QuantizedMatrix)
+        self.assertEqual(model.params['ff_logit_W'].values.dtype, numpy.int8)
+
+    def test_int8_product(self):
+        # the int8 x int8 product differs from the float32 product only by the quantization of x
+        x = self.rng.uniform(-2, 2, (5, 40)).astype('float32')
+        W = self.rng.uniform(-1, 1, (40, 30)).astype('float32')
+        for axis in (0, 1):
+            values, scale = quantize_matrix(W, axis)
+            expected = numpy.dot(x, values * scale)
+            numpy.testing.assert_allclose(QuantizedMatrix(values, scale, 'blocks').rdot(x), expected,
+                                          rtol=1e-5, atol=1e-5)
+            out = QuantizedMatrix(values, scale, 'int8').rdot(x)
+            self.assertEqual(out.dtype, numpy.float32)
+            # an error of at most half a step (1/254 of the largest value of the row) per value of x
+            bound = numpy.abs(x).max(1, keepdims=True) / 254. * numpy.abs(values * scale).sum(0)
+            self.assertTrue((numpy.abs(out - expected) <= bound + 1e-5).all())
+            self.assertFalse(numpy.allclose(out, expected, rtol=1e-6, atol=1e-6))
+
+        # and the model decodes with it about as with float32
+        params, options = random_model(18)
+        quantized = quantize_params(params)
+        x, x_mask = random_batch(self.rng, 3)
+        f_init, f_next = build_numpy_sampler(dequantize_params(quantized), options, log_probs=True)
+        f_init8, f_next8 = build_numpy_sampler(quantized, options, log_probs=True, quantized_product='int8')
+        state, ctx = f_init(x, x_mask)
+        state8, ctx8 = f_init8(x, x_mask)
+        self.assertLess(numpy.abs(ctx8 - ctx).mean(), 0.01)
+        y = -1 * numpy.ones(x.shape[2], dtype='int64')
+        ret, ret8 = f_next(y, ctx, state, x_mask), f_next8(y, ctx, state, x_mask)
+        numpy.testing.assert_allclose(numpy.exp(ret8[0]), numpy.exp(ret[0]), atol=1e-3)
+
+    def test_float16(self):
+        # float16 parameters are computed in float32 by both backends
+        params, options = random_model(12)
+        half = cast_params(params, 'float16')
+        self.assertTrue(all(p.dtype == numpy.float16 for p in half.values()))
+        self.assertEqual(NumpyModel(half, options).params['Wemb_dec'].dtype, numpy.float16)
+        self.assertEqual(init_theano_params(half)['Wemb_dec'].dtype, theano.config.floatX)
+        numpy.testing.assert_allclose(dequantize_params(half)['ff_logit_W'], params['ff_logit_W'], rtol=1e-3)
+
+        x, x_mask = random_batch(self.rng, 3)
+        self.assert_steps_equal(*(self.samplers(half, options, log_probs=True, return_alignment=True) +
+                                  (x, x_mask)))
+
+    def test_without_theano(self):
+        # decoding with the NumPy backend (as translate.py --backend numpy does) does not import Theano
+        params, options = random_model(13)
+        x, _ = random_batch(self.rng, 1)
+        tmp_dir = tempfile.mkdtemp(prefix='nematus-numpy')
+        try:
+            numpy.savez(os.path.join(tmp_dir, 'model.npz'), **params)
+            code = '\n'.join([
+                'import sys',
+                'sys.path.insert(0, {0!r})'.format(os.path.join(nem_path, 'nematus')),
+                'import numpy',
+                'import translate',
+                'from beam_search import gen_sample, unmasked_sampler',
+                'from numpy_backend import build_numpy_sampler',
+                'params = numpy.load({0!r})'.format(os.path.join(tmp_dir, 'model.npz')),
+                'f_init, f_next = unmasked_sampler(*build_numpy_sampler(params, {0!r}, log_probs=True))'.format(options),
+                'gen_sample([f_init], [f_next], numpy.array({0!r}), k=3, maxlen=10, stochastic=False, argmax=False, '
+                'log_probs=True)'.format(x.tolist()),
+                'sys.exit(sorted(m for m in sys.modules if m.startswith("theano")) or None)'])
+            process = subprocess.Popen([sys.executable, '-c', code], stderr=subprocess.PIPE)
+            _, err = process.communicate()
+            self.assertEqual(process.returncode, 0, err)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
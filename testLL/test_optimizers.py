@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the update variants of the optimizers against the plain f_grad_shared / f_update step
+"""
+
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+import numpy
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+import theano
+import theano.tensor as tensor
+from nematus import optimizers
+from nematus.theano_util import itemlist
+
+OPTIMIZERS = ('sgd', 'adam', 'adadelta', 'rmsprop')
+N_IN = 6
+N_OUT = 5
+N_WORDS = 8
+SPARSE = dict(E=0, W=1, b=0)
+
+
+class TestOptimizers(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        self.W = self.rng.uniform(-0.5, 0.5, (N_IN, N_OUT)).astype('float32')
+        self.b = self.rng.uniform(-0.5, 0.5, N_OUT).astype('float32')
+        self.E = self.rng.uniform(-0.5, 0.5, (N_WORDS, N_IN)).astype('float32')
+
+    def model(self):
+        """a softmax classifier: parameters, inputs and the mean cost over the batch"""
+        tparams = OrderedDict([('W', theano.shared(self.W.copy(), name='W')),
+                               ('b', theano.shared(self.b.copy(), name='b'))])
+        x = tensor.matrix('x', dtype='float32')
+        y = tensor.vector('y', dtype='int64')
+        probs = tensor.nnet.softmax(tensor.dot(x, tparams['W']) + tparams['b'])
+        cost = -tensor.log(probs[tensor.arange(y.shape[0]), y]).mean()
+        return tparams, [x, y], cost
+
+    def optimizer(self, name, **kwargs):
+        tparams, inps, cost = self.model()
+        grads = tensor.grad(cost, wrt=itemlist(tparams))
+        lr = tensor.scalar(name='lr')
+        return tparams, getattr(optimizers, name)(lr, tparams, grads, inps, cost, **kwargs)
+
+    def lookup_model(self):
+        """a classifier over the sum of two word embeddings, with the scores of a sample of the classes
+        (as in the sampled softmax): parameters, inputs and the mean cost over the batch"""
+        tparams = OrderedDict([('E', theano.shared(self.E.copy(), name='E')),
+                               ('W', theano.shared(self.W.copy(), name='W')),
+                               ('b', theano.shared(self.b.copy(), name='b'))])
+        x = tensor.matrix('x', dtype='int64')
+        c = tensor.vector('c', dtype='int64')
+        y = tensor.vector('y', dtype='int64')
+        h = tparams['E'][x.flatten()].reshape((x.shape[0], 2, N_IN)).sum(1)
+        probs = tensor.nnet.softmax(tensor.dot(h, tparams['W'][:, c]) + tparams['b'][c])
+        cost = -tensor.log(probs[tensor.arange(y.shape[0]), y]).mean()
+        return tparams, [x, c, y], cost
+
+    def sparse_optimizer(self, name, sparse, **kwargs):
+        tparams, inps, cost = self.lookup_model()
+        grads, sparse = optimizers.gradients(cost, tparams, sparse)
+        lr = tensor.scalar(name='lr')
+        return tparams, getattr(optimizers, name)(lr, tparams, grads, inps, cost, sparse=sparse, **kwargs)
+
+    def lookup_batch(self, n, words=N_WORDS, classes=N_OUT):
+        # words and classes: how many of the first words and classes are used
+        x = self.rng.randint(0, words, (n, 2)).astype('int64')
+        x[:words // 2] = numpy.arange(words).reshape(-1, 2)[:n]
+        c = numpy.concatenate([self.rng.permutation(classes), self.rng.randint(0, classes, 2)]).astype('int64')
+        y = self.rng.randint(0, len(c), n).astype('int64')
+        return x, c, y
+
+    def batch(self, n):
+        x = self.rng.uniform(-1, 1, (n, N_IN)).astype('float32')
+        y = self.rng.randint(0, N_OUT, n).astype('int64')
+        return x, y
+
+    def assert_params_equal(self, tparams, other):
+        for k in tparams:
+            numpy.testing.assert_allclose(other[k].get_value(), tparams[k].get_value(), rtol=1e-5, atol=1e-6)
+
+    def test_fused(self):
+        # one call computes the same cost and update as f_grad_shared followed by f_update
+        batches = [self.batch(5) for _ in xrange(3)]
+        for name in OPTIMIZERS:
+            tparams, (f_grad_shared, f_update) = self.optimizer(name)
+            tparams_fused, f_train_step = self.optimizer(name, fused=True)
+            for x, y in batches:
+                cost = f_grad_shared(x, y)
+                f_update(0.01)
+                self.assertAlmostEqual(float(f_train_step(x, y, 0.01)), float(cost), places=5)
+                self.assert_params_equal(tparams, tparams_fused)
+
+        with self.assertRaises(ValueError):
+            self.optimizer('adam', fused=True, accumulate=True)
+
+    def test_accumulation(self):
+        # micro-batches weighted by their number of sentences give the update of the combined batch
+        batches = [self.batch(5) for _ in xrange(3)]
+        for name in OPTIMIZERS:
+            tparams, (f_grad_shared, f_update) = self.optimizer(name)
+            tparams_acc, (f_grad_acc, f_update_acc) = self.optimizer(name, accumulate=True)
+            for x, y in batches:
+                cost = f_grad_shared(x, y)
+                f_update(0.01)
+                costs = [f_grad_acc(x[:2], y[:2], 2.), f_grad_acc(x[2:], y[2:], 3.)]
+                f_update_acc(0.01)
+                self.assertAlmostEqual((2 * costs[0] + 3 * costs[1]) / 5, cost, places=5)
+                self.assert_params_equal(tparams, tparams_acc)
+
+    def test_sparse_updates_batch_rows(self):
+        # the words and classes that are not in the batches keep their parameters (and state)
+        for name in OPTIMIZERS:
+            for accumulate in (False, True):
+                tparams, (f_grad_shared, f_update) = self.sparse_optimizer(name, SPARSE, accumulate=accumulate)
+                for _ in xrange(3):
+                    x, c, y = self.lookup_batch(4, words=6, classes=3)
+                    if accumulate:
+                        f_grad_shared(x[:2], c, y[:2], 2.)
+                        f_grad_shared(x[2:], c, y[2:], 2.)
+                    else:
+                        f_grad_shared(x, c, y)
+                    f_update(0.01)
+                for k, n_used, initial in (('E', 6, self.E), ('W', 3, self.W.T), ('b', 3, self.b)):
+                    value = tparams[k].get_value().T if k == 'W' else tparams[k].get_value()
+                    numpy.testing.assert_array_equal(value[n_used:], initial[n_used:])
+                    self.assertTrue(all((value[i] != initial[i]).any() for i in xrange(n_used)))
+
+    def test_sparse_equals_dense_if_all_rows_used(self):
+        batches = [self.lookup_batch(4) for _ in xrange(3)]
+        for name in OPTIMIZERS:
+            for kwargs in (dict(), dict(fused=True), dict(accumulate=True)):
+                tparams, f = self.sparse_optimizer(name, {}, **kwargs)
+                tparams_sparse, f_sparse = self.sparse_optimizer(name, SPARSE, **kwargs)
+                for x, c, y in batches:
+                    if 'fused' in kwargs:
+                        f(x, c, y, 0.01)
+                        f_sparse(x, c, y, 0.01)
+                        self.assert_params_equal(tparams, tparams_sparse)
+                        continue
+                    (f_grad_shared, f_update), (f_grad_sparse, f_update_sparse) = f, f_sparse
+                    if 'accumulate' in kwargs:
+                        # both halves score the same classes: their rows are added up
+                        for f_grad in (f_grad_shared, f_grad_sparse):
+                            f_grad(x[:2], c, y[:2], 2.)
+                            f_grad(x[2:], c, y[2:], 2.)
+                    else:
+                        f_grad_shared(x, c, y)
+                        f_grad_sparse(x, c, y)
+                    f_update(0.01)
+                    f_update_sparse(0.01)
+                    self.assert_params_equal(tparams, tparams_sparse)
+
+    def test_sparse_needs_lookups(self):
+        # weight decay uses every row of the embeddings, so their gradient is not sparse
+        tparams, inps, cost = self.lookup_model()
+        cost += 0.01 * (tparams['E'] ** 2).sum()
+        with self.assertRaises(ValueError):
+            optimizers.gradients(cost, tparams, SPARSE)
+        optimizers.gradients(cost, tparams, dict(W=1, b=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the training costs of the output layer against reference computations
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+import theano
+import theano.tensor as tensor
+from theano.gof.graph import inputs as graph_inputs, io_toposort
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from theano.tensor.nnet.nnet import CrossentropySoftmaxArgmax1HotWithBias
+from nematus.nmt_utils import build_model, _sampled_softmax_cost
+from nematus.theano_util import init_theano_params
+
+from test_numpy_backend import random_model, random_batch, N_WORDS as N_MODEL_WORDS
+
+N_WORDS = 10
+N_SAMPLED = 20
+DIM = 8
+
+
+def log_sum_exp(x):
+    m = x.max(axis=-1, keepdims=True)
+    return (m + numpy.log(numpy.exp(x - m).sum(axis=-1, keepdims=True)))[..., 0]
+
+
+class TestSampledSoftmax(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        self.W = self.rng.uniform(-1, 1, (DIM, N_WORDS)).astype('float32')
+        self.b = self.rng.uniform(-1, 1, N_WORDS).astype('float32')
+
+    def sampled_cost(self, W, b):
+        tparams = dict(ff_logit_W=theano.shared(W), ff_logit_b=theano.shared(b))
+        hidden = tensor.tensor3('hidden', dtype='float32')
+        y = tensor.matrix('y', dtype='int64')
+        y_mask = tensor.matrix('y_mask', dtype='float32')
+        options = dict(n_words=N_WORDS, sampled_softmax=N_SAMPLED)
+        cost = _sampled_softmax_cost(tparams, options, RandomStreams(1234), hidden, y, y_mask)
+        grads = tensor.grad(cost.sum(), wrt=tparams.values())
+        return theano.function([hidden, y, y_mask], [cost] + grads)
+
+    def candidates(self):
+        # the candidates drawn by the first call of a fresh RandomStreams(1234), as in sampled_cost
+        u = RandomStreams(1234).uniform((N_SAMPLED,), dtype='float32').eval()
+        log_range = numpy.float32(numpy.log(N_WORDS + 1.))
+        return numpy.clip(numpy.floor(numpy.exp(u * log_range)) - 1., 0, N_WORDS - 1).astype('int64')
+
+    def batch(self, scale=1.):
+        hidden = (scale * self.rng.uniform(-1, 1, (4, 3, DIM))).astype('float32')
+        y = self.rng.randint(0, N_WORDS, (4, 3)).astype('int64')
+        y_mask = numpy.ones((4, 3), dtype='float32')
+        y_mask[3:, 1:] = 0.
+        return hidden, y, y_mask
+
+    def test_cost(self):
+        # the target word's logit against those of the other candidates, each corrected for
+        # its expected number of draws; candidates that are the target word are left out
+        hidden, y, y_mask = self.batch()
+        cost = self.sampled_cost(self.W, self.b)(hidden, y, y_mask)[0]
+
+        sampled = self.candidates()
+        logits = numpy.dot(hidden, self.W) + self.b
+        expected_count = N_SAMPLED * numpy.log((sampled + 2.) / (sampled + 1.)) / numpy.log(N_WORDS + 1.)
+        sampled_logits = logits[:, :, sampled] - numpy.log(expected_count)
+        is_target = y[:, :, None] == sampled[None, None, :]
+        self.assertTrue(is_target.any())
+        sampled_logits[is_target] = -numpy.inf
+        true_logits = logits[numpy.arange(4)[:, None], numpy.arange(3)[None, :], y]
+        all_logits = numpy.concatenate([true_logits[:, :, None], sampled_logits], axis=2)
+        expected = ((log_sum_exp(all_logits) - true_logits) * y_mask).sum(0)
+        numpy.testing.assert_allclose(cost, expected, rtol=1e-5)
+
+    def test_finite(self):
+        # large logits, and targets that are also drawn as candidates, give a finite cost and gradient
+        W = self.W * numpy.float32(100.)
+        hidden, y, y_mask = self.batch(scale=10.)
+        y[:] = self.candidates()[0]
+        outputs = self.sampled_cost(W, self.b)(hidden, y, y_mask)
+        for output in outputs:
+            self.assertTrue(numpy.isfinite(output).all())
+        self.assertTrue((outputs[0] >= 0).all())
+
+
+class TestCrossEntropy(unittest.TestCase):
+
+    def test_build_model_cost(self):
+        # the fused softmax cross-entropy of build_model gives the cost (and gradient) of
+        # -log(probs[idx]) on the probabilities of the same logits
+        rng = numpy.random.RandomState(1)
+        params, options = random_model(14)
+        tparams = init_theano_params(params)
+        trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost = build_model(tparams, options)
+        use_noise.set_value(0.)
+
+        node = [node for node in io_toposort(graph_inputs([cost]), [cost])
+                if isinstance(node.op, CrossentropySoftmaxArgmax1HotWithBias)][0]
+        logit, bias, y_flat = node.inputs
+        probs = tensor.nnet.softmax(logit + bias)
+        old_cost = -tensor.log(probs[tensor.arange(y_flat.shape[0]), y_flat])
+        old_cost = (old_cost.reshape([y.shape[0], y.shape[1]]) * y_mask).sum(0)
+
+        outputs = []
+        for c in (cost, old_cost):
+            outputs.append(theano.function([x, x_mask, y, y_mask],
+                                           [c] + tensor.grad(c.sum(), wrt=tparams.values())))
+        x_, x_mask_ = random_batch(rng, 4)
+        y_ = rng.randint(1, N_MODEL_WORDS, (6, 4)).astype('int64')
+        y_mask_ = numpy.ones((6, 4), dtype='float32')
+        y_mask_[4:, :2] = 0.
+        y_[4:, :2] = 0
+        fused, old = [f(x_, x_mask_, y_, y_mask_) for f in outputs]
+        for value, expected in zip(fused, old):
+            numpy.testing.assert_allclose(value, expected, rtol=1e-4, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
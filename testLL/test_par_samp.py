@@ -44,7 +44,7 @@ model_options = build_model_options(modeldir_AB, LANG_A, LANG_B)
 GPU_ID = 0
 
 
-def sample_par(lines, model_options, f_init, f_next, beam_size=3, suppress_unk=True):
+def sample_par(lines, model_options, f_init, f_next, beam_size=3):
         dictionaries = model_options['dictionaries']
         dictionaries_source = dictionaries[:-1]
         dictionary_target = dictionaries[-1]
@@ -105,7 +105,7 @@ def sample_par(lines, model_options, f_init, f_next, beam_size=3, suppress_unk=T
         parsample, parscore, parword_probs = gen_par_sample([f_init, ], [f_next, ],
                                                             sequences, xmask,
                                                             k=beam_size, maxlen=200,
-                                                            suppress_unk=suppress_unk)
+                                                            log_probs=True)
         print 'gen_par_samp returned, took %.1f seconds'%(time.time()-t0)
 
         t0 = time.time()
@@ -114,7 +114,7 @@ def sample_par(lines, model_options, f_init, f_next, beam_size=3, suppress_unk=T
             mask_size = int(round(np.sum(xmask[:,i])))
             seq = sequences[:, :mask_size, i:i+1]
             print 'calling gen_sample'
-            sample, score, word_probs, _, _ = gen_sample([f_init, ], [f_next, ], seq, k=beam_size, maxlen=200, stochastic = False, suppress_unk=suppress_unk)
+            sample, score, word_probs, _, _ = gen_sample([f_init, ], [f_next, ], seq, k=beam_size, maxlen=200, stochastic = False, log_probs=True)
             compare_samples += sample
 
         print 'iterative gen_sample took %.1f seconds'%(time.time()-t0)
@@ -153,7 +153,8 @@ class ParallelSampleTestCase(unittest.TestCase):
         cls.remote_interface = initialize(model_options=model_options,
                                           pyro_port=pyro_port,
                                           pyro_name=pyro_name,
-                                          pyro_key=pyro_key)
+                                          pyro_key=pyro_key,
+                                          suppress_unk=True)
 
     @classmethod
     def tearDownClass(cls):
@@ -172,8 +173,7 @@ class ParallelSampleTestCase(unittest.TestCase):
                                                model_options=model_options, 
                                                f_init = self.remote_interface.x_f_init,
                                                f_next = self.remote_interface.x_f_next,
-                                               beam_size=3, 
-                                               suppress_unk=True)
+                                               beam_size=3)
         self.assertEqual(parsamples, nonparsamples)
         #for line, sents, scores_per_sent in zip(lines, sample_words, score):
         #    print '------------------', line
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test that score_pairs returns the scores of the sentence pairs in input order
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+import theano
+from nematus.nmt_utils import build_model, prepare_data
+from nematus.quantize import quantize_params, dequantize_params
+from nematus.scoring import score_pairs
+from nematus.theano_util import init_theano_params
+
+from test_numpy_backend import random_model, N_WORDS_SRC, N_WORDS
+
+
+def random_sentence(rng, n_words, min_len=1, max_len=9):
+    return ['w{0}'.format(w) for w in rng.randint(2, n_words, rng.randint(min_len, max_len + 1))]
+
+
+class TestScorePairs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix='nematus-scoring')
+        dictionaries = []
+        for name, n_words in (('vocab.src.json', N_WORDS_SRC), ('vocab.trg.json', N_WORDS)):
+            vocab = dict(('w{0}'.format(i), i) for i in xrange(2, n_words))
+            vocab.update(eos=0, UNK=1)
+            dictionaries.append(cls.path(name))
+            with open(dictionaries[-1], 'w') as f:
+                json.dump(vocab, f)
+
+        cls.models, cls.options, cls.f_log_probs = [], [], []
+        for seed in (15, 16):
+            params, options = random_model(seed)
+            options['dictionaries'] = dictionaries
+            cls.models.append(cls.path('model{0}.npz'.format(seed)))
+            numpy.savez(cls.models[-1], **params)
+            cls.options.append(options)
+
+            # per-pair reference scores, without batching
+            trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost = build_model(init_theano_params(params), options)
+            use_noise.set_value(0.)
+            cls.f_log_probs.append(theano.function([x, x_mask, y, y_mask], cost))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.tmp_dir, name)
+
+    def write_pairs(self, sources, targets):
+        for name, lines in (('source', sources), ('target', targets)):
+            with open(self.path(name), 'w') as f:
+                for line in lines:
+                    f.write(' '.join(line) + '\n')
+        return self.path('source'), self.path('target')
+
+    def reference(self, f_log_probs, sources, targets):
+        scores = []
+        for source, target in zip(sources, targets):
+            x, x_mask, y, y_mask = prepare_data([[[int(w[1:])] for w in source]], [[int(w[1:]) for w in target]])
+            scores.append(f_log_probs(x, x_mask, y, y_mask)[0])
+        return numpy.array(scores)
+
+    def assert_scores(self, scores, sources, targets, n_models=1):
+        self.assertEqual(len(scores), n_models)
+        for model_scores, f_log_probs in zip(scores, self.f_log_probs):
+            numpy.testing.assert_allclose(model_scores, self.reference(f_log_probs, sources, targets),
+                                          rtol=1e-4, atol=1e-5)
+
+    def test_sort_by_length(self):
+        # batches of pairs sorted by length, and one model group per process
+        rng = numpy.random.RandomState(1)
+        sources = [random_sentence(rng, N_WORDS_SRC) for _ in xrange(11)]
+        targets = [random_sentence(rng, N_WORDS) for _ in xrange(11)]
+        source_file, target_file = self.write_pairs(sources, targets)
+        scores, _ = score_pairs(source_file, target_file, self.models, self.options, b=3, n_process=2)
+        self.assert_scores(scores, sources, targets, n_models=2)
+
+    def test_group_by_source(self):
+        # an n-best list: several translations of each source, some of them repeated
+        rng = numpy.random.RandomState(2)
+        distinct_sources = [random_sentence(rng, N_WORDS_SRC) for _ in xrange(3)]
+        sources, targets = [], []
+        for source in distinct_sources:
+            translations = [random_sentence(rng, N_WORDS) for _ in xrange(3)]
+            for target in translations + translations[:2]:
+                sources.append(source)
+                targets.append(target)
+        order = rng.permutation(len(sources))
+        sources, targets = [sources[i] for i in order], [targets[i] for i in order]
+
+        source_file, target_file = self.write_pairs(sources, targets)
+        scores, _ = score_pairs(source_file, target_file, self.models[:1], self.options[:1], b=4,
+                                group_by_source=True)
+        self.assert_scores(scores, sources, targets)
+
+    def test_quantized_model(self):
+        # a quantized model scores as its dequantized parameters
+        rng = numpy.random.RandomState(3)
+        sources = [random_sentence(rng, N_WORDS_SRC) for _ in xrange(5)]
+        targets = [random_sentence(rng, N_WORDS) for _ in xrange(5)]
+        source_file, target_file = self.write_pairs(sources, targets)
+        quantized = quantize_params(numpy.load(self.models[0]), ['Wemb', 'Wemb_dec', 'ff_logit_W', 'decoder_U'])
+        models = [self.path('quantized.npz'), self.path('dequantized.npz')]
+        numpy.savez(models[0], **quantized)
+        numpy.savez(models[1], **dequantize_params(quantized))
+        scores = [score_pairs(source_file, target_file, [model], self.options[:1], b=3)[0][0] for model in models]
+        numpy.testing.assert_allclose(scores[0], scores[1], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the keys, LRU eviction and persistence of the translation cache
+"""
+
+import cPickle as pkl
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+from nematus.translation_cache import TranslationCache
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='nematus-cache')
+        self.model = self.write('model.npz', 'model parameters')
+        self.dictionary = self.write('vocab.json', '{"eos": 0, "UNK": 1}')
+        self.path = os.path.join(self.tmp_dir, 'cache.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def key(self, **settings):
+        return TranslationCache.key([self.model], [self.dictionary], **settings)
+
+    def test_key(self):
+        key = self.key(k=5, normalize=True)
+        self.assertEqual(self.key(normalize=True, k=5), key)
+        self.assertNotEqual(self.key(k=12, normalize=True), key)
+        self.assertNotEqual(self.key(k=5), key)
+
+        # the model is identified by its contents, not its name
+        copy = os.path.join(self.tmp_dir, 'copy.npz')
+        shutil.copyfile(self.model, copy)
+        self.assertEqual(TranslationCache.key([copy], [self.dictionary], k=5, normalize=True), key)
+        self.write('model.npz', 'retrained model parameters')
+        self.assertNotEqual(self.key(k=5, normalize=True), key)
+
+    def test_get_put(self):
+        cache = TranslationCache()
+        key = self.key(k=5)
+        self.assertIsNone(cache.get(key, ['a', 'b']))
+        cache.put(key, ['a', 'b'], 'A B')
+        self.assertEqual(cache.get(key, ['a', 'b']), 'A B')
+        self.assertIsNone(cache.get(self.key(k=12), ['a', 'b']))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertAlmostEqual(cache.hit_rate(), 1. / 3)
+
+    def test_lru_eviction(self):
+        cache = TranslationCache(max_entries=2)
+        key = self.key(k=5)
+        cache.put(key, ['a'], 'A')
+        cache.put(key, ['b'], 'B')
+        cache.get(key, ['a'])  # a is now used more recently than b
+        cache.put(key, ['c'], 'C')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(key, ['b']))
+        self.assertEqual(cache.get(key, ['a']), 'A')
+        self.assertEqual(cache.get(key, ['c']), 'C')
+
+        # replacing an entry does not evict another one
+        cache.put(key, ['a'], 'A2')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(key, ['c']), 'C')
+
+    def test_persistence(self):
+        key = self.key(k=5)
+        cache = TranslationCache(self.path)
+        for word in 'abc':
+            cache.put(key, [word], word.upper())
+        cache.save()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse([f for f in os.listdir(self.tmp_dir) if f.endswith('.tmp')])
+
+        loaded = TranslationCache(self.path)
+        self.assertEqual(loaded.entries, cache.entries)
+        self.assertEqual(loaded.get(key, ['b']), 'B')
+
+        # a smaller cache keeps the most recently used entries
+        smaller = TranslationCache(self.path, max_entries=2)
+        self.assertEqual(smaller.entries.keys(), [(key, ('b',)), (key, ('c',))])
+
+    def test_unreadable_cache(self):
+        for content in ('not a pickle', pkl.dumps({'version': TranslationCache.VERSION - 1, 'entries': {}})):
+            self.write('cache.pkl', content)
+            cache = TranslationCache(self.path)
+            self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test claiming, resuming and concatenating sharded translation jobs
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+nem_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.insert(1, nem_path)
+from nematus.translation_job import ShardedJob
+
+LINES = ['line %d\n' % i for i in xrange(7)]
+SETTINGS = dict(models='0123abcd', k=5)
+
+
+class TestShardedJob(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp(prefix='nematus-job')
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def job(self, lines=LINES, settings=SETTINGS, lock_timeout=3600):
+        return ShardedJob(self.job_dir, lines, shard_size=3, settings=settings, lock_timeout=lock_timeout)
+
+    def finish(self, job, n):
+        # what translate.py does for a claimed shard
+        start, end = job.shard_range(n)
+        with open(job.tmp_path(n, 'out'), 'w') as out:
+            for line in LINES[start:end]:
+                out.write(line.upper())
+        job.commit(n)
+
+    def test_shards(self):
+        job = self.job()
+        self.assertEqual(job.n_shards, 3)
+        self.assertEqual([job.shard_range(n) for n in xrange(3)], [(0, 3), (3, 6), (6, 7)])
+
+    def test_claim(self):
+        job, other = self.job(), self.job()
+        self.assertEqual(job.claim_next(), 0)
+        self.assertFalse(other.claim(0))  # locked
+        self.assertEqual(other.claim_next(), 1)
+        job.release(0)
+        self.assertEqual(other.claim_next(), 0)
+
+    def test_done_shards_are_not_claimed(self):
+        job = self.job()
+        self.assertTrue(job.claim(1))
+        self.finish(job, 1)
+        self.assertTrue(job.is_done(1))
+        self.assertFalse(os.path.exists(job.path(1, 'lock')))
+        self.assertFalse(job.claim(1))
+
+    def test_stale_lock_is_taken_over(self):
+        job, other = self.job(lock_timeout=60), self.job(lock_timeout=60)
+        self.assertTrue(job.claim(0))
+        self.assertFalse(other.claim(0))
+        old = time.time() - 120
+        os.utime(job.path(0, 'lock'), (old, old))
+        self.assertTrue(other.claim(0))
+        self.assertFalse(job.claim(0))  # the new lock is fresh
+        # only the new lock is left behind
+        self.assertEqual([f for f in os.listdir(self.job_dir) if 'lock' in f], ['shard.000000.lock'])
+
+    def test_fresh_lock_is_not_taken_over(self):
+        # another process replaced the stale lock after this one found it stale
+        job = self.job(lock_timeout=60)
+        self.assertTrue(job.claim(0))
+        lock = job.path(0, 'lock')
+        stale = os.stat(lock)
+        os.remove(lock)
+        with open(lock, 'w') as f:
+            f.write('new owner\n')
+        self.assertFalse(job._take_over(lock, stale))
+        with open(lock) as f:
+            self.assertEqual(f.read(), 'new owner\n')
+
+    def test_resume_and_concatenate(self):
+        job = self.job()
+        for n in (2, 0):
+            self.assertTrue(job.claim(n))
+            self.finish(job, n)
+        self.assertFalse(job.all_done())
+
+        # a new run on the same job directory only translates the remaining shard
+        resumed = self.job()
+        self.assertEqual(resumed.claim_next(), 1)
+        self.finish(resumed, 1)
+        self.assertIsNone(resumed.claim_next())
+        self.assertTrue(resumed.all_done())
+
+        out = StringIO()
+        resumed.concatenate(out)
+        self.assertEqual(out.getvalue(), ''.join(LINES).upper())
+
+    def test_different_job(self):
+        self.job()
+        self.job()  # same job
+        with self.assertRaises(SystemExit):
+            self.job(settings=dict(SETTINGS, models='4567cdef'))
+        with self.assertRaises(SystemExit):
+            self.job(lines=LINES[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,7 +10,7 @@ remote.init(model_options)
 """
 
 
-def initialize(model_options, pyro_port, pyro_name, pyro_key):
+def initialize(model_options, pyro_port, pyro_name, pyro_key, suppress_unk=False):
     if model_options['dim_per_factor'] is None:
         if model_options['factors'] == 1:
             model_options['dim_per_factor'] = [model_options['dim_word']]
@@ -46,5 +46,5 @@ def initialize(model_options, pyro_port, pyro_name, pyro_key):
     remote = Pyro4.Proxy("PYRONAME:{0}".format(pyro_name))
     remote._pyroHmacKey = pyro_key
 
-    remote.init(model_options)
+    remote.init(model_options, suppress_unk=suppress_unk)
     return remote